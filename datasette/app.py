@@ -3,10 +3,12 @@ import collections
 import hashlib
 import itertools
 import json
+import multiprocessing
 import os
 import re
 import sys
 import threading
+import time
 import traceback
 import urllib.parse
 from concurrent import futures
@@ -18,27 +20,33 @@ from jinja2 import ChoiceLoader, Environment, FileSystemLoader, PrefixLoader, es
 from jinja2.environment import Template
 import uvicorn
 
-from .views.base import DatasetteError, ureg, AsgiRouter
+from .views.base import DatasetteError, HASH_LENGTH, ureg, AsgiRouter
 from .views.database import DatabaseDownload, DatabaseView
 from .views.index import IndexView
-from .views.special import JsonDataView
+from .views.special import JsonDataView, StatusView
 from .views.table import RowView, TableView
 from .renderer import json_renderer
-from .database import Database
+from .database import Database, DirectoryWatcher
+from .executor import init_process_worker
 
 from .utils import (
+    LRUCache,
     QueryInterrupted,
+    QueryRejected,
     escape_css_string,
     escape_sqlite,
     format_bytes,
     module_from_path,
     sqlite3,
+    sql_identifiers,
     to_css_class,
 )
 from .utils.asgi import (
+    AsgiCancelOnDisconnect,
     AsgiLifespan,
     NotFound,
     Response,
+    asgi_internal_get,
     asgi_static,
     asgi_send,
     asgi_send_html,
@@ -53,6 +61,8 @@ app_root = Path(__file__).parent.parent
 
 MEMORY = object()
 
+WARMUP_STEPS = ("read", "madvise", "queries", "pages")
+
 ConfigOption = collections.namedtuple("ConfigOption", ("name", "default", "help"))
 CONFIG_OPTIONS = (
     ConfigOption("default_page_size", 100, "Default page size for the table view"),
@@ -66,6 +76,82 @@ CONFIG_OPTIONS = (
         3,
         "Number of threads in the thread pool for executing SQLite queries",
     ),
+    ConfigOption(
+        "max_shared_sql_threads",
+        0,
+        "Maximum threads one database can use at once from the shared thread pool (0 == no limit)",
+    ),
+    ConfigOption(
+        "num_sql_connections",
+        0,
+        "Number of read connections to pool for each database (0 == num_sql_threads)",
+    ),
+    ConfigOption(
+        "sql_connection_idle_timeout",
+        0,
+        "Close pooled read connections unused for this many seconds (0 == never)",
+    ),
+    ConfigOption(
+        "max_sql_in_flight",
+        0,
+        "Reject new queries for a database that already has this many running or queued (0 == no limit)",
+    ),
+    ConfigOption(
+        "max_sql_queued",
+        0,
+        "Reject new queries for a database that already has this many waiting for a thread (0 == no limit)",
+    ),
+    ConfigOption(
+        "sql_queue_timeout_ms",
+        0,
+        "Reject queries that have waited this long for a thread (0 == no limit)",
+    ),
+    ConfigOption(
+        "sql_shed_queue_depth",
+        0,
+        "Skip queries for suggested facets while this many queries are waiting (0 == never)",
+    ),
+    ConfigOption(
+        "num_sql_processes",
+        0,
+        "Number of worker processes for queries against immutable databases (0 == use threads)",
+    ),
+    ConfigOption(
+        "write_batch_size",
+        100,
+        "Maximum queued writes to commit together in one transaction",
+    ),
+    ConfigOption(
+        "write_batch_window_ms",
+        0,
+        "Time to wait for more writes to join a batch before committing it",
+    ),
+    ConfigOption(
+        "wal_mode",
+        False,
+        "Switch mutable databases to WAL mode when writing to them and checkpoint them in the background",
+    ),
+    ConfigOption(
+        "wal_checkpoint_pages",
+        1000,
+        "Checkpoint WAL mode databases once their WAL holds this many pages",
+    ),
+    ConfigOption(
+        "wal_checkpoint_interval_ms",
+        1000,
+        "How often to check whether WAL mode databases need a checkpoint",
+    ),
+    ConfigOption(
+        "change_check_interval_ms",
+        500,
+        "How often to check mutable databases for changes made by other processes",
+    ),
+    ConfigOption(
+        "query_cache_kb", 0, "Memory to use for caching query results (0 == disabled)",
+    ),
+    ConfigOption(
+        "facet_cache_kb", 0, "Memory to use for caching facet results (0 == disabled)",
+    ),
     ConfigOption(
         "sql_time_limit_ms", 1000, "Time limit for a SQL query in milliseconds"
     ),
@@ -75,11 +161,21 @@ CONFIG_OPTIONS = (
     ConfigOption(
         "facet_time_limit_ms", 200, "Time limit for calculating a requested facet"
     ),
+    ConfigOption(
+        "facet_sample_size",
+        10000,
+        "Rows to sample for approximate facets (0 == never approximate)",
+    ),
     ConfigOption(
         "facet_suggest_time_limit_ms",
         50,
         "Time limit for calculating a suggested facet",
     ),
+    ConfigOption(
+        "facet_suggest_sample_size",
+        1000,
+        "Number of rows to look at when suggesting facets",
+    ),
     ConfigOption(
         "hash_urls",
         False,
@@ -107,9 +203,54 @@ CONFIG_OPTIONS = (
         365 * 24 * 60 * 60,
         "Default HTTP cache TTL for hashed URL pages",
     ),
+    ConfigOption(
+        "hash_cache",
+        False,
+        "Cache the hashes of immutable databases in a file next to each one",
+    ),
+    ConfigOption(
+        "lazy_startup",
+        False,
+        "Start serving at once, hashing and counting immutable databases in the background",
+    ),
+    ConfigOption(
+        "dir_scan_interval_ms",
+        1000,
+        "How often to check directories passed to --dir for new or replaced databases",
+    ),
+    ConfigOption(
+        "warmup",
+        "",
+        "Warm caches at startup - comma separated steps from read, madvise, queries, pages",
+    ),
+    ConfigOption(
+        "fast_count_threshold",
+        0,
+        "Estimate counts for tables with at least this many rows (0 == always count)",
+    ),
     ConfigOption(
         "cache_size_kb", 0, "SQLite cache size in KB (0 == use SQLite default)"
     ),
+    ConfigOption(
+        "mmap_size_mb",
+        0,
+        "Memory-mapped I/O size in MB for reading SQLite files (0 == use SQLite default)",
+    ),
+    ConfigOption(
+        "temp_store",
+        "default",
+        "Where SQLite keeps temporary tables and indices: default, file or memory",
+    ),
+    ConfigOption(
+        "cached_statements",
+        0,
+        "Prepared statements to cache for each connection (0 == Python default)",
+    ),
+    ConfigOption(
+        "sqlite_threads",
+        0,
+        "Helper threads SQLite can use for a single sort (0 == none)",
+    ),
     ConfigOption(
         "allow_csv_stream",
         True,
@@ -161,27 +302,17 @@ class Datasette:
         memory=False,
         config=None,
         version_note=None,
+        watch_dirs=None,
     ):
         immutables = immutables or []
         self.files = tuple(files) + tuple(immutables)
         self.immutables = set(immutables)
-        if not self.files:
+        if not self.files and not watch_dirs:
             self.files = [MEMORY]
         elif memory:
             self.files = (MEMORY,) + self.files
         self.databases = collections.OrderedDict()
         self.inspect_data = inspect_data
-        for file in self.files:
-            path = file
-            is_memory = False
-            if file is MEMORY:
-                path = None
-                is_memory = True
-            is_mutable = path not in self.immutables
-            db = Database(self, path, is_mutable=is_mutable, is_memory=is_memory)
-            if db.name in self.databases:
-                raise Exception("Multiple files with same stem: {}".format(db.name))
-            self.add_database(db.name, db)
         self.cache_headers = cache_headers
         self.cors = cors
         self._metadata = metadata or {}
@@ -196,9 +327,35 @@ class Datasette:
         self.executor = futures.ThreadPoolExecutor(
             max_workers=self.config("num_sql_threads")
         )
+        self._process_executor = None
+        self.query_cache = LRUCache(self.config("query_cache_kb") * 1024)
+        self.facet_cache = LRUCache(self.config("facet_cache_kb") * 1024)
+        # Samples of rows for suggested facets that are being read right now
+        self.pending_facet_samples = {}
+        self._startup_tasks = []
+        self._warmup_timings = {}
+        self._warmup_complete = False
+        self._directory_watcher_task = None
         self.max_returned_rows = self.config("max_returned_rows")
         self.sql_time_limit_ms = self.config("sql_time_limit_ms")
         self.page_size = self.config("default_page_size")
+        for file in self.files:
+            path = file
+            is_memory = False
+            if file is MEMORY:
+                path = None
+                is_memory = True
+            is_mutable = path not in self.immutables
+            db = Database(self, path, is_mutable=is_mutable, is_memory=is_memory)
+            if db.name in self.databases:
+                raise Exception("Multiple files with same stem: {}".format(db.name))
+            self.add_database(db.name, db)
+        self.directory_watcher = None
+        if watch_dirs:
+            self.directory_watcher = DirectoryWatcher(
+                self, watch_dirs, interval_ms=self.config("dir_scan_interval_ms")
+            )
+            self.directory_watcher.attach_existing()
         # Execute plugins in constructor, to ensure they are available
         # when the rest of `datasette inspect` executes
         if self.plugins_dir:
@@ -248,11 +405,148 @@ class Datasette:
         self.databases[name] = db
 
     def remove_database(self, name):
-        self.databases.pop(name)
+        db = self.databases.pop(name)
+        db.close()
+
+    @property
+    def process_executor(self):
+        "Process pool for read queries against immutable databases, if enabled"
+        num_processes = self.config("num_sql_processes")
+        if not num_processes or sys.version_info < (3, 7):
+            # initializer= for ProcessPoolExecutor requires Python 3.7+
+            return None
+        if self._process_executor is None:
+            self._process_executor = futures.ProcessPoolExecutor(
+                max_workers=num_processes,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_process_worker,
+                initargs=(
+                    self._metadata,
+                    self._config,
+                    self.sqlite_extensions,
+                    self.plugins_dir,
+                ),
+            )
+        return self._process_executor
+
+    async def query_cache_enabled(self, database, sql):
+        "Can results of this SQL be cached, based on query_cache in metadata?"
+        if self.metadata("query_cache", database=database) is False:
+            return False
+        databases = self._metadata.get("databases") or {}
+        tables = (databases.get(database) or {}).get("tables") or {}
+        excluded = [
+            table
+            for table, table_metadata in tables.items()
+            if table_metadata.get("query_cache") is False
+        ]
+        if not excluded:
+            return True
+        # Queries through a view over an excluded table are excluded too
+        schema = await self.databases[database].schema()
+        return not (sql_identifiers(sql) & schema.with_dependent_views(excluded))
+
+    def caches(self):
+        return {
+            "query": self.query_cache.stats(),
+            "facet": self.facet_cache.stats(),
+        }
+
+    def status(self):
+        databases = {
+            name: {
+                "hash_ready": not db.hash_pending,
+                "counts_ready": not db.counts_pending,
+            }
+            for name, db in self.databases.items()
+        }
+        num_ready = len(
+            [d for d in databases.values() if d["hash_ready"] and d["counts_ready"]]
+        )
+        warmup_steps = self.warmup_steps()
+        warmup_complete = self._warmup_complete or not warmup_steps
+        status = {
+            "ready": num_ready == len(databases) and warmup_complete,
+            "lazy_startup": self.config("lazy_startup"),
+            "databases_ready": num_ready,
+            "databases_total": len(databases),
+            "databases": databases,
+            "warmup": {
+                "steps": warmup_steps,
+                "complete": warmup_complete,
+                "timings_ms": dict(self._warmup_timings),
+            },
+        }
+        if self.directory_watcher is not None:
+            status["directories"] = self.directory_watcher.stats()
+        return status
+
+    def warmup_steps(self):
+        steps = [
+            step.strip().lower() for step in (self.config("warmup") or "").split(",")
+        ]
+        return [step for step in steps if step in WARMUP_STEPS]
 
-    def config(self, key):
+    async def warmup(self, asgi):
+        """
+        Runs the configured warmup steps in order, so the first requests after
+        startup do not have to wait for a cold page cache
+        """
+        for step in self.warmup_steps():
+            start = time.perf_counter()
+            if step in ("read", "madvise"):
+                await self._warmup_files(step)
+            elif step == "queries":
+                await self._warmup_queries()
+            elif step == "pages":
+                await self._warmup_pages(asgi)
+            self._warmup_timings[step] = round((time.perf_counter() - start) * 1000, 3)
+        self._warmup_complete = True
+
+    async def _warmup_files(self, method):
+        loop = asyncio.get_event_loop()
+        await asyncio.gather(
+            *[
+                loop.run_in_executor(None, database.warm_page_cache, method)
+                for database in self.databases.values()
+                if not database.is_mutable
+            ]
+        )
+
+    async def _warmup_queries(self):
+        # Canned queries run with blank parameters, as they are when their
+        # page is first visited
+        for dbname in list(self.databases):
+            for query in self.get_canned_queries(dbname):
+                params = {
+                    name: "" for name in re.findall(":([a-zA-Z0-9_]+)", query["sql"])
+                }
+                try:
+                    await self.execute(dbname, query["sql"], params, truncate=True)
+                except (QueryInterrupted, QueryRejected, sqlite3.DatabaseError):
+                    pass
+
+    async def _warmup_pages(self, asgi):
+        base_url = self.config("base_url")
+        paths = [base_url]
+        for dbname, database in self.databases.items():
+            if self.config("hash_urls") and database.hash:
+                dbname = "{}-{}".format(dbname, database.hash[:HASH_LENGTH])
+            paths.append(base_url + dbname)
+        for path in paths:
+            await asgi_internal_get(asgi, path)
+
+    def config(self, key, database=None):
+        if database is not None:
+            database_config = self.database_config(database)
+            if key in database_config:
+                return database_config[key]
         return self._config.get(key, None)
 
+    def database_config(self, database):
+        "Config overrides set in the metadata for a specific database"
+        return self.metadata("config", database=database, fallback=False) or {}
+
     def config_dict(self):
         # Returns a fully resolved config dictionary, useful for templates
         return {option.name: self.config(option.name) for option in CONFIG_OPTIONS}
@@ -359,8 +653,6 @@ class Datasette:
             conn.enable_load_extension(True)
             for extension in self.sqlite_extensions:
                 conn.execute("SELECT load_extension('{}')".format(extension))
-        if self.config("cache_size_kb"):
-            conn.execute("PRAGMA cache_size=-{}".format(self.config("cache_size_kb")))
         # pylint: disable=no-member
         pm.hook.prepare_connection(conn=conn, database=database, datasette=self)
 
@@ -373,6 +665,7 @@ class Datasette:
         custom_time_limit=None,
         page_size=None,
         log_sql_errors=True,
+        priority="interactive",
     ):
         return await self.databases[db_name].execute(
             sql,
@@ -381,6 +674,7 @@ class Datasette:
             custom_time_limit=custom_time_limit,
             page_size=page_size,
             log_sql_errors=log_sql_errors,
+            priority=priority,
         )
 
     async def expand_foreign_keys(self, database, table, column, values):
@@ -413,7 +707,7 @@ class Datasette:
         )
         try:
             results = await self.execute(database, sql, list(set(values)))
-        except QueryInterrupted:
+        except (QueryInterrupted, QueryRejected):
             pass
         else:
             for id, value in results:
@@ -431,7 +725,7 @@ class Datasette:
         for unit in self.metadata("custom_units") or []:
             ureg.define(unit)
 
-    def connected_databases(self):
+    async def connected_databases(self):
         return [
             {
                 "name": d.name,
@@ -440,6 +734,10 @@ class Datasette:
                 "is_mutable": d.is_mutable,
                 "is_memory": d.is_memory,
                 "hash": d.hash,
+                "generation": await d.current_generation(),
+                "wal": d.wal_stats(),
+                "tuning": d.tuning,
+                "pool": d.pool.stats(),
             }
             for d in sorted(self.databases.values(), key=lambda d: d.name)
         ]
@@ -513,6 +811,9 @@ class Datasette:
             "threads": [
                 {"name": t.name, "ident": t.ident, "daemon": t.daemon} for t in threads
             ],
+            "databases": {
+                name: db.executor.stats() for name, db in self.databases.items()
+            },
         }
         # Only available in Python 3.7+
         if hasattr(asyncio, "all_tasks"):
@@ -700,6 +1001,14 @@ class Datasette:
             JsonDataView.as_asgi(self, "databases.json", self.connected_databases),
             r"/-/databases(?P<as_format>(\.json)?)$",
         )
+        add_route(
+            JsonDataView.as_asgi(self, "caches.json", self.caches),
+            r"/-/caches(?P<as_format>(\.json)?)$",
+        )
+        add_route(
+            StatusView.as_asgi(self, "status.json", self.status),
+            r"/-/status(?P<as_format>(\.json)?)$",
+        )
         add_route(
             DatabaseDownload.as_asgi(self), r"/(?P<db_name>[^/]+?)(?P<as_db>\.db)$"
         )
@@ -722,13 +1031,52 @@ class Datasette:
         self.register_custom_units()
 
         async def setup_db():
-            # First time server starts up, calculate table counts for immutable databases
+            # Open and prepare read connections before the first request arrives
             for dbname, database in self.databases.items():
-                if not database.is_mutable:
-                    await database.table_counts(limit=60 * 60 * 1000)
+                await database.prewarm()
+            if self.directory_watcher is not None:
+                self._directory_watcher_task = asyncio.ensure_future(
+                    self.directory_watcher.run()
+                )
+            if self.config("lazy_startup"):
+                # Hash and count in the background, serving requests meanwhile
+                finish_tasks = []
+                for database in self.databases.values():
+                    if not database.is_mutable and database.cached_table_counts is None:
+                        database.counts_pending = True
+                    if database.hash_pending or database.counts_pending:
+                        finish_tasks.append(
+                            asyncio.ensure_future(database.finish_startup())
+                        )
+                self._startup_tasks.extend(finish_tasks)
+                if self.warmup_steps():
+
+                    async def finish_then_warmup():
+                        await asyncio.gather(*finish_tasks)
+                        await self.warmup(asgi)
+
+                    self._startup_tasks.append(
+                        asyncio.ensure_future(finish_then_warmup())
+                    )
+                return
+            # First time server starts up, calculate table counts for immutable databases
+            await asyncio.gather(
+                *[
+                    database.table_counts(limit=60 * 60 * 1000)
+                    for database in self.databases.values()
+                    if not database.is_mutable
+                ]
+            )
+            await self.warmup(asgi)
+
+        async def stop_watching():
+            if self._directory_watcher_task is not None:
+                self._directory_watcher_task.cancel()
 
         asgi = AsgiLifespan(
-            AsgiTracer(DatasetteRouter(self, routes)), on_startup=setup_db
+            AsgiCancelOnDisconnect(AsgiTracer(DatasetteRouter(self, routes))),
+            on_startup=setup_db,
+            on_shutdown=stop_watching,
         )
         for wrapper in pm.hook.asgi_wrapper(datasette=self):
             asgi = wrapper(asgi)
@@ -760,10 +1108,16 @@ class DatasetteRouter(AsgiRouter):
 
     async def handle_500(self, scope, receive, send, exception):
         title = None
+        extra_headers = {}
         if isinstance(exception, NotFound):
             status = 404
             info = {}
             message = exception.args[0]
+        elif isinstance(exception, QueryRejected):
+            status = 503
+            info = {}
+            message = str(exception)
+            extra_headers["Retry-After"] = str(exception.retry_after)
         elif isinstance(exception, DatasetteError):
             status = exception.status
             info = exception.error_dict
@@ -780,7 +1134,7 @@ class DatasetteRouter(AsgiRouter):
         if status != 500:
             templates = ["{}.html".format(status)] + templates
         info.update({"ok": False, "error": message, "status": status, "title": title})
-        headers = {}
+        headers = extra_headers
         if self.ds.cors:
             headers["Access-Control-Allow-Origin"] = "*"
         if scope["path"].split("?")[0].endswith(".json"):
@@ -9,6 +9,7 @@ import shutil
 from subprocess import call
 import sys
 from .app import Datasette, DEFAULT_CONFIG, CONFIG_OPTIONS, pm
+from .inspect import inspect_column_stats
 from .utils import (
     check_connection,
     ConnectionProblem,
@@ -76,31 +77,67 @@ def cli():
     type=click.Path(exists=True, resolve_path=True),
     help="Path to a SQLite extension to load",
 )
-def inspect(files, inspect_file, sqlite_extensions):
+@click.option(
+    "--top-values",
+    type=int,
+    default=0,
+    help="Store the N most common values of every column, for facets",
+)
+def inspect(files, inspect_file, sqlite_extensions, top_values):
     app = Datasette([], immutables=files, sqlite_extensions=sqlite_extensions)
     if inspect_file == "-":
         out = sys.stdout
     else:
         out = open(inspect_file, "w")
     loop = asyncio.get_event_loop()
-    inspect_data = loop.run_until_complete(inspect_(files, sqlite_extensions))
+    inspect_data = loop.run_until_complete(
+        inspect_(files, sqlite_extensions, top_values)
+    )
     out.write(json.dumps(inspect_data, indent=2))
 
 
-async def inspect_(files, sqlite_extensions):
+async def inspect_(files, sqlite_extensions, top_values=0):
     app = Datasette([], immutables=files, sqlite_extensions=sqlite_extensions)
     data = {}
     for name, database in app.databases.items():
         counts = await database.table_counts(limit=3600 * 1000)
+        schema = await database.schema()
+        hidden_table_names = set(await database.hidden_table_names())
+        all_foreign_keys = schema.all_foreign_keys()
         data[name] = {
             "hash": database.hash,
             "size": database.size,
             "file": database.path,
             "tables": {
-                table_name: {"count": table_count}
+                table_name: {
+                    "count": table_count,
+                    "columns": schema.table_columns(table_name),
+                    "primary_keys": schema.primary_keys(table_name),
+                    "hidden": table_name in hidden_table_names,
+                    "fts_table": schema.fts_table(table_name),
+                    "foreign_keys": all_foreign_keys[table_name],
+                    "indexes": schema.indexes(table_name),
+                }
                 for table_name, table_count in counts.items()
             },
+            "views": {
+                view_name: {
+                    "columns": schema.table_columns(view_name),
+                    "sql": schema.definition(view_name, "view"),
+                }
+                for view_name in schema.view_names()
+            },
+            "schema": schema.to_dict(),
         }
+        if top_values:
+            for table_name, table_data in data[name]["tables"].items():
+                if table_data["hidden"]:
+                    continue
+                table_data[
+                    "column_stats"
+                ] = await database.execute_against_connection_in_thread(
+                    lambda conn: inspect_column_stats(conn, table_name, top_values)
+                )
     return data
 
 
@@ -300,6 +337,13 @@ def package(
     multiple=True,
 )
 @click.option("--memory", is_flag=True, help="Make :memory: database available")
+@click.option(
+    "watch_dirs",
+    "--dir",
+    type=click.Path(exists=True, file_okay=False, dir_okay=True),
+    help="Serve the .db files in this directory as immutable databases, attaching new and replaced files without a restart",
+    multiple=True,
+)
 @click.option(
     "--config",
     type=Config(),
@@ -323,6 +367,7 @@ def serve(
     plugins_dir,
     static,
     memory,
+    watch_dirs,
     config,
     version_note,
     help_config,
@@ -373,6 +418,7 @@ def serve(
         config=dict(config),
         memory=memory,
         version_note=version_note,
+        watch_dirs=watch_dirs,
     )
     # Run async sanity checks - but only if we're not under pytest
     asyncio.get_event_loop().run_until_complete(check_databases(ds))
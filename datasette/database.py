@@ -1,27 +1,41 @@
 import asyncio
+from concurrent import futures
 import contextlib
 from pathlib import Path
 import janus
+import mmap
+import os
 import queue
 import threading
+import time
 import uuid
 
+from .executor import QueryExecutor, execute_in_process
 from .tracer import trace
+from .utils.asgi import current_cancellation
 from .utils import (
     QueryInterrupted,
+    QueryRejected,
     Results,
+    cache_key_params,
     detect_fts,
     detect_primary_keys,
     detect_spatialite,
+    estimated_size,
     get_all_foreign_keys,
     get_outbound_foreign_keys,
+    sql_identifiers,
+    result_row_class,
     sqlite_timelimit,
     sqlite3,
     table_columns,
 )
-from .inspect import inspect_hash
-
-connections = threading.local()
+from .inspect import (
+    HASH_BLOCK_SIZE,
+    inspect_hash,
+    read_cached_hash,
+    write_cached_hash,
+)
 
 
 class Database:
@@ -33,33 +47,126 @@ class Database:
         self.hash = None
         self.cached_size = None
         self.cached_table_counts = None
+        # Tables whose cached count is an estimate - see fast_count_threshold
+        self.estimated_table_counts = set()
+        # Set while a lazy startup is still counting this database's tables
+        self.counts_pending = False
+        # SQLite settings read back from the first connection opened
+        self.tuning = None
         self._write_thread = None
         self._write_queue = None
+        self._schema = None
+        self._schema_lock = threading.Lock()
+        self._pool = None
+        self._executor = None
+        self._changes = None
+        self._checkpoints = None
+        self._schema_generation = None
+        self._table_counts_generation = None
+        # Time limit used for cached_table_counts, None if every count finished
+        self._table_counts_limit = None
         if not self.is_mutable:
             p = Path(path)
-            self.hash = inspect_hash(p)
-            self.cached_size = p.stat().st_size
+            stat = p.stat()
+            self.cached_size = stat.st_size
+            self.hash = self._hash_from_inspect_data(stat) or self._cached_hash(p, stat)
+            # With lazy_startup the hash is computed later by compute_hash()
+            if self.hash is None and not self.ds.config("lazy_startup"):
+                self.compute_hash()
             # Maybe use self.ds.inspect_data to populate cached_table_counts
-            if self.ds.inspect_data and self.ds.inspect_data.get(self.name):
+            info = self._inspect_info()
+            if info:
                 self.cached_table_counts = {
-                    key: value["count"]
-                    for key, value in self.ds.inspect_data[self.name]["tables"].items()
+                    key: value["count"] for key, value in info["tables"].items()
                 }
+            # ... and the schema catalog, so no introspection queries are needed
+            if info.get("schema") and info.get("size") in (None, stat.st_size):
+                self._schema = SchemaCatalog.from_dict(info["schema"])
+
+    def _inspect_info(self):
+        return (self.ds.inspect_data or {}).get(self.name) or {}
+
+    def inspected_table(self, table):
+        """
+        What `datasette inspect` recorded about a table, or None if this
+        database is mutable or the file has changed size since then
+        """
+        if self.is_mutable:
+            return None
+        info = self._inspect_info()
+        if info.get("size") not in (None, self.cached_size):
+            return None
+        return (info.get("tables") or {}).get(table)
+
+    def _hash_from_inspect_data(self, stat):
+        # Trust a hash from `datasette inspect` if the file size still matches
+        info = self._inspect_info()
+        if info.get("hash") and info.get("size") == stat.st_size:
+            return info["hash"]
+        return None
+
+    def _cached_hash(self, path, stat):
+        if self.ds.config("hash_cache", database=self.name):
+            return read_cached_hash(path, stat)
+        return None
+
+    def compute_hash(self):
+        "Hash the database file, setting self.hash - this can take a while"
+        path = Path(self.path)
+        stat = path.stat()
+        hash = inspect_hash(path)
+        if self.ds.config("hash_cache", database=self.name):
+            write_cached_hash(path, stat, hash)
+        self.hash = hash
+        return hash
+
+    def warm_page_cache(self, method="read"):
+        """
+        Pulls the database file into the operating system's page cache - runs
+        in a thread. "madvise" asks the kernel to read ahead in the background
+        where that is supported, "read" reads the whole file.
+        """
+        with Path(self.path).open("rb") as fp:
+            if method == "madvise" and hasattr(mmap, "MADV_WILLNEED"):
+                try:
+                    mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+                except (ValueError, OSError):
+                    # Empty files cannot be memory-mapped
+                    return
+                with mapped:
+                    mapped.madvise(mmap.MADV_WILLNEED)
+                return
+            buffer = bytearray(HASH_BLOCK_SIZE)
+            while fp.readinto(buffer):
+                pass
+
+    @property
+    def hash_pending(self):
+        return not self.is_mutable and self.hash is None
 
     def connect(self, write=False):
+        kwargs = {"check_same_thread": False}
+        cached_statements = self.ds.config("cached_statements", database=self.name)
+        if cached_statements:
+            kwargs["cached_statements"] = cached_statements
         if self.is_memory:
-            return sqlite3.connect(":memory:")
-        # mode=ro or immutable=1?
-        if self.is_mutable:
-            qs = "?mode=ro"
+            conn = sqlite3.connect(":memory:", **kwargs)
         else:
-            qs = "?immutable=1"
-        assert not (write and not self.is_mutable)
-        if write:
-            qs = ""
-        return sqlite3.connect(
-            "file:{}{}".format(self.path, qs), uri=True, check_same_thread=False
-        )
+            # mode=ro or immutable=1?
+            if self.is_mutable:
+                qs = "?mode=ro"
+            else:
+                qs = "?immutable=1"
+            assert not (write and not self.is_mutable)
+            if write:
+                qs = ""
+            conn = sqlite3.connect(
+                "file:{}{}".format(self.path, qs), uri=True, **kwargs
+            )
+        tune_connection(conn, self.ds, self.name)
+        if self.tuning is None and not write:
+            self.tuning = effective_tuning(conn, cached_statements)
+        return conn
 
     async def execute_write(self, sql, params=None, block=False):
         def _inner(conn):
@@ -92,28 +199,294 @@ class Database:
         # Infinite looping thread that protects the single write connection
         # to this database
         conn = self.connect(write=True)
+        if self.uses_wal:
+            self._enable_wal(conn)
         while True:
-            task = self._write_queue.get()
+            self._execute_write_batch(conn, self._next_write_batch())
+
+    @property
+    def uses_wal(self):
+        "Should Datasette switch this database to WAL mode and checkpoint it?"
+        return bool(
+            self.is_mutable
+            and not self.is_memory
+            and self.ds.config("wal_mode", database=self.name)
+        )
+
+    def _enable_wal(self, conn):
+        conn.execute("PRAGMA journal_mode=wal")
+        # NORMAL is durable in WAL mode other than across power loss, and
+        # avoids an fsync on every commit
+        conn.execute("PRAGMA synchronous=normal")
+        # Checkpoints are run by the scheduler instead of during commits
+        conn.execute("PRAGMA wal_autocheckpoint=0")
+        self._checkpoints = CheckpointScheduler(
+            self,
+            pages=self.ds.config("wal_checkpoint_pages", database=self.name),
+            interval_ms=self.ds.config(
+                "wal_checkpoint_interval_ms", database=self.name
+            ),
+        )
+        self._checkpoints.start()
+
+    @property
+    def wal_size(self):
+        "Size in bytes of the WAL file for this database, or None"
+        if self.is_memory or not self.is_mutable:
+            return None
+        try:
+            return os.stat(str(self.path) + "-wal").st_size
+        except OSError:
+            return None
+
+    def wal_stats(self):
+        wal_size = self.wal_size
+        if wal_size is None:
+            return None
+        stats = {"size": wal_size}
+        if self._checkpoints is not None:
+            stats.update(self._checkpoints.stats())
+        return stats
+
+    def _next_write_batch(self):
+        # Blocks for the next task, then gathers any more that are queued
+        # (or arrive within write_batch_window_ms) up to write_batch_size
+        tasks = [self._write_queue.get()]
+        batch_size = self.ds.config("write_batch_size", database=self.name) or 1
+        window_ms = self.ds.config("write_batch_window_ms", database=self.name) or 0
+        deadline = time.monotonic() + window_ms / 1000
+        while len(tasks) < batch_size:
+            timeout = deadline - time.monotonic()
             try:
+                if timeout > 0:
+                    tasks.append(self._write_queue.get(timeout=timeout))
+                else:
+                    tasks.append(self._write_queue.get_nowait())
+            except queue.Empty:
+                break
+        return tasks
+
+    def _execute_write_batch(self, conn, tasks):
+        # Runs every task in one transaction, each inside its own savepoint
+        # so a failing task only rolls back its own changes
+        if len(tasks) == 1:
+            self._execute_write_task(conn, tasks[0])
+            return
+        results = []
+        try:
+            for i, task in enumerate(tasks):
+                if not conn.in_transaction:
+                    # Also after a task that ended the transaction itself,
+                    # e.g. with conn.executescript() or "commit"
+                    conn.execute("begin")
+                savepoint = "datasette_write_{}".format(i)
+                conn.execute("savepoint {}".format(savepoint))
+                try:
+                    result = task.fn(SavepointConnection(conn, savepoint))
+                    if conn.in_transaction:
+                        conn.execute("release {}".format(savepoint))
+                except Exception as e:
+                    print(e)
+                    if conn.in_transaction:
+                        conn.execute("rollback to {}".format(savepoint))
+                        conn.execute("release {}".format(savepoint))
+                    result = e
+                results.append(result)
+            conn.commit()
+        except Exception as e:
+            # Nothing in the batch can be trusted to have been written
+            print(e)
+            if conn.in_transaction:
+                try:
+                    conn.rollback()
+                except Exception as rollback_error:
+                    print(rollback_error)
+            results = [e] * len(tasks)
+        finally:
+            # Every task gets a reply, even if the batch failed part way
+            results += [None] * (len(tasks) - len(results))
+            self.changes.bump()
+            for task, result in zip(tasks, results):
+                task.reply_queue.sync_q.put(result)
+
+    def _execute_write_task(self, conn, task):
+        # A write on its own gets the connection itself, exactly as it would
+        # without batching, and anything it leaves uncommitted is committed
+        result = None
+        try:
+            with conn:
                 result = task.fn(conn)
-            except Exception as e:
-                print(e)
-                result = e
+        except Exception as e:
+            print(e)
+            result = e
+        finally:
+            self.changes.bump()
             task.reply_queue.sync_q.put(result)
 
-    async def execute_against_connection_in_thread(self, fn):
-        def in_thread():
-            conn = getattr(connections, self.name, None)
-            if not conn:
-                conn = self.connect()
-                self.ds.prepare_connection(conn, self.name)
-                setattr(connections, self.name, conn)
-            return fn(conn)
+    @property
+    def changes(self):
+        if self._changes is None:
+            self._changes = ChangeMonitor(
+                self,
+                interval_ms=self.ds.config(
+                    "change_check_interval_ms", database=self.name
+                ),
+            )
+        return self._changes
 
+    async def current_generation(self):
+        """
+        A number that increases every time this database is seen to change.
+        The database files are checked for changes in a thread, so this
+        never blocks the event loop.
+        """
+        if not self.is_mutable:
+            return 0
+        changes = self.changes
+        if not changes.check_due():
+            return changes.check()
         return await asyncio.get_event_loop().run_in_executor(
-            self.ds.executor, in_thread
+            self.ds.executor, changes.check
+        )
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = ConnectionPool(
+                self,
+                size=self.ds.config("num_sql_connections", database=self.name)
+                or self.ds.config("num_sql_threads", database=self.name),
+                idle_timeout=self.ds.config(
+                    "sql_connection_idle_timeout", database=self.name
+                ),
+            )
+        return self._pool
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            admission = dict(
+                name=self.name,
+                max_in_flight=self.ds.config("max_sql_in_flight", database=self.name),
+                max_queued=self.ds.config("max_sql_queued", database=self.name),
+                queue_timeout_ms=self.ds.config(
+                    "sql_queue_timeout_ms", database=self.name
+                ),
+                shed_queue_depth=self.ds.config(
+                    "sql_shed_queue_depth", database=self.name
+                ),
+            )
+            num_threads = self.ds.database_config(self.name).get("num_sql_threads")
+            if num_threads:
+                # This database gets a thread pool all to itself
+                self._executor = QueryExecutor(
+                    futures.ThreadPoolExecutor(
+                        max_workers=num_threads,
+                        thread_name_prefix="datasette-{}".format(self.name),
+                    ),
+                    num_threads=num_threads,
+                    dedicated=True,
+                    **admission
+                )
+            else:
+                self._executor = QueryExecutor(
+                    self.ds.executor,
+                    num_threads=self.ds.config("num_sql_threads"),
+                    max_threads=self.ds.config(
+                        "max_shared_sql_threads", database=self.name
+                    ),
+                    **admission
+                )
+        return self._executor
+
+    async def prewarm(self):
+        "Opens and prepares all of the read connections for this database"
+        await asyncio.wrap_future(self.executor.submit(self.pool.prewarm))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+        if self._executor is not None:
+            self._executor.shutdown()
+        if self._changes is not None:
+            self._changes.close()
+        if self._checkpoints is not None:
+            self._checkpoints.stop()
+
+    async def execute_against_connection_in_thread(self, fn, priority="interactive"):
+        pool = self.pool
+        cancellation = current_cancellation()
+
+        def in_thread():
+            with pool.connection() as conn:
+                if cancellation is None:
+                    return fn(conn)
+                with cancellation.interrupts(conn):
+                    return fn(conn)
+
+        return await asyncio.wrap_future(
+            self.executor.submit(in_thread, priority=priority)
+        )
+
+    @property
+    def uses_processes(self):
+        "Should read queries run in the shared process pool?"
+        return bool(
+            not self.is_mutable
+            and not self.is_memory
+            and self.ds.config("num_sql_processes", database=self.name)
+            and self.ds.process_executor is not None
         )
 
+    async def _execute_in_process(
+        self,
+        sql,
+        params,
+        truncate,
+        custom_time_limit,
+        page_size,
+        log_sql_errors,
+        priority,
+    ):
+        time_limit_ms = self.ds.config("sql_time_limit_ms", database=self.name)
+        if custom_time_limit and custom_time_limit < time_limit_ms:
+            time_limit_ms = custom_time_limit
+        max_rows = None
+        if truncate and self.ds.max_returned_rows:
+            max_rows = self.ds.max_returned_rows
+            if max_rows == page_size:
+                max_rows += 1
+        process_executor = self.ds.process_executor
+
+        def in_thread():
+            # Waiting on the process from one of this database's threads
+            # applies the same admission control and priorities as
+            # queries run in threads
+            return process_executor.submit(
+                execute_in_process,
+                str(self.path),
+                self.name,
+                sql,
+                params,
+                time_limit_ms,
+                max_rows,
+            ).result()
+
+        try:
+            description, rows, truncated = await asyncio.wrap_future(
+                self.executor.submit(in_thread, priority=priority)
+            )
+        except (sqlite3.OperationalError, sqlite3.DatabaseError) as e:
+            if log_sql_errors:
+                print(
+                    "ERROR: process, db = {}, sql = {}, params = {}: {}".format(
+                        self.name, repr(sql), params, e
+                    )
+                )
+            raise
+        row_class = result_row_class(description)
+        return Results([row_class(row) for row in rows], truncated, description)
+
     async def execute(
         self,
         sql,
@@ -122,12 +495,18 @@ class Database:
         custom_time_limit=None,
         page_size=None,
         log_sql_errors=True,
+        priority="interactive",
     ):
         """Executes sql against db_name in a thread"""
         page_size = page_size or self.ds.page_size
+        cache_key = await self._query_cache_key(sql, params, truncate, page_size)
+        if cache_key is not None:
+            cached = self.ds.query_cache.get(cache_key)
+            if cached is not None:
+                return Results(list(cached.rows), cached.truncated, cached.description)
 
         def sql_operation_in_thread(conn):
-            time_limit_ms = self.ds.sql_time_limit_ms
+            time_limit_ms = self.ds.config("sql_time_limit_ms", database=self.name)
             if custom_time_limit and custom_time_limit < time_limit_ms:
                 time_limit_ms = custom_time_limit
 
@@ -163,11 +542,120 @@ class Database:
                 return Results(rows, False, cursor.description)
 
         with trace("sql", database=self.name, sql=sql.strip(), params=params):
-            results = await self.execute_against_connection_in_thread(
-                sql_operation_in_thread
+            if self.uses_processes:
+                results = await self._execute_in_process(
+                    sql,
+                    params,
+                    truncate,
+                    custom_time_limit,
+                    page_size,
+                    log_sql_errors,
+                    priority,
+                )
+            else:
+                results = await self.execute_against_connection_in_thread(
+                    sql_operation_in_thread, priority=priority
+                )
+        if cache_key is not None:
+            self.ds.query_cache.set(
+                cache_key,
+                Results(list(results.rows), results.truncated, results.description),
+                estimated_size(results.rows),
             )
         return results
 
+    async def cache_version(self):
+        "Identifies the current contents of this database, or None if unknown"
+        if self.is_memory:
+            return None
+        if self.is_mutable:
+            return await self.current_generation()
+        return self.hash
+
+    async def _query_cache_key(self, sql, params, truncate, page_size):
+        if not self.ds.query_cache.max_bytes:
+            return None
+        version = await self.cache_version()
+        if version is None:
+            return None
+        if not await self.ds.query_cache_enabled(self.name, sql):
+            return None
+        key = (
+            self.name,
+            version,
+            sql,
+            cache_key_params(params),
+            page_size,
+            bool(truncate),
+        )
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    async def execute_stream(
+        self, sql, params=None, batch_size=100, custom_time_limit=None
+    ):
+        """
+        Async generator yielding lists of up to batch_size rows
+
+        The query gets its own connection, outside of the connection pool,
+        which is closed once the generator is exhausted or closed - so slow
+        consumers can never starve execute() of pooled connections. The next
+        batch is only fetched once the previous one has been consumed, and
+        the time limit applies to each batch separately.
+        """
+        time_limit_ms = self.ds.config("sql_time_limit_ms", database=self.name)
+        if custom_time_limit and custom_time_limit < time_limit_ms:
+            time_limit_ms = custom_time_limit
+        conn = None
+        cursor = None
+        cancellation = current_cancellation()
+
+        def fetch_batch():
+            nonlocal conn, cursor
+            if conn is None:
+                conn = self.connect()
+                self.ds.prepare_connection(conn, self.name)
+            with contextlib.ExitStack() as stack:
+                if cancellation is not None:
+                    stack.enter_context(cancellation.interrupts(conn))
+                stack.enter_context(sqlite_timelimit(conn, time_limit_ms))
+                try:
+                    if cursor is None:
+                        cursor = conn.cursor()
+                        cursor.execute(sql, params or {})
+                    return cursor.fetchmany(batch_size)
+                except (sqlite3.OperationalError, sqlite3.DatabaseError) as e:
+                    if e.args == ("interrupted",):
+                        raise QueryInterrupted(e, sql, params)
+                    raise
+
+        def release(*args):
+            if cursor is not None:
+                cursor.close()
+            if conn is not None:
+                conn.close()
+
+        future = None
+        try:
+            with trace("sql", database=self.name, sql=sql.strip(), params=params):
+                future = self.executor.submit(fetch_batch)
+                rows = await asyncio.wrap_future(future)
+            while rows:
+                yield rows
+                if len(rows) < batch_size:
+                    break
+                future = self.executor.submit(fetch_batch)
+                rows = await asyncio.wrap_future(future)
+        finally:
+            if future is not None and not future.done():
+                # Cancelled while a batch was being fetched
+                future.add_done_callback(release)
+            else:
+                release()
+
     @property
     def size(self):
         if self.is_memory:
@@ -178,26 +666,123 @@ class Database:
             return Path(self.path).stat().st_size
 
     async def table_counts(self, limit=10):
-        if not self.is_mutable and self.cached_table_counts is not None:
+        generation = await self.current_generation()
+        if (
+            self.cached_table_counts is not None
+            and (not self.is_mutable or self._table_counts_generation == generation)
+            # Counts that timed out may finish given a longer time limit
+            and (self._table_counts_limit is None or limit <= self._table_counts_limit)
+        ):
             return self.cached_table_counts
-        # Try to get counts for each table, $limit timeout for each count
+        counts, estimated, rejected = await self._count_tables(limit)
+        if self.counts_pending or rejected:
+            # The background count from finish_startup() fills the cache, and
+            # counts turned away while the database was busy are not cached
+            return counts
+        self._cache_table_counts(counts, estimated, generation, limit)
+        return counts
+
+    def _cache_table_counts(self, counts, estimated, generation, limit):
+        self.cached_table_counts = counts
+        self.estimated_table_counts = estimated
+        self._table_counts_generation = generation
+        self._table_counts_limit = (
+            limit if any(count is None for count in counts.values()) else None
+        )
+
+    async def _count_tables(self, limit):
+        """
+        Counts the tables in parallel, no more at once than this database
+        has threads for. Returns (counts, names of tables whose count is an
+        estimate, names of tables whose count was rejected as too busy)
+        """
+        table_names = await self.table_names()
+        threshold = self.ds.config("fast_count_threshold", database=self.name)
+        has_stat1 = "sqlite_stat1" in table_names
+        # Queueing every table at once could trip max_sql_in_flight or
+        # max_sql_queued on a database with many tables
+        executor = self.executor
+        limits = [
+            executor.max_threads or executor.num_threads,
+            executor.max_in_flight,
+            executor.max_queued,
+        ]
+        semaphore = asyncio.Semaphore(min(limit for limit in limits if limit))
+        rejected = set()
+
+        async def count_table(table):
+            async with semaphore:
+                try:
+                    return await self._count_table(table, limit, threshold, has_stat1)
+                except QueryRejected:
+                    rejected.add(table)
+                    return None, True
+
+        results = await asyncio.gather(*[count_table(table) for table in table_names])
         counts = {}
-        for table in await self.table_names():
+        estimated = set()
+        for table, (count, exact) in zip(table_names, results):
+            counts[table] = count
+            if not exact:
+                estimated.add(table)
+        return counts, estimated, rejected
+
+    async def _count_table(self, table, limit, threshold, has_stat1):
+        if threshold:
+            estimate = await self._estimate_count(table, has_stat1)
+            if estimate is not None and estimate >= threshold:
+                return estimate, False
+        # $limit timeout for each count
+        try:
+            rows = await self.execute(
+                "select count(*) from [{}]".format(table),
+                custom_time_limit=limit,
+                priority="count",
+            )
+            return rows.rows[0][0], True
+        # In some cases I saw "SQL Logic Error" here in addition to
+        # QueryInterrupted - so we catch that too:
+        except (QueryInterrupted, sqlite3.OperationalError, sqlite3.DatabaseError):
+            return None, True
+
+    async def _estimate_count(self, table, has_stat1):
+        # sqlite_stat1 records the row count as the first number of each stat,
+        # otherwise max(rowid) matches the count for tables with no deletes
+        queries = [("select max(rowid) from [{}]".format(table), None)]
+        if has_stat1:
+            queries.insert(
+                0, ("select stat from sqlite_stat1 where tbl = ? limit 1", [table])
+            )
+        for sql, params in queries:
             try:
-                table_count = (
+                rows = (
                     await self.execute(
-                        "select count(*) from [{}]".format(table),
-                        custom_time_limit=limit,
+                        sql, params, log_sql_errors=False, priority="count"
                     )
-                ).rows[0][0]
-                counts[table] = table_count
-            # In some cases I saw "SQL Logic Error" here in addition to
-            # QueryInterrupted - so we catch that too:
+                ).rows
             except (QueryInterrupted, sqlite3.OperationalError, sqlite3.DatabaseError):
-                counts[table] = None
-        if not self.is_mutable:
-            self.cached_table_counts = counts
-        return counts
+                # WITHOUT ROWID tables have no rowid
+                continue
+            if rows and rows[0][0] is not None:
+                return int(str(rows[0][0]).split()[0])
+        return None
+
+    async def finish_startup(self):
+        """
+        Background half of a lazy startup: hashes an immutable database file
+        and then counts its tables, if either is still outstanding.
+        """
+        if self.hash_pending:
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, self.compute_hash)
+        if self.counts_pending:
+            try:
+                limit = 60 * 60 * 1000
+                counts, estimated, rejected = await self._count_tables(limit)
+                if not rejected:
+                    self._cache_table_counts(counts, estimated, 0, limit)
+            finally:
+                self.counts_pending = False
 
     @property
     def mtime_ns(self):
@@ -210,32 +795,42 @@ class Database:
         else:
             return Path(self.path).stem
 
-    async def table_exists(self, table):
-        results = await self.execute(
-            "select 1 from sqlite_master where type='table' and name=?", params=(table,)
+    async def schema(self):
+        "Returns the SchemaCatalog for this database, reloading it if it changed"
+        generation = await self.current_generation()
+        if self._schema is not None and (
+            not self.is_mutable or self._schema_generation == generation
+        ):
+            return self._schema
+        schema = await self.execute_against_connection_in_thread(
+            self._schema_for_connection
         )
-        return bool(results.rows)
+        self._schema_generation = generation
+        return schema
+
+    def _schema_for_connection(self, conn):
+        # Runs in a thread - PRAGMA schema_version is incremented by SQLite
+        # every time the schema is modified, so it is a cheap staleness check
+        schema_version = conn.execute("PRAGMA schema_version").fetchone()[0]
+        with self._schema_lock:
+            if self._schema is None or self._schema.schema_version != schema_version:
+                self._schema = SchemaCatalog.load(conn, schema_version)
+            return self._schema
+
+    async def table_exists(self, table):
+        return (await self.schema()).table_exists(table)
 
     async def table_names(self):
-        results = await self.execute(
-            "select name from sqlite_master where type='table'"
-        )
-        return [r[0] for r in results.rows]
+        return (await self.schema()).table_names()
 
     async def table_columns(self, table):
-        return await self.execute_against_connection_in_thread(
-            lambda conn: table_columns(conn, table)
-        )
+        return (await self.schema()).table_columns(table)
 
     async def primary_keys(self, table):
-        return await self.execute_against_connection_in_thread(
-            lambda conn: detect_primary_keys(conn, table)
-        )
+        return (await self.schema()).primary_keys(table)
 
     async def fts_table(self, table):
-        return await self.execute_against_connection_in_thread(
-            lambda conn: detect_fts(conn, table)
-        )
+        return (await self.schema()).fts_table(table)
 
     async def label_column_for_table(self, table):
         explicit_label_column = self.ds.table_metadata(self.name, table).get(
@@ -244,9 +839,7 @@ class Database:
         if explicit_label_column:
             return explicit_label_column
         # If a table has two columns, one of which is ID, then label_column is the other one
-        column_names = await self.execute_against_connection_in_thread(
-            lambda conn: table_columns(conn, table)
-        )
+        column_names = await self.table_columns(table)
         # Is there a name or title column?
         name_or_title = [c for c in column_names if c in ("name", "title")]
         if name_or_title:
@@ -261,28 +854,13 @@ class Database:
         return None
 
     async def foreign_keys_for_table(self, table):
-        return await self.execute_against_connection_in_thread(
-            lambda conn: get_outbound_foreign_keys(conn, table)
-        )
+        return (await self.schema()).outbound_foreign_keys(table)
 
     async def hidden_table_names(self):
+        schema = await self.schema()
         # Mark tables 'hidden' if they relate to FTS virtual tables
-        hidden_tables = [
-            r[0]
-            for r in (
-                await self.execute(
-                    """
-                select name from sqlite_master
-                where rootpage = 0
-                and sql like '%VIRTUAL TABLE%USING FTS%'
-            """
-                )
-            ).rows
-        ]
-        has_spatialite = await self.execute_against_connection_in_thread(
-            detect_spatialite
-        )
-        if has_spatialite:
+        hidden_tables = list(schema.fts_virtual_tables)
+        if schema.has_spatialite:
             # Also hide Spatialite internal tables
             hidden_tables += [
                 "ElementaryGeometries",
@@ -294,18 +872,7 @@ class Database:
                 "sqlite_sequence",
                 "views_geometry_columns",
                 "virts_geometry_columns",
-            ] + [
-                r[0]
-                for r in (
-                    await self.execute(
-                        """
-                        select name from sqlite_master
-                        where name like "idx_%"
-                        and type = "table"
-                    """
-                    )
-                ).rows
-            ]
+            ] + list(schema.spatialite_index_tables)
         # Add any from metadata.json
         db_metadata = self.ds.metadata(database=self.name)
         if "tables" in db_metadata:
@@ -316,7 +883,7 @@ class Database:
             ]
         # Also mark as hidden any tables which start with the name of a hidden table
         # e.g. "searchable_fts" implies "searchable_fts_content" should be hidden
-        for table_name in await self.table_names():
+        for table_name in schema.table_names():
             for hidden_table in hidden_tables[:]:
                 if table_name.startswith(hidden_table):
                     hidden_tables.append(table_name)
@@ -325,37 +892,16 @@ class Database:
         return hidden_tables
 
     async def view_names(self):
-        results = await self.execute("select name from sqlite_master where type='view'")
-        return [r[0] for r in results.rows]
+        return (await self.schema()).view_names()
 
     async def get_all_foreign_keys(self):
-        return await self.execute_against_connection_in_thread(get_all_foreign_keys)
+        return (await self.schema()).all_foreign_keys()
 
     async def get_outbound_foreign_keys(self, table):
-        return await self.execute_against_connection_in_thread(
-            lambda conn: get_outbound_foreign_keys(conn, table)
-        )
+        return (await self.schema()).outbound_foreign_keys(table)
 
     async def get_table_definition(self, table, type_="table"):
-        table_definition_rows = list(
-            await self.execute(
-                "select sql from sqlite_master where name = :n and type=:t",
-                {"n": table, "t": type_},
-            )
-        )
-        if not table_definition_rows:
-            return None
-        bits = [table_definition_rows[0][0] + ";"]
-        # Add on any indexes
-        index_rows = list(
-            await self.execute(
-                "select sql from sqlite_master where tbl_name = :n and type='index' and sql is not null",
-                {"n": table},
-            )
-        )
-        for index_row in index_rows:
-            bits.append(index_row[0] + ";")
-        return "\n".join(bits)
+        return (await self.schema()).definition(table, type_)
 
     async def get_view_definition(self, view):
         return await self.get_table_definition(view, "view")
@@ -383,3 +929,765 @@ class WriteTask:
         self.fn = fn
         self.task_id = task_id
         self.reply_queue = reply_queue
+
+
+class ChangeMonitor:
+    """
+    Detects changes to a mutable database, including those made by other
+    processes, and counts them in a ``generation`` number that caches can
+    use as part of their keys.
+
+    The database is checked using ``PRAGMA data_version`` and the mtime and
+    size of the database file and its WAL file, at most once every
+    interval_ms. Writes made through Datasette increment the generation
+    immediately.
+    """
+
+    def __init__(self, database, interval_ms=0):
+        self.database = database
+        self.interval_ms = interval_ms or 0
+        self._generation = 0
+        self._state = None
+        self._last_check = None
+        self._conn = None
+        self._lock = threading.Lock()
+
+    @property
+    def generation(self):
+        return self.check()
+
+    def check_due(self):
+        "Will the next check() look at the database files?"
+        with self._lock:
+            return self._check_due(time.monotonic())
+
+    def _check_due(self, now):
+        return (
+            self._last_check is None
+            or (now - self._last_check) * 1000 >= self.interval_ms
+        )
+
+    def check(self, force=False):
+        "Returns the current generation, checking for changes if it is time"
+        now = time.monotonic()
+        with self._lock:
+            if not force and not self._check_due(now):
+                return self._generation
+            self._last_check = now
+            state = self._current_state()
+            if self._state is not None and state != self._state:
+                self._generation += 1
+            self._state = state
+            return self._generation
+
+    def bump(self):
+        with self._lock:
+            self._generation += 1
+
+    def _current_state(self):
+        if self.database.is_memory:
+            return None
+        if self._conn is None:
+            self._conn = self.database.connect()
+        data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        path = str(self.database.path)
+        return (data_version, self._stat(path), self._stat(path + "-wal"))
+
+    @staticmethod
+    def _stat(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class DirectoryWatcher:
+    """
+    Serves the .db files in a set of directories as immutable databases,
+    checking every interval_ms for files that have been added, replaced or
+    removed.
+
+    A file is only attached once it has looked the same for two checks in a
+    row, so one that is still being copied into place is left alone. A new
+    or replaced file is opened, hashed and counted in full before it is
+    swapped in. The Database it replaces is then closed, which lets queries
+    that are already running against it finish first.
+    """
+
+    def __init__(self, datasette, directories, interval_ms=1000):
+        self.ds = datasette
+        self.directories = [Path(directory) for directory in directories]
+        self.interval_ms = interval_ms or 1000
+        # name -> (path, identity) for the databases this watcher has attached
+        self.attached = {}
+        self.num_attached = 0
+        self.num_replaced = 0
+        self.num_detached = 0
+        self._previous = {}
+        self._failed = {}
+
+    def scan(self):
+        "Returns {name: (path, identity)} for the database files in the directories"
+        found = {}
+        for directory in self.directories:
+            for path in sorted(directory.glob("*.db")):
+                try:
+                    stat = path.stat()
+                except OSError:
+                    # Deleted since the glob() call
+                    continue
+                identity = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+                # The first directory wins if two contain the same file name
+                found.setdefault(path.stem, (str(path), identity))
+        return found
+
+    def attach_existing(self):
+        "Attaches the files that are already there, before the server starts"
+        found = self.scan()
+        for name, (path, identity) in found.items():
+            if name in self.ds.databases:
+                continue
+            self.ds.add_database(name, Database(self.ds, path, is_mutable=False))
+            self.attached[name] = (path, identity)
+        self._previous = found
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval_ms / 1000)
+            try:
+                await self.check()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Keep watching - the next check may well succeed
+                print("Error checking {}: {}".format(self.directories, e))
+
+    async def check(self):
+        found = self.scan()
+        previous, self._previous = self._previous, found
+        for name, (path, identity) in found.items():
+            if self.attached.get(name) == (path, identity):
+                continue
+            if name not in self.attached and name in self.ds.databases:
+                # Served from the command-line, not from the watched directory
+                continue
+            if previous.get(name) != (path, identity):
+                # Changed since the last check - wait until it settles
+                continue
+            if self._failed.get(name) == (path, identity):
+                continue
+            try:
+                db = await self._open(path)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print("Could not attach {}: {}".format(path, e))
+                if not isinstance(e, QueryRejected):
+                    # Not retried until the file changes - unlike being
+                    # turned away while busy, which is retried next time
+                    self._failed[name] = (path, identity)
+                continue
+            old = self.ds.databases.get(name) if name in self.attached else None
+            self.ds.add_database(name, db)
+            self.attached[name] = (path, identity)
+            if old is not None:
+                old.close()
+                self.num_replaced += 1
+            else:
+                self.num_attached += 1
+        for name in list(self.attached):
+            if name not in found:
+                del self.attached[name]
+                if name in self.ds.databases:
+                    self.ds.remove_database(name)
+                self.num_detached += 1
+
+    async def _open(self, path):
+        loop = asyncio.get_event_loop()
+        # Creating an immutable Database hashes the file, so use a thread
+        db = await loop.run_in_executor(
+            None, lambda: Database(self.ds, path, is_mutable=False)
+        )
+        try:
+            if db.hash_pending:
+                await loop.run_in_executor(None, db.compute_hash)
+            # Fails with sqlite3.DatabaseError if this is not a SQLite database
+            await db.table_names()
+            await db.table_counts(limit=60 * 60 * 1000)
+            await db.prewarm()
+        except BaseException:
+            db.close()
+            raise
+        return db
+
+    def stats(self):
+        return {
+            "directories": [str(directory) for directory in self.directories],
+            "databases": sorted(self.attached),
+            "attached": self.num_attached,
+            "replaced": self.num_replaced,
+            "detached": self.num_detached,
+        }
+
+
+class CheckpointScheduler:
+    """
+    Background thread that checkpoints a WAL mode database, so that the
+    write thread never has to pause to do so after a commit.
+
+    Every interval_ms it runs a PASSIVE checkpoint - which does not block
+    readers or the writer - if the WAL file holds at least ``pages`` frames
+    that have not been checkpointed yet.
+
+    The WAL file is never shrunk by a PASSIVE checkpoint, so its size says
+    nothing about how much of it is waiting to be checkpointed. Instead the
+    frames in its current generation are counted from their headers, and
+    the number of those already checkpointed is taken from the result of
+    the last checkpoint.
+    """
+
+    def __init__(self, database, pages=1000, interval_ms=1000):
+        self.database = database
+        self.pages = pages or 1
+        self.interval_ms = interval_ms or 1000
+        self.num_checkpoints = 0
+        self.num_pages_checkpointed = 0
+        self.last_checkpoint_ms = None
+        # (salts, frames) for the WAL generation as of the last checkpoint
+        self._checkpointed = (None, 0)
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run,
+            name="datasette-checkpoint-{}".format(self.database.name),
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        path = str(self.database.path)
+        conn = sqlite3.connect(path, check_same_thread=False)
+        try:
+            while not self._stopped.wait(self.interval_ms / 1000):
+                try:
+                    salts, frames = wal_frames(path + "-wal")
+                except OSError:
+                    continue
+                if salts is None or self.pending_frames(salts, frames) < self.pages:
+                    continue
+                _, _, checkpointed = self.checkpoint(conn)
+                self._checkpointed = (salts, max(checkpointed, 0))
+        finally:
+            conn.close()
+
+    def pending_frames(self, salts, frames):
+        "How many of the frames in the WAL have not been checkpointed yet"
+        checkpointed_salts, checkpointed = self._checkpointed
+        if salts != checkpointed_salts:
+            # The WAL has been restarted since the last checkpoint
+            return frames
+        return max(frames - checkpointed, 0)
+
+    def checkpoint(self, conn):
+        "Runs a PASSIVE checkpoint, returning (busy, log, checkpointed)"
+        start = time.monotonic()
+        busy, log, checkpointed = conn.execute(
+            "PRAGMA wal_checkpoint(PASSIVE)"
+        ).fetchone()
+        self.num_checkpoints += 1
+        self.num_pages_checkpointed += max(checkpointed, 0)
+        self.last_checkpoint_ms = round((time.monotonic() - start) * 1000, 3)
+        return busy, log, checkpointed
+
+    def stats(self):
+        return {
+            "checkpoints": self.num_checkpoints,
+            "pages_checkpointed": self.num_pages_checkpointed,
+            "last_checkpoint_ms": self.last_checkpoint_ms,
+        }
+
+
+def wal_frames(path):
+    """
+    Returns (salts, frames) for the WAL file at path, where frames is the
+    number of frames written since the WAL was last restarted.
+
+    When SQLite restarts a WAL it writes new salts into the header and then
+    overwrites frames from the start of the file, so the current frames are
+    the leading ones whose headers carry the same salts. salts is None if
+    the file has no valid header yet.
+    """
+    with open(path, "rb") as fp:
+        header = fp.read(32)
+        if len(header) < 32:
+            return None, 0
+        page_size = int.from_bytes(header[8:12], "big")
+        if page_size == 1:
+            page_size = 65536
+        salts = header[16:24]
+        frame_size = page_size + 24
+        low, high = 0, (os.fstat(fp.fileno()).st_size - 32) // frame_size
+        while low < high:
+            middle = (low + high + 1) // 2
+            # Salts are bytes 8 to 16 of each 24 byte frame header
+            fp.seek(32 + (middle - 1) * frame_size + 8)
+            if fp.read(8) == salts:
+                low = middle
+            else:
+                high = middle - 1
+    return salts, low
+
+
+class SavepointConnection:
+    """
+    Stands in for the write connection while a task runs as part of a
+    batch of writes. The task's own commit() and rollback() calls, and
+    ``with conn:`` blocks, apply to its savepoint instead of the
+    transaction shared by the whole batch.
+    """
+
+    def __init__(self, conn, savepoint):
+        self._conn = conn
+        self._savepoint = savepoint
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+    def commit(self):
+        self._conn.execute("release {}".format(self._savepoint))
+        self._conn.execute("savepoint {}".format(self._savepoint))
+
+    def rollback(self):
+        self._conn.execute("rollback to {}".format(self._savepoint))
+
+
+TEMP_STORE_VALUES = ("default", "file", "memory")
+
+
+def tune_connection(conn, datasette, database):
+    "Applies the SQLite tuning options configured for database to conn"
+
+    def config(key):
+        return datasette.config(key, database=database)
+
+    if config("mmap_size_mb"):
+        conn.execute(
+            "PRAGMA mmap_size={}".format(int(config("mmap_size_mb") * 1024 * 1024))
+        )
+    if config("cache_size_kb"):
+        conn.execute("PRAGMA cache_size=-{}".format(int(config("cache_size_kb"))))
+    temp_store = (config("temp_store") or "default").lower()
+    if temp_store != "default" and temp_store in TEMP_STORE_VALUES:
+        conn.execute("PRAGMA temp_store={}".format(temp_store))
+    if config("sqlite_threads"):
+        conn.execute("PRAGMA threads={}".format(int(config("sqlite_threads"))))
+
+
+def effective_tuning(conn, cached_statements=None):
+    def pragma(name):
+        # Some PRAGMAs return nothing if SQLite was compiled without support
+        row = conn.execute("PRAGMA {}".format(name)).fetchone()
+        return row[0] if row else None
+
+    return {
+        "mmap_size": pragma("mmap_size"),
+        "cache_size": pragma("cache_size"),
+        "temp_store": TEMP_STORE_VALUES[pragma("temp_store") or 0],
+        "threads": pragma("threads"),
+        "cached_statements": cached_statements or None,
+    }
+
+
+class ConnectionPool:
+    """
+    A bounded pool of prepared read connections to a single database.
+
+    Connections are checked out by whichever executor thread is running a
+    query and returned afterwards, so the number of open file handles is
+    capped at ``size`` no matter how many threads there are.
+    """
+
+    def __init__(self, database, size, idle_timeout=0):
+        self.database = database
+        self.size = max(size, 1)
+        # Seconds a connection can sit unused before it is closed, 0 = never
+        self.idle_timeout = idle_timeout
+        self._idle = []  # (conn, last_used) pairs, most recently used last
+        self._num_open = 0
+        self._num_in_use = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self.num_created = 0
+        self.num_evicted = 0
+        self.num_checkouts = 0
+        self.num_waits = 0
+        self.total_wait_ms = 0.0
+        self.max_wait_ms = 0.0
+        self._stopped = threading.Event()
+        if self.idle_timeout:
+            # Idle connections are closed even if nothing is checked out
+            threading.Thread(
+                target=self._evict_idle_periodically,
+                name="datasette-pool-{}".format(database.name),
+                daemon=True,
+            ).start()
+
+    def _create(self):
+        conn = self.database.connect()
+        self.database.ds.prepare_connection(conn, self.database.name)
+        return conn
+
+    def _evict_idle(self):
+        # Must be called while holding self._condition
+        if not self.idle_timeout or not self._idle:
+            return
+        cutoff = time.monotonic() - self.idle_timeout
+        keep = []
+        for conn, last_used in self._idle:
+            if last_used < cutoff:
+                conn.close()
+                self._num_open -= 1
+                self.num_evicted += 1
+            else:
+                keep.append((conn, last_used))
+        self._idle = keep
+
+    def _evict_idle_periodically(self):
+        while not self._stopped.wait(self.idle_timeout / 2):
+            with self._condition:
+                self._evict_idle()
+
+    def checkout(self):
+        start = time.monotonic()
+        waited = False
+        conn = None
+        with self._condition:
+            self._evict_idle()
+            while True:
+                if self._idle:
+                    conn, _ = self._idle.pop()
+                    break
+                if self._num_open < self.size or self._closed:
+                    # Reserve a slot, then open the connection outside the lock
+                    self._num_open += 1
+                    break
+                waited = True
+                self._condition.wait()
+            self._num_in_use += 1
+        created = conn is None
+        if created:
+            try:
+                conn = self._create()
+            except Exception:
+                with self._condition:
+                    self._num_open -= 1
+                    self._num_in_use -= 1
+                    self._condition.notify()
+                raise
+        wait_ms = (time.monotonic() - start) * 1000
+        with self._condition:
+            if created:
+                self.num_created += 1
+            self.num_checkouts += 1
+            if waited:
+                self.num_waits += 1
+            self.total_wait_ms += wait_ms
+            self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+        return conn
+
+    def checkin(self, conn):
+        with self._condition:
+            self._num_in_use -= 1
+            if self._closed:
+                conn.close()
+                self._num_open -= 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._condition.notify()
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self.checkout()
+        try:
+            yield conn
+        finally:
+            self.checkin(conn)
+
+    def prewarm(self):
+        with self._condition:
+            to_create = self.size - self._num_open
+            self._num_open += to_create
+        for _ in range(to_create):
+            try:
+                conn = self._create()
+            except Exception:
+                with self._condition:
+                    self._num_open -= 1
+                    self._condition.notify()
+                raise
+            with self._condition:
+                self.num_created += 1
+                self._idle.insert(0, (conn, time.monotonic()))
+                self._condition.notify()
+
+    def close(self):
+        "Closes idle connections - in-use connections are closed on checkin"
+        self._stopped.set()
+        with self._condition:
+            self._closed = True
+            for conn, _ in self._idle:
+                conn.close()
+                self._num_open -= 1
+            self._idle = []
+            self._condition.notify_all()
+
+    def stats(self):
+        with self._condition:
+            return {
+                "size": self.size,
+                "open": self._num_open,
+                "in_use": self._num_in_use,
+                "idle": len(self._idle),
+                "created": self.num_created,
+                "evicted": self.num_evicted,
+                "checkouts": self.num_checkouts,
+                "checkout_waits": self.num_waits,
+                "checkout_wait_ms_total": round(self.total_wait_ms, 3),
+                "checkout_wait_ms_max": round(self.max_wait_ms, 3),
+            }
+
+
+class SchemaCatalog:
+    """
+    Everything Datasette needs to know about the schema of a database,
+    loaded from a single connection in one pass and then reused by every
+    view until PRAGMA schema_version says it is stale.
+
+    ``datasette inspect`` saves it using to_dict(), and from_dict() loads
+    it back when the server starts with --inspect-file.
+    """
+
+    # Increment this if the format returned by to_dict() changes
+    snapshot_version = 1
+
+    def __init__(
+        self,
+        schema_version,
+        master_rows,
+        columns,
+        primary_keys,
+        fts_tables,
+        outbound_foreign_keys,
+        all_foreign_keys,
+        fts_virtual_tables,
+        has_spatialite,
+        spatialite_index_tables,
+    ):
+        self.schema_version = schema_version
+        # List of (type, name, tbl_name, sql) in sqlite_master order
+        self.master_rows = master_rows
+        self.columns = columns
+        self.primary_keys_by_table = primary_keys
+        self.fts_tables = fts_tables
+        self.outbound_foreign_keys_by_table = outbound_foreign_keys
+        self.all_foreign_keys_by_table = all_foreign_keys
+        self.fts_virtual_tables = fts_virtual_tables
+        self.has_spatialite = has_spatialite
+        self.spatialite_index_tables = spatialite_index_tables
+        self._tables = [r[1] for r in master_rows if r[0] == "table"]
+        self._views = [r[1] for r in master_rows if r[0] == "view"]
+        self._table_set = set(self._tables)
+        # PRAGMA table_info() and friends match names case-insensitively
+        self._lower_names = {}
+        for name in self._tables + self._views:
+            self._lower_names.setdefault(name.lower(), name)
+
+    @classmethod
+    def load(cls, conn, schema_version=None):
+        if schema_version is None:
+            schema_version = conn.execute("PRAGMA schema_version").fetchone()[0]
+        master_rows = [
+            tuple(r)
+            for r in conn.execute(
+                "select type, name, tbl_name, sql from sqlite_master"
+            ).fetchall()
+        ]
+        columns = {}
+        primary_keys = {}
+        fts_tables = {}
+        outbound_foreign_keys = {}
+        for type_, name, _, _ in master_rows:
+            if type_ not in ("table", "view"):
+                continue
+            columns[name] = table_columns(conn, name)
+            primary_keys[name] = detect_primary_keys(conn, name)
+            fts_tables[name] = detect_fts(conn, name)
+            if type_ == "table":
+                outbound_foreign_keys[name] = get_outbound_foreign_keys(conn, name)
+        fts_virtual_tables = [
+            r[0]
+            for r in conn.execute(
+                """
+                select name from sqlite_master
+                where rootpage = 0
+                and sql like '%VIRTUAL TABLE%USING FTS%'
+            """
+            ).fetchall()
+        ]
+        has_spatialite = detect_spatialite(conn)
+        spatialite_index_tables = []
+        if has_spatialite:
+            spatialite_index_tables = [
+                r[0]
+                for r in conn.execute(
+                    """
+                    select name from sqlite_master
+                    where name like "idx_%"
+                    and type = "table"
+                """
+                ).fetchall()
+            ]
+        return cls(
+            schema_version=schema_version,
+            master_rows=master_rows,
+            columns=columns,
+            primary_keys=primary_keys,
+            fts_tables=fts_tables,
+            outbound_foreign_keys=outbound_foreign_keys,
+            all_foreign_keys=get_all_foreign_keys(conn),
+            fts_virtual_tables=fts_virtual_tables,
+            has_spatialite=has_spatialite,
+            spatialite_index_tables=spatialite_index_tables,
+        )
+
+    def to_dict(self):
+        return {
+            "version": self.snapshot_version,
+            "schema_version": self.schema_version,
+            "master_rows": [list(r) for r in self.master_rows],
+            "columns": self.columns,
+            "primary_keys": self.primary_keys_by_table,
+            "fts_tables": self.fts_tables,
+            "outbound_foreign_keys": self.outbound_foreign_keys_by_table,
+            "all_foreign_keys": self.all_foreign_keys_by_table,
+            "fts_virtual_tables": self.fts_virtual_tables,
+            "has_spatialite": self.has_spatialite,
+            "spatialite_index_tables": self.spatialite_index_tables,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        "Returns None for snapshots written by a different version of Datasette"
+        if data.get("version") != cls.snapshot_version:
+            return None
+        return cls(
+            schema_version=data["schema_version"],
+            master_rows=[tuple(r) for r in data["master_rows"]],
+            columns=data["columns"],
+            primary_keys=data["primary_keys"],
+            fts_tables=data["fts_tables"],
+            outbound_foreign_keys=data["outbound_foreign_keys"],
+            all_foreign_keys=data["all_foreign_keys"],
+            fts_virtual_tables=data["fts_virtual_tables"],
+            has_spatialite=data["has_spatialite"],
+            spatialite_index_tables=data["spatialite_index_tables"],
+        )
+
+    def _resolve(self, name):
+        if name in self.columns:
+            return name
+        return self._lower_names.get(name.lower(), name)
+
+    def table_exists(self, table):
+        return table in self._table_set
+
+    def table_names(self):
+        return list(self._tables)
+
+    def view_names(self):
+        return list(self._views)
+
+    def with_dependent_views(self, names):
+        """
+        Returns the lower case names in names plus those of every view that
+        reads from one of them, directly or through other views
+        """
+        names = {name.lower() for name in names}
+        views = [
+            (name.lower(), sql_identifiers(sql or ""))
+            for type_, name, _, sql in self.master_rows
+            if type_ == "view"
+        ]
+        changed = True
+        while changed:
+            changed = False
+            for view, used in views:
+                if view not in names and used & names:
+                    names.add(view)
+                    changed = True
+        return names
+
+    def table_columns(self, table):
+        return list(self.columns.get(self._resolve(table)) or [])
+
+    def primary_keys(self, table):
+        return list(self.primary_keys_by_table.get(self._resolve(table)) or [])
+
+    def fts_table(self, table):
+        return self.fts_tables.get(self._resolve(table))
+
+    def outbound_foreign_keys(self, table):
+        return [
+            dict(fk)
+            for fk in self.outbound_foreign_keys_by_table.get(self._resolve(table))
+            or []
+        ]
+
+    def all_foreign_keys(self):
+        return {
+            table: {
+                "incoming": [dict(fk) for fk in fks["incoming"]],
+                "outgoing": [dict(fk) for fk in fks["outgoing"]],
+            }
+            for table, fks in self.all_foreign_keys_by_table.items()
+        }
+
+    def indexes(self, table):
+        return [
+            {"name": name, "sql": sql}
+            for t, name, tbl_name, sql in self.master_rows
+            if t == "index" and tbl_name == table
+        ]
+
+    def definition(self, name, type_="table"):
+        matches = [sql for t, n, _, sql in self.master_rows if n == name and t == type_]
+        if not matches:
+            return None
+        bits = [matches[0] + ";"]
+        # Add on any indexes
+        for t, _, tbl_name, sql in self.master_rows:
+            if t == "index" and tbl_name == name and sql is not None:
+                bits.append(sql + ";")
+        return "\n".join(bits)
@@ -0,0 +1,248 @@
+from concurrent import futures
+import heapq
+import itertools
+import math
+import os
+import threading
+import time
+
+from .utils import QueryInterrupted, QueryRejected, sqlite3, sqlite_timelimit
+
+
+# Query priority classes, most urgent first
+PRIORITIES = {"interactive": 0, "count": 1, "facet": 2, "suggest": 3}
+
+
+class QueryExecutor:
+    """
+    Dispatches a single database's queries onto a thread pool.
+
+    The thread pool can be dedicated to this database or shared with
+    others, in which case ``max_threads`` caps how many of its threads
+    this database is allowed to occupy at once. Queries that cannot start
+    yet wait in a queue here rather than in the thread pool, so they cannot
+    hold up queries against other databases, and are started in order of
+    priority - see PRIORITIES.
+    """
+
+    def __init__(
+        self,
+        executor,
+        num_threads,
+        max_threads=0,
+        dedicated=False,
+        name=None,
+        max_in_flight=0,
+        max_queued=0,
+        queue_timeout_ms=0,
+        shed_queue_depth=0,
+    ):
+        self.executor = executor
+        self.num_threads = num_threads
+        self.max_threads = max_threads or 0
+        self.dedicated = dedicated
+        self.name = name
+        # Admission control - 0 means no limit
+        self.max_in_flight = max_in_flight or 0
+        self.max_queued = max_queued or 0
+        self.queue_timeout_ms = queue_timeout_ms or 0
+        # Suggest queries are dropped while this many queries are waiting
+        self.shed_queue_depth = shed_queue_depth or 0
+        self.num_rejected_in_flight = 0
+        self.num_rejected_queued = 0
+        self.num_rejected_wait = 0
+        self.num_rejected_low_priority = 0
+        self._lock = threading.Lock()
+        self._pending = []  # Heap of (priority, sequence, item)
+        self._sequence = itertools.count()
+        # Submitted to the thread pool (or about to be), not yet finished:
+        self._dispatched = 0
+        self._queued = 0
+        self._running = 0
+        self.num_completed = 0
+        self.total_wait_ms = 0.0
+        self.max_wait_ms = 0.0
+
+    def submit(self, fn, priority="interactive"):
+        """
+        Returns a concurrent.futures.Future for the result of calling fn()
+
+        Raises QueryRejected if this database already has too many queries
+        in flight or queued.
+        """
+        level = PRIORITIES[priority]
+        future = futures.Future()
+        item = (fn, future, time.monotonic())
+        with self._lock:
+            if (
+                self.max_in_flight
+                and self._queued + self._running >= self.max_in_flight
+            ):
+                self.num_rejected_in_flight += 1
+                raise self._rejected("too many queries in progress")
+            if self.max_queued and self._queued >= self.max_queued:
+                self.num_rejected_queued += 1
+                raise self._rejected("too many queries waiting")
+            if (
+                self.shed_queue_depth
+                and level >= PRIORITIES["suggest"]
+                and self._queued >= self.shed_queue_depth
+            ):
+                self.num_rejected_low_priority += 1
+                raise self._rejected("skipping low priority query")
+            self._queued += 1
+            if self._dispatched >= (self.max_threads or self.num_threads):
+                heapq.heappush(self._pending, (level, next(self._sequence), item))
+                return future
+            self._dispatched += 1
+        self._dispatch(item)
+        return future
+
+    def _dispatch(self, item):
+        fn, future, submitted = item
+        inner = self.executor.submit(self._run, fn, future, submitted)
+        inner.add_done_callback(self._on_done)
+
+    def _run(self, fn, future, submitted):
+        wait_ms = (time.monotonic() - submitted) * 1000
+        with self._lock:
+            self._queued -= 1
+            self.total_wait_ms += wait_ms
+            self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+            if not future.set_running_or_notify_cancel():
+                return
+            if self.queue_timeout_ms and wait_ms > self.queue_timeout_ms:
+                self.num_rejected_wait += 1
+                future.set_exception(self._rejected("waited too long to run"))
+                return
+            self._running += 1
+        result = error = None
+        try:
+            result = fn()
+        except BaseException as e:
+            error = e
+        with self._lock:
+            self._running -= 1
+            self.num_completed += 1
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def _on_done(self, inner):
+        with self._lock:
+            self._dispatched -= 1
+            next_item = None
+            while self._pending:
+                candidate = heapq.heappop(self._pending)[2]
+                if candidate[1].cancelled():
+                    self._queued -= 1
+                    continue
+                next_item = candidate
+                self._dispatched += 1
+                break
+        if next_item is not None:
+            self._dispatch(next_item)
+
+    def _rejected(self, reason):
+        return QueryRejected(
+            "Database {} is too busy: {}".format(self.name, reason),
+            retry_after=max(1, math.ceil(self.queue_timeout_ms / 1000)),
+        )
+
+    def shutdown(self):
+        if self.dedicated:
+            self.executor.shutdown(wait=False)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "executor": "dedicated" if self.dedicated else "shared",
+                "threads": self.num_threads,
+                "max_threads": self.max_threads or self.num_threads,
+                "queued": self._queued,
+                "running": self._running,
+                "completed": self.num_completed,
+                "wait_ms_total": round(self.total_wait_ms, 3),
+                "wait_ms_max": round(self.max_wait_ms, 3),
+                "rejected_in_flight": self.num_rejected_in_flight,
+                "rejected_queued": self.num_rejected_queued,
+                "rejected_wait": self.num_rejected_wait,
+                "rejected_low_priority": self.num_rejected_low_priority,
+            }
+
+
+# State for worker processes in the process pool used by num_sql_processes
+_worker_datasette = None
+_worker_connections = {}
+
+
+def init_process_worker(metadata, config, sqlite_extensions, plugins_dir):
+    "Initializer for query worker processes"
+    global _worker_datasette
+    from .app import Datasette
+
+    _worker_datasette = Datasette(
+        [],
+        metadata=metadata,
+        config=config,
+        sqlite_extensions=sqlite_extensions,
+        plugins_dir=plugins_dir,
+    )
+
+
+def _worker_connection(path, name):
+    # Immutable connections cache pages forever, so a file replaced at the
+    # same path needs a fresh connection
+    stat = os.stat(path)
+    key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    cached_key, conn = _worker_connections.get(path, (None, None))
+    if conn is not None and cached_key != key:
+        conn.close()
+        conn = None
+    if conn is None:
+        from .database import tune_connection
+
+        kwargs = {}
+        cached_statements = _worker_datasette.config("cached_statements", database=name)
+        if cached_statements:
+            kwargs["cached_statements"] = cached_statements
+        conn = sqlite3.connect(
+            "file:{}?immutable=1".format(path),
+            uri=True,
+            check_same_thread=False,
+            **kwargs
+        )
+        tune_connection(conn, _worker_datasette, name)
+        _worker_datasette.prepare_connection(conn, name)
+        # Plain tuples are far cheaper to send back than sqlite3.Row
+        conn.row_factory = None
+        _worker_connections[path] = (key, conn)
+    return conn
+
+
+def execute_in_process(path, name, sql, params, time_limit_ms, max_rows):
+    """
+    Runs a read query in a worker process.
+
+    Returns (description, rows, truncated) with rows as plain tuples. If
+    max_rows is set at most that many rows are returned.
+    """
+    conn = _worker_connection(path, name)
+    with sqlite_timelimit(conn, time_limit_ms):
+        try:
+            cursor = conn.cursor()
+            cursor.execute(sql, params or {})
+            if max_rows:
+                rows = cursor.fetchmany(max_rows + 1)
+                truncated = len(rows) > max_rows
+                rows = rows[:max_rows]
+            else:
+                rows = cursor.fetchall()
+                truncated = False
+        except (sqlite3.OperationalError, sqlite3.DatabaseError) as e:
+            if e.args == ("interrupted",):
+                raise QueryInterrupted(e, sql, params)
+            raise
+    description = tuple(tuple(d) for d in cursor.description or ())
+    return description, rows, truncated
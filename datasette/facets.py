@@ -1,15 +1,25 @@
+import asyncio
+import collections
 import json
+import math
 import urllib
 import re
 from datasette import hookimpl
+from datasette.utils.asgi import detached_cancellation
 from datasette.utils import (
+    cache_key_params,
     escape_sqlite,
+    estimated_size,
     path_with_added_args,
     path_with_removed_args,
     detect_json1,
+    detect_window_functions,
     QueryInterrupted,
+    QueryRejected,
     InvalidSql,
     sqlite3,
+    value_as_boolean,
+    ValueAsBooleanError,
 )
 
 
@@ -66,8 +76,83 @@ def register_facet_classes():
     return classes
 
 
+def approximate_count(count, sample_fraction):
+    """
+    Scales a count from a sample up to an estimate for the whole table.
+    Returns (estimate, [low, high]) where the true count should be in that
+    range with about 95% confidence, treating the count as Poisson - it is
+    never less than the count that was seen in the sample.
+    """
+    margin = 1.96 * math.sqrt(count)
+    return (
+        round(count / sample_fraction),
+        [
+            max(count, math.floor((count - margin) / sample_fraction)),
+            math.ceil((count + margin) / sample_fraction),
+        ],
+    )
+
+
+# What a sample of rows says about the values in one column, used to decide
+# which facets to suggest for it
+ColumnProfile = collections.namedtuple(
+    "ColumnProfile", ("distinct", "repeated", "string_arrays", "dates")
+)
+
+# Values that SQLite's date() function understands, roughly
+_date_re = re.compile(
+    r"^\d{4}-(0[1-9]|1[0-2])-(0[1-9]|[12]\d|3[01])"
+    r"([T ]([01]\d|2[0-3]):[0-5]\d(:[0-5]\d(\.\d+)?)?\s*([+-]\d\d:\d\d|Z)?)?\s*$"
+)
+
+
+def _is_json_array(value):
+    if not isinstance(value, str) or not value.lstrip().startswith("["):
+        return None
+    try:
+        array = json.loads(value)
+    except ValueError:
+        return None
+    return array if isinstance(array, list) else None
+
+
+def profile_column(values):
+    """
+    Returns a ColumnProfile for a list of values from a column:
+
+    distinct - the number of distinct values that are not null
+    repeated - True if any of those values appears more than once
+    string_arrays - True if every value is null or a JSON array, and the
+        first 100 arrays that are not empty only contain strings
+    dates - True if any value looks like a date
+    """
+    counts = collections.Counter(value for value in values if value is not None)
+    string_arrays = bool(counts)
+    non_empty_arrays = 0
+    for value in counts:
+        array = _is_json_array(value)
+        if array is None:
+            string_arrays = False
+            break
+        if array and non_empty_arrays < 100:
+            non_empty_arrays += 1
+            if not all(isinstance(item, str) for item in array):
+                string_arrays = False
+                break
+    return ColumnProfile(
+        distinct=len(counts),
+        repeated=any(count > 1 for count in counts.values()),
+        string_arrays=string_arrays and non_empty_arrays > 0,
+        dates=any(isinstance(value, str) and _date_re.match(value) for value in counts),
+    )
+
+
 class Facet:
     type = None
+    # Key for this facet's values in the column statistics from inspect
+    precomputed_values = None
+    # Number of rowid ranges a sample for approximate facets is taken from
+    sample_ranges = 20
 
     def __init__(
         self,
@@ -79,6 +164,7 @@ class Facet:
         params=None,
         metadata=None,
         row_count=None,
+        unfiltered=False,
     ):
         assert table or sql, "Must provide either table= or sql="
         self.ds = ds
@@ -87,10 +173,14 @@ class Facet:
         # For foreign key expansion. Can be None for e.g. canned SQL queries:
         self.table = table
         self.sql = sql or "select * from [{}]".format(table)
+        # unfiltered=True says that sql returns every row of table, so facets
+        # can use the column statistics from `datasette inspect --top-values`
+        self.unfiltered = unfiltered
         self.params = params or []
         self.metadata = metadata
         # row_count can be None, in which case we calculate it ourselves:
         self.row_count = row_count
+        self._sample = None
 
     def get_configs(self):
         configs = load_facet_configs(self.request, self.metadata)
@@ -101,9 +191,281 @@ class Facet:
         # [('_foo', 'bar'), ('_foo', '2'), ('empty', '')]
         return urllib.parse.parse_qsl(self.request.query_string, keep_blank_values=True)
 
+    async def facet_cache_key(self, column, facet_size):
+        "Key for caching the values of a facet, or None if they cannot be cached"
+        return await self._cache_key(self.type, column, facet_size)
+
+    async def _cache_key(self, *parts):
+        if not self.ds.facet_cache.max_bytes:
+            return None
+        version = await self.ds.databases[self.database].cache_version()
+        if version is None:
+            return None
+        if not await self.ds.query_cache_enabled(self.database, self.sql):
+            return None
+        key = (
+            self.database,
+            version,
+            self.table,
+            self.sql,
+            cache_key_params(self.params),
+        ) + parts
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def querystring_flag(self, name):
+        "Is ?name=1 (or on or true) set for this request?"
+        value = dict(self.get_querystring_pairs()).get(name)
+        if value is None:
+            return False
+        try:
+            return value_as_boolean(value)
+        except ValueAsBooleanError:
+            return False
+
+    def cached_value_counts(self, cache_key):
+        "Returns (value_counts, sample_fraction) from the facet cache, or None"
+        if cache_key is None or self.querystring_flag("_nocache"):
+            return None
+        return self.ds.facet_cache.get(cache_key)
+
+    def cache_value_counts(self, cache_key, value_counts, sample_fraction=None):
+        if cache_key is not None:
+            self.ds.facet_cache.set(
+                cache_key, (value_counts, sample_fraction), estimated_size(value_counts)
+            )
+
+    async def value_counts(self, column, facet_size, facet_sql, approximate=False):
+        """
+        Runs facet_sql, which should return value and count columns, and
+        returns (value_counts, sample_fraction, cached) where value_counts
+        is a list of (value, count) pairs.
+
+        If the query times out - or an approximate answer was asked for -
+        it is run against a sample of the table instead, and sample_fraction
+        is the fraction of the table's rows that were sampled. Otherwise it
+        is None. Raises QueryInterrupted if there was no way to answer in
+        time.
+        """
+        precomputed = self.precomputed_value_counts(column, facet_size)
+        if precomputed is not None:
+            return precomputed, None, False
+        cache_key = await self.facet_cache_key(column, facet_size)
+        cached = self.cached_value_counts(cache_key)
+        if cached is not None:
+            value_counts, sample_fraction = cached
+            return value_counts, sample_fraction, True
+        sample = None
+        if approximate or self.querystring_flag("_facet_approx"):
+            sample = await self.sample()
+        if sample is None:
+            try:
+                value_counts = await self.execute_facet_sql(facet_sql)
+            except QueryInterrupted:
+                # Not for QueryRejected - a sample would be turned away too
+                sample = await self.sample()
+                if sample is None:
+                    raise
+            else:
+                self.cache_value_counts(cache_key, value_counts)
+                return value_counts, None, False
+        with_clause, sample_fraction = sample
+        value_counts = await self.execute_facet_sql(with_clause + facet_sql)
+        # Cached under the same key as exact counts, so later requests do not
+        # wait for an exact query that is likely to time out again
+        self.cache_value_counts(cache_key, value_counts, sample_fraction)
+        return value_counts, sample_fraction, False
+
+    def inspected_table(self):
+        if not self.unfiltered or not self.table:
+            return None
+        return self.ds.databases[self.database].inspected_table(self.table)
+
+    def precomputed_value_counts(self, column, facet_size):
+        """
+        Value counts for this facet against the whole table, from the column
+        statistics recorded by `datasette inspect --top-values`, or None
+        """
+        info = self.inspected_table()
+        if not info or "column_stats" not in info or not self.precomputed_values:
+            return None
+        stats = info["column_stats"]
+        values = (stats["columns"].get(column) or {}).get(self.precomputed_values)
+        if values is None:
+            return None
+        # Too few values were recorded to tell if the facet is truncated
+        if facet_size >= len(values) >= stats["limit"]:
+            return None
+        return [tuple(value_count) for value_count in values[: facet_size + 1]]
+
+    async def execute_facet_sql(self, facet_sql):
+        results = await self.ds.execute(
+            self.database,
+            facet_sql,
+            self.params,
+            truncate=False,
+            custom_time_limit=self.ds.config("facet_time_limit_ms"),
+            priority="facet",
+        )
+        return [(row["value"], row["count"]) for row in results.rows]
+
+    async def sample(self):
+        """
+        Returns (with_clause, sample_fraction) for running facet SQL against
+        a sample of self.table, or None if the table cannot be sampled.
+
+        The sample is facet_sample_size rows taken from evenly spaced ranges
+        of rowids. Looking up a range of rowids is fast however large the
+        table is. The WITH clause gives the sample the same name as the
+        table, so SQLite reads it in place of the table for the rest of the
+        query - including for any filters.
+        """
+        if self._sample is not None:
+            return self._sample or None
+        self._sample = ()
+        sample_size = self.ds.config("facet_sample_size")
+        if not self.table or not sample_size:
+            return None
+        table = escape_sqlite(self.table)
+        try:
+            results = await self.ds.execute(
+                self.database,
+                "select min(rowid), max(rowid) from main.{}".format(table),
+                custom_time_limit=self.ds.config("facet_time_limit_ms"),
+                priority="facet",
+                log_sql_errors=False,
+            )
+        except (QueryInterrupted, QueryRejected, sqlite3.OperationalError):
+            return None
+        low, high = results.rows[0]
+        if low is None:
+            # An empty table, or a view or WITHOUT ROWID table
+            return None
+        span = high - low + 1
+        if span <= sample_size:
+            return None
+        num_ranges = min(self.sample_ranges, sample_size)
+        range_size = sample_size // num_ranges
+        starts = [
+            low + i * (span - range_size) // max(num_ranges - 1, 1)
+            for i in range(num_ranges)
+        ]
+        with_clause = "with {table} as ({ranges}) ".format(
+            table=table,
+            ranges=" union all ".join(
+                "select rowid, * from main.{} where rowid between {} and {}".format(
+                    table, start, start + range_size - 1
+                )
+                for start in starts
+            ),
+        )
+        self._sample = (with_clause, num_ranges * range_size / span)
+        return self._sample
+
+    def annotate_facet_result(self, facet_result, sample_fraction, cached):
+        """
+        Marks facet results that came from the facet cache, and scales
+        counts from a sample up to estimates for the whole table
+        """
+        if cached:
+            facet_result["cached"] = True
+        if sample_fraction is None:
+            return
+        facet_result["approximate"] = True
+        facet_result["sample_fraction"] = round(sample_fraction, 6)
+        for value in facet_result["results"]:
+            value["count"], value["count_range"] = approximate_count(
+                value["count"], sample_fraction
+            )
+
     async def suggest(self):
         return []
 
+    async def column_profiles(self):
+        """
+        Returns {column: ColumnProfile} for a sample of the first
+        facet_suggest_sample_size rows, or None if they could not be read
+        in time. For a whole table with column statistics from inspect
+        the profiles come from those instead.
+
+        Every type of facet decides which columns to suggest from the same
+        sample, so it is read once however many columns and facet types
+        there are. Profiles are kept in the facet cache for this table and
+        version of the data.
+        """
+        info = self.inspected_table()
+        if info and "column_stats" in info:
+            return {
+                column: ColumnProfile(
+                    distinct=stats["distinct"],
+                    repeated=stats["distinct"] < info["count"] - stats["nulls"],
+                    string_arrays=stats["arrays"],
+                    dates=stats["dates"],
+                )
+                for column, stats in info["column_stats"]["columns"].items()
+            }
+        sample_size = self.ds.config("facet_suggest_sample_size")
+        cache_key = await self._cache_key("suggest", sample_size)
+        if cache_key is not None and not self.querystring_flag("_nocache"):
+            profiles = self.ds.facet_cache.get(cache_key)
+            if profiles is not None:
+                return profiles
+        # Facets that ask for the same sample at the same time share it
+        pending = self.ds.pending_facet_samples
+        pending_key = (
+            self.database,
+            await self.ds.databases[self.database].cache_version(),
+            self.sql,
+            cache_key_params(self.params),
+            sample_size,
+        )
+        try:
+            task = pending.get(pending_key)
+        except TypeError:
+            pending_key = task = None
+        if task is None:
+            # Other requests may wait for this task, so cancelling this one
+            # must not interrupt its query
+            with detached_cancellation():
+                task = asyncio.ensure_future(
+                    self._read_column_profiles(sample_size, cache_key)
+                )
+            if pending_key is not None:
+                pending[pending_key] = task
+                task.add_done_callback(lambda _: pending.pop(pending_key, None))
+        try:
+            # Shielded so a cancelled request does not cancel it for the others
+            return await asyncio.shield(task)
+        except (QueryInterrupted, QueryRejected, sqlite3.OperationalError):
+            return None
+
+    async def _read_column_profiles(self, sample_size, cache_key):
+        results = await self.ds.execute(
+            self.database,
+            "select * from ({}) limit {}".format(self.sql, sample_size),
+            self.params,
+            truncate=False,
+            custom_time_limit=self.ds.config("facet_suggest_time_limit_ms"),
+            priority="suggest",
+            log_sql_errors=False,
+        )
+        profiles = {
+            column: profile_column([row[i] for row in results.rows])
+            for i, column in enumerate(results.columns)
+        }
+        if cache_key is not None:
+            self.ds.facet_cache.set(
+                cache_key,
+                profiles,
+                estimated_size(
+                    [(column,) + profile for column, profile in profiles.items()]
+                ),
+            )
+        return profiles
+
     async def facet_results(self):
         # returns ([results], [timed_out])
         # TODO: Include "hideable" with each one somehow, which indicates if it was
@@ -114,7 +476,10 @@ class Facet:
         # Detect column names using the "limit 0" trick
         return (
             await self.ds.execute(
-                self.database, "select * from ({}) limit 0".format(sql), params or []
+                self.database,
+                "select * from ({}) limit 0".format(sql),
+                params or [],
+                priority="suggest",
             )
         ).columns
 
@@ -125,6 +490,7 @@ class Facet:
                     self.database,
                     "select count(*) from ({})".format(self.sql),
                     self.params,
+                    priority="count",
                 )
             ).rows[0][0]
         return self.row_count
@@ -132,202 +498,249 @@ class Facet:
 
 class ColumnFacet(Facet):
     type = "column"
+    precomputed_values = "values"
 
     async def suggest(self):
         row_count = await self.get_row_count()
-        columns = await self.get_columns(self.sql, self.params)
+        profiles = await self.column_profiles()
+        if not profiles:
+            return []
         facet_size = self.ds.config("default_facet_size")
         suggested_facets = []
         already_enabled = [c["config"]["simple"] for c in self.get_configs()]
-        for column in columns:
+        for column, profile in profiles.items():
             if column in already_enabled:
                 continue
-            suggested_facet_sql = """
-                select {column}, count(*) as n from (
-                    {sql}
-                ) where {column} is not null
-                group by {column}
-                limit {limit}
-            """.format(
-                column=escape_sqlite(column), sql=self.sql, limit=facet_size + 1
-            )
-            distinct_values = None
-            try:
-                distinct_values = await self.ds.execute(
-                    self.database,
-                    suggested_facet_sql,
-                    self.params,
-                    truncate=False,
-                    custom_time_limit=self.ds.config("facet_suggest_time_limit_ms"),
+            if (
+                profile.distinct > 1
+                and profile.distinct <= facet_size
+                and (row_count is None or profile.distinct < row_count)
+                # And at least one value appears more than once
+                and profile.repeated
+            ):
+                suggested_facets.append(
+                    {
+                        "name": column,
+                        "toggle_url": self.ds.absolute_url(
+                            self.request,
+                            path_with_added_args(self.request, {"_facet": column}),
+                        ),
+                    }
                 )
-                num_distinct_values = len(distinct_values)
-                if (
-                    num_distinct_values
-                    and num_distinct_values > 1
-                    and num_distinct_values <= facet_size
-                    and num_distinct_values < row_count
-                    # And at least one has n > 1
-                    and any(r["n"] > 1 for r in distinct_values)
-                ):
-                    suggested_facets.append(
-                        {
-                            "name": column,
-                            "toggle_url": self.ds.absolute_url(
-                                self.request,
-                                path_with_added_args(self.request, {"_facet": column}),
-                            ),
-                        }
-                    )
-            except QueryInterrupted:
-                continue
         return suggested_facets
 
     async def facet_results(self):
         facet_results = {}
         facets_timed_out = []
 
-        qs_pairs = self.get_querystring_pairs()
-
         facet_size = self.ds.config("default_facet_size")
+        sources = {}
         for source_and_config in self.get_configs():
             config = source_and_config["config"]
-            source = source_and_config["source"]
             column = config.get("column") or config["simple"]
-            facet_sql = """
-                select {col} as value, count(*) as count from (
-                    {sql}
+            sources[column] = source_and_config["source"]
+        if not sources:
+            return facet_results, facets_timed_out
+
+        value_counts = {}
+        approximate = self.querystring_flag("_facet_approx")
+        if len(sources) > 1 and not approximate and detect_window_functions():
+            # Count every column that is not in the facet cache in one pass
+            columns = []
+            for column in sources:
+                precomputed = self.precomputed_value_counts(column, facet_size)
+                if precomputed is not None:
+                    value_counts[column] = (precomputed, None, False)
+                    continue
+                cached = self.cached_value_counts(
+                    await self.facet_cache_key(column, facet_size)
                 )
-                where {col} is not null
-                group by {col} order by count desc, value limit {limit}
-            """.format(
-                col=escape_sqlite(column), sql=self.sql, limit=facet_size + 1
-            )
-            try:
-                facet_rows_results = await self.ds.execute(
-                    self.database,
-                    facet_sql,
-                    self.params,
-                    truncate=False,
-                    custom_time_limit=self.ds.config("facet_time_limit_ms"),
-                )
-                facet_results_values = []
-                facet_results[column] = {
-                    "name": column,
-                    "type": self.type,
-                    "hideable": source != "metadata",
-                    "toggle_url": path_with_removed_args(
-                        self.request, {"_facet": column}
-                    ),
-                    "results": facet_results_values,
-                    "truncated": len(facet_rows_results) > facet_size,
-                }
-                facet_rows = facet_rows_results.rows[:facet_size]
-                if self.table:
-                    # Attempt to expand foreign keys into labels
-                    values = [row["value"] for row in facet_rows]
-                    expanded = await self.ds.expand_foreign_keys(
-                        self.database, self.table, column, values
+                if cached is not None:
+                    value_counts[column] = cached + (True,)
+                else:
+                    columns.append(column)
+            if len(columns) > 1:
+                try:
+                    rows_by_column = await self._facet_rows_single_pass(
+                        columns, facet_size
                     )
+                except QueryRejected:
+                    facets_timed_out.extend(columns)
+                except QueryInterrupted:
+                    # Each column is counted on its own instead - from a
+                    # sample if possible, so the cheap ones can still finish
+                    if await self.sample() is not None:
+                        approximate = True
                 else:
-                    expanded = {}
-                for row in facet_rows:
-                    selected = (column, str(row["value"])) in qs_pairs
-                    if selected:
-                        toggle_path = path_with_removed_args(
-                            self.request, {column: str(row["value"])}
-                        )
-                    else:
-                        toggle_path = path_with_added_args(
-                            self.request, {column: row["value"]}
+                    for column, rows in rows_by_column.items():
+                        self.cache_value_counts(
+                            await self.facet_cache_key(column, facet_size), rows
                         )
-                    facet_results_values.append(
-                        {
-                            "value": row["value"],
-                            "label": expanded.get((column, row["value"]), row["value"]),
-                            "count": row["count"],
-                            "toggle_url": self.ds.absolute_url(
-                                self.request, toggle_path
-                            ),
-                            "selected": selected,
-                        }
-                    )
-            except QueryInterrupted:
+                        value_counts[column] = (rows, None, False)
+
+        for column in sources:
+            if column in value_counts or column in facets_timed_out:
+                continue
+            try:
+                value_counts[column] = await self.value_counts(
+                    column,
+                    facet_size,
+                    self._facet_sql(column, facet_size),
+                    approximate=approximate,
+                )
+            except (QueryInterrupted, QueryRejected):
                 facets_timed_out.append(column)
 
+        for column, source in sources.items():
+            if column in value_counts:
+                rows, sample_fraction, cached = value_counts[column]
+                facet_results[column] = await self._facet_result(
+                    column, source, rows, facet_size, sample_fraction, cached
+                )
         return facet_results, facets_timed_out
 
+    def _facet_sql(self, column, facet_size):
+        return """
+            select {col} as value, count(*) as count from (
+                {sql}
+            )
+            where {col} is not null
+            group by {col} order by count desc, value limit {limit}
+        """.format(
+            col=escape_sqlite(column), sql=self.sql, limit=facet_size + 1
+        )
+
+    async def _facet_rows_single_pass(self, columns, facet_size):
+        """
+        Counts the values of every column in one scan of the filtered rows,
+        rather than one scan per column. Each row is cross joined against
+        the list of column indexes - CROSS JOIN makes SQLite use the rows
+        as the outer loop - and row_number() picks the top values of each.
+
+        Returns {column: [(value, count), ...]}
+        """
+        column_indexes = " union all ".join(
+            "select {} as facet_column".format(i) for i in range(len(columns))
+        )
+        value_case = "case facet_columns.facet_column {} end".format(
+            " ".join(
+                "when {} then facet_rows.{}".format(i, escape_sqlite(column))
+                for i, column in enumerate(columns)
+            )
+        )
+        facet_sql = """
+            select facet_column, value, count from (
+                select facet_column, value, count, row_number() over (
+                    partition by facet_column order by count desc, value
+                ) as facet_rank from (
+                    select facet_column, value, count(*) as count from (
+                        select facet_columns.facet_column as facet_column,
+                            {value_case} as value
+                        from ({sql}) as facet_rows
+                        cross join ({column_indexes}) as facet_columns
+                    )
+                    where value is not null
+                    group by facet_column, value
+                )
+            )
+            where facet_rank <= {limit}
+            order by facet_column, facet_rank
+        """.format(
+            value_case=value_case,
+            sql=self.sql,
+            column_indexes=column_indexes,
+            limit=facet_size + 1,
+        )
+        # The query does the work of one facet query per column, so it gets
+        # the time those queries would have had between them
+        results = await self.ds.execute(
+            self.database,
+            facet_sql,
+            self.params,
+            truncate=False,
+            custom_time_limit=self.ds.config("facet_time_limit_ms") * len(columns),
+            priority="facet",
+        )
+        rows_by_column = {column: [] for column in columns}
+        for facet_column, value, count in results.rows:
+            rows_by_column[columns[facet_column]].append((value, count))
+        return rows_by_column
+
+    async def _facet_result(
+        self,
+        column,
+        source,
+        value_counts,
+        facet_size,
+        sample_fraction=None,
+        cached=False,
+    ):
+        "value_counts is a list of (value, count) pairs, largest count first"
+        qs_pairs = self.get_querystring_pairs()
+        facet_results_values = []
+        facet_result = {
+            "name": column,
+            "type": self.type,
+            "hideable": source != "metadata",
+            "toggle_url": path_with_removed_args(self.request, {"_facet": column}),
+            "results": facet_results_values,
+            "truncated": len(value_counts) > facet_size,
+        }
+        value_counts = value_counts[:facet_size]
+        if self.table:
+            # Attempt to expand foreign keys into labels
+            values = [value for value, _ in value_counts]
+            expanded = await self.ds.expand_foreign_keys(
+                self.database, self.table, column, values
+            )
+        else:
+            expanded = {}
+        for value, count in value_counts:
+            selected = (column, str(value)) in qs_pairs
+            if selected:
+                toggle_path = path_with_removed_args(self.request, {column: str(value)})
+            else:
+                toggle_path = path_with_added_args(self.request, {column: value})
+            facet_results_values.append(
+                {
+                    "value": value,
+                    "label": expanded.get((column, value), value),
+                    "count": count,
+                    "toggle_url": self.ds.absolute_url(self.request, toggle_path),
+                    "selected": selected,
+                }
+            )
+        self.annotate_facet_result(facet_result, sample_fraction, cached)
+        return facet_result
+
 
 class ArrayFacet(Facet):
     type = "array"
-
-    def _is_json_array_of_strings(self, json_string):
-        try:
-            array = json.loads(json_string)
-        except ValueError:
-            return False
-        for item in array:
-            if not isinstance(item, str):
-                return False
-        return True
+    precomputed_values = "array_values"
 
     async def suggest(self):
-        columns = await self.get_columns(self.sql, self.params)
+        profiles = await self.column_profiles()
+        if not profiles:
+            return []
         suggested_facets = []
         already_enabled = [c["config"]["simple"] for c in self.get_configs()]
-        for column in columns:
+        for column, profile in profiles.items():
             if column in already_enabled:
                 continue
-            # Is every value in this column either null or a JSON array?
-            suggested_facet_sql = """
-                select distinct json_type({column})
-                from ({sql})
-            """.format(
-                column=escape_sqlite(column), sql=self.sql
-            )
-            try:
-                results = await self.ds.execute(
-                    self.database,
-                    suggested_facet_sql,
-                    self.params,
-                    truncate=False,
-                    custom_time_limit=self.ds.config("facet_suggest_time_limit_ms"),
-                    log_sql_errors=False,
-                )
-                types = tuple(r[0] for r in results.rows)
-                if types in (("array",), ("array", None)):
-                    # Now sanity check that first 100 arrays contain only strings
-                    first_100 = [
-                        v[0]
-                        for v in await self.ds.execute(
-                            self.database,
-                            "select {column} from ({sql}) where {column} is not null and json_array_length({column}) > 0 limit 100".format(
-                                column=escape_sqlite(column), sql=self.sql
+            # Is every value in this column either null or a JSON array of strings?
+            if profile.string_arrays:
+                suggested_facets.append(
+                    {
+                        "name": column,
+                        "type": "array",
+                        "toggle_url": self.ds.absolute_url(
+                            self.request,
+                            path_with_added_args(
+                                self.request, {"_facet_array": column}
                             ),
-                            self.params,
-                            truncate=False,
-                            custom_time_limit=self.ds.config(
-                                "facet_suggest_time_limit_ms"
-                            ),
-                            log_sql_errors=False,
-                        )
-                    ]
-                    if first_100 and all(
-                        self._is_json_array_of_strings(r) for r in first_100
-                    ):
-                        suggested_facets.append(
-                            {
-                                "name": column,
-                                "type": "array",
-                                "toggle_url": self.ds.absolute_url(
-                                    self.request,
-                                    path_with_added_args(
-                                        self.request, {"_facet_array": column}
-                                    ),
-                                ),
-                            }
-                        )
-            except (QueryInterrupted, sqlite3.OperationalError):
-                continue
+                        ),
+                    }
+                )
         return suggested_facets
 
     async def facet_results(self):
@@ -349,97 +762,74 @@ class ArrayFacet(Facet):
                 col=escape_sqlite(column), sql=self.sql, limit=facet_size + 1
             )
             try:
-                facet_rows_results = await self.ds.execute(
-                    self.database,
-                    facet_sql,
-                    self.params,
-                    truncate=False,
-                    custom_time_limit=self.ds.config("facet_time_limit_ms"),
+                value_counts, sample_fraction, cached = await self.value_counts(
+                    column, facet_size, facet_sql
                 )
-                facet_results_values = []
-                facet_results[column] = {
-                    "name": column,
-                    "type": self.type,
-                    "results": facet_results_values,
-                    "hideable": source != "metadata",
-                    "toggle_url": path_with_removed_args(
-                        self.request, {"_facet_array": column}
-                    ),
-                    "truncated": len(facet_rows_results) > facet_size,
-                }
-                facet_rows = facet_rows_results.rows[:facet_size]
-                pairs = self.get_querystring_pairs()
-                for row in facet_rows:
-                    value = str(row["value"])
-                    selected = ("{}__arraycontains".format(column), value) in pairs
-                    if selected:
-                        toggle_path = path_with_removed_args(
-                            self.request, {"{}__arraycontains".format(column): value}
-                        )
-                    else:
-                        toggle_path = path_with_added_args(
-                            self.request, {"{}__arraycontains".format(column): value}
-                        )
-                    facet_results_values.append(
-                        {
-                            "value": value,
-                            "label": value,
-                            "count": row["count"],
-                            "toggle_url": self.ds.absolute_url(
-                                self.request, toggle_path
-                            ),
-                            "selected": selected,
-                        }
-                    )
-            except QueryInterrupted:
+            except (QueryInterrupted, QueryRejected):
                 facets_timed_out.append(column)
+                continue
+            facet_results_values = []
+            facet_results[column] = {
+                "name": column,
+                "type": self.type,
+                "results": facet_results_values,
+                "hideable": source != "metadata",
+                "toggle_url": path_with_removed_args(
+                    self.request, {"_facet_array": column}
+                ),
+                "truncated": len(value_counts) > facet_size,
+            }
+            pairs = self.get_querystring_pairs()
+            for value, count in value_counts[:facet_size]:
+                value = str(value)
+                selected = ("{}__arraycontains".format(column), value) in pairs
+                if selected:
+                    toggle_path = path_with_removed_args(
+                        self.request, {"{}__arraycontains".format(column): value}
+                    )
+                else:
+                    toggle_path = path_with_added_args(
+                        self.request, {"{}__arraycontains".format(column): value}
+                    )
+                facet_results_values.append(
+                    {
+                        "value": value,
+                        "label": value,
+                        "count": count,
+                        "toggle_url": self.ds.absolute_url(self.request, toggle_path),
+                        "selected": selected,
+                    }
+                )
+            self.annotate_facet_result(facet_results[column], sample_fraction, cached)
 
         return facet_results, facets_timed_out
 
 
 class DateFacet(Facet):
     type = "date"
+    precomputed_values = "date_values"
 
     async def suggest(self):
-        columns = await self.get_columns(self.sql, self.params)
+        profiles = await self.column_profiles()
+        if not profiles:
+            return []
         already_enabled = [c["config"]["simple"] for c in self.get_configs()]
         suggested_facets = []
-        for column in columns:
+        for column, profile in profiles.items():
             if column in already_enabled:
                 continue
-            # Does this column contain any dates in the first 100 rows?
-            suggested_facet_sql = """
-                select date({column}) from (
-                    {sql}
-                ) where {column} glob "????-??-*" limit 100;
-            """.format(
-                column=escape_sqlite(column), sql=self.sql
-            )
-            try:
-                results = await self.ds.execute(
-                    self.database,
-                    suggested_facet_sql,
-                    self.params,
-                    truncate=False,
-                    custom_time_limit=self.ds.config("facet_suggest_time_limit_ms"),
-                    log_sql_errors=False,
+            # Does this column contain any dates?
+            if profile.dates:
+                suggested_facets.append(
+                    {
+                        "name": column,
+                        "type": "date",
+                        "toggle_url": self.ds.absolute_url(
+                            self.request,
+                            path_with_added_args(self.request, {"_facet_date": column}),
+                        ),
+                    }
                 )
-                values = tuple(r[0] for r in results.rows)
-                if any(values):
-                    suggested_facets.append(
-                        {
-                            "name": column,
-                            "type": "date",
-                            "toggle_url": self.ds.absolute_url(
-                                self.request,
-                                path_with_added_args(
-                                    self.request, {"_facet_date": column}
-                                ),
-                            ),
-                        }
-                    )
-            except (QueryInterrupted, sqlite3.OperationalError):
-                continue
         return suggested_facets
 
     async def facet_results(self):
@@ -462,49 +852,42 @@ class DateFacet(Facet):
                 col=escape_sqlite(column), sql=self.sql, limit=facet_size + 1
             )
             try:
-                facet_rows_results = await self.ds.execute(
-                    self.database,
-                    facet_sql,
-                    self.params,
-                    truncate=False,
-                    custom_time_limit=self.ds.config("facet_time_limit_ms"),
+                value_counts, sample_fraction, cached = await self.value_counts(
+                    column, facet_size, facet_sql
                 )
-                facet_results_values = []
-                facet_results[column] = {
-                    "name": column,
-                    "type": self.type,
-                    "results": facet_results_values,
-                    "hideable": source != "metadata",
-                    "toggle_url": path_with_removed_args(
-                        self.request, {"_facet_date": column}
-                    ),
-                    "truncated": len(facet_rows_results) > facet_size,
-                }
-                facet_rows = facet_rows_results.rows[:facet_size]
-                for row in facet_rows:
-                    selected = str(args.get("{}__date".format(column))) == str(
-                        row["value"]
+            except (QueryInterrupted, QueryRejected):
+                facets_timed_out.append(column)
+                continue
+            facet_results_values = []
+            facet_results[column] = {
+                "name": column,
+                "type": self.type,
+                "results": facet_results_values,
+                "hideable": source != "metadata",
+                "toggle_url": path_with_removed_args(
+                    self.request, {"_facet_date": column}
+                ),
+                "truncated": len(value_counts) > facet_size,
+            }
+            for value, count in value_counts[:facet_size]:
+                selected = str(args.get("{}__date".format(column))) == str(value)
+                if selected:
+                    toggle_path = path_with_removed_args(
+                        self.request, {"{}__date".format(column): str(value)}
                     )
-                    if selected:
-                        toggle_path = path_with_removed_args(
-                            self.request, {"{}__date".format(column): str(row["value"])}
-                        )
-                    else:
-                        toggle_path = path_with_added_args(
-                            self.request, {"{}__date".format(column): row["value"]}
-                        )
-                    facet_results_values.append(
-                        {
-                            "value": row["value"],
-                            "label": row["value"],
-                            "count": row["count"],
-                            "toggle_url": self.ds.absolute_url(
-                                self.request, toggle_path
-                            ),
-                            "selected": selected,
-                        }
+                else:
+                    toggle_path = path_with_added_args(
+                        self.request, {"{}__date".format(column): value}
                     )
-            except QueryInterrupted:
-                facets_timed_out.append(column)
+                facet_results_values.append(
+                    {
+                        "value": value,
+                        "label": value,
+                        "count": count,
+                        "toggle_url": self.ds.absolute_url(self.request, toggle_path),
+                        "selected": selected,
+                    }
+                )
+            self.annotate_facet_result(facet_results[column], sample_fraction, cached)
 
         return facet_results, facets_timed_out
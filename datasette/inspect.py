@@ -1,6 +1,9 @@
 import hashlib
+import json
+import mmap
 
 from .utils import (
+    detect_json1,
     detect_spatialite,
     detect_fts,
     detect_primary_keys,
@@ -11,22 +14,73 @@ from .utils import (
 )
 
 
-HASH_BLOCK_SIZE = 1024 * 1024
+HASH_BLOCK_SIZE = 16 * 1024 * 1024
 
 
 def inspect_hash(path):
     " Calculate the hash of a database, efficiently. "
     m = hashlib.sha256()
     with path.open("rb") as fp:
-        while True:
-            data = fp.read(HASH_BLOCK_SIZE)
-            if not data:
-                break
-            m.update(data)
+        try:
+            mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # Empty files cannot be memory-mapped
+            mapped = None
+        if mapped is None:
+            while True:
+                data = fp.read(HASH_BLOCK_SIZE)
+                if not data:
+                    break
+                m.update(data)
+        else:
+            with mapped:
+                view = memoryview(mapped)
+                try:
+                    for offset in range(0, len(view), HASH_BLOCK_SIZE):
+                        m.update(view[offset : offset + HASH_BLOCK_SIZE])
+                finally:
+                    view.release()
 
     return m.hexdigest()
 
 
+def hash_cache_path(path):
+    " Path of the sidecar file used to cache the hash of a database. "
+    return path.with_name(path.name + ".datasette-hash")
+
+
+def _hash_cache_key(path, stat):
+    return {
+        "path": str(path.resolve()),
+        "inode": stat.st_ino,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+
+
+def read_cached_hash(path, stat):
+    " Returns the hash from the sidecar file, if it still matches the file. "
+    try:
+        cached = json.loads(hash_cache_path(path).read_text())
+    except (OSError, ValueError):
+        return None
+    if not isinstance(cached, dict) or "hash" not in cached:
+        return None
+    key = _hash_cache_key(path, stat)
+    if any(cached.get(k) != v for k, v in key.items()):
+        return None
+    return cached["hash"]
+
+
+def write_cached_hash(path, stat, hash):
+    " Writes the sidecar file - silently does nothing if it cannot. "
+    data = dict(_hash_cache_key(path, stat), hash=hash)
+    try:
+        hash_cache_path(path).write_text(json.dumps(data))
+    except OSError:
+        pass
+
+
 def inspect_views(conn):
     " List views in a database. "
     return [
@@ -111,3 +165,112 @@ def inspect_tables(conn, database_metadata):
                 continue
 
     return tables
+
+
+def inspect_column_stats(conn, table, limit):
+    """
+    Statistics about the values in every column of a table, which let
+    facets and suggested facets against the whole table be answered
+    without querying it:
+
+        {"limit": limit, "columns": {column: {
+            "distinct": number of distinct values that are not null,
+            "nulls": number of null values,
+            "values": [[value, count], ...] for the most common values,
+            "dates": True if any value is a date,
+            "arrays": True if every value is null or a JSON array of strings,
+            "date_values": [[date, count], ...] if "dates" is True,
+            "array_values": [[item, count], ...] if "arrays" is True,
+        }}}
+
+    Each list holds at most limit values, and is complete if it has fewer.
+    Lists that would include binary values are left out.
+    """
+    table_sql = escape_sqlite(table)
+    columns = table_columns(conn, table)
+    stats = {}
+    if not columns:
+        return {"limit": limit, "columns": stats}
+    has_json1 = detect_json1(conn)
+    row = conn.execute(
+        "select {} from {}".format(
+            ", ".join(
+                "count(distinct {col}), sum({col} is null)".format(
+                    col=escape_sqlite(column)
+                )
+                for column in columns
+            ),
+            table_sql,
+        )
+    ).fetchone()
+
+    def top_values(value, from_sql):
+        values = [
+            list(r)
+            for r in conn.execute(
+                """
+                    select {value} as value, count(*) as count from {from_sql}
+                    where {value} is not null
+                    group by {value} order by count desc, value limit {limit}
+                """.format(
+                    value=value, from_sql=from_sql, limit=limit
+                )
+            )
+        ]
+        if any(isinstance(v, bytes) for v, _ in values):
+            return None
+        return values
+
+    for i, column in enumerate(columns):
+        col = escape_sqlite(column)
+        column_stats = {"distinct": row[i * 2], "nulls": row[i * 2 + 1] or 0}
+        values = top_values(col, table_sql)
+        if values is not None:
+            column_stats["values"] = values
+        column_stats["dates"] = (
+            conn.execute(
+                """
+                    select 1 from {} where {col} glob "????-??-*"
+                    and date({col}) is not null limit 1
+                """.format(
+                    table_sql, col=col
+                )
+            ).fetchone()
+            is not None
+        )
+        if column_stats["dates"]:
+            column_stats["date_values"] = top_values("date({})".format(col), table_sql)
+        column_stats["arrays"] = has_json1 and _is_string_array_column(
+            conn, table_sql, col
+        )
+        if column_stats["arrays"]:
+            values = top_values(
+                "j.value", "{} join json_each({}) j".format(table_sql, col)
+            )
+            if values is not None:
+                column_stats["array_values"] = values
+        stats[column] = column_stats
+    return {"limit": limit, "columns": stats}
+
+
+def _is_string_array_column(conn, table_sql, col):
+    try:
+        types = {
+            r[0]
+            for r in conn.execute(
+                "select distinct json_type({col}) from {} where {col} is not null".format(
+                    table_sql, col=col
+                )
+            )
+        }
+    except sqlite3.OperationalError:
+        # Not valid JSON
+        return False
+    if types != {"array"}:
+        return False
+    items = "select j.type from {} join json_each({}) j".format(table_sql, col)
+    return (
+        conn.execute("{} limit 1".format(items)).fetchone() is not None
+        and conn.execute("{} where j.type != 'text' limit 1".format(items)).fetchone()
+        is None
+    )
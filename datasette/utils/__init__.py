@@ -2,12 +2,14 @@ from contextlib import contextmanager
 from collections import OrderedDict
 import base64
 import click
+import functools
 import hashlib
 import json
 import os
 import re
 import shlex
 import tempfile
+import threading
 import time
 import types
 import shutil
@@ -49,6 +51,19 @@ class QueryInterrupted(Exception):
     pass
 
 
+class QueryRejected(Exception):
+    """
+    Raised when a query is turned away because its database is overloaded.
+
+    This is deliberately not a QueryInterrupted: the query never ran, so its
+    failure says nothing about how long it would take.
+    """
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
 class Results:
     def __init__(self, rows, truncated, description):
         self.rows = rows
@@ -66,6 +81,89 @@ class Results:
         return len(self.rows)
 
 
+class LRUCache:
+    """
+    A least-recently-used cache with a budget in bytes rather than entries.
+
+    Callers supply the size of each value when they store it. A max_bytes
+    of 0 disables the cache entirely.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (value, size)
+        self._lock = threading.Lock()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, size = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.num_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self.num_bytes += size
+            while self.num_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.num_bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.num_bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_bytes": self.max_bytes,
+                "bytes": self.num_bytes,
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+def estimated_size(rows):
+    "Rough number of bytes of memory used by a list of result rows"
+    size = 64
+    for row in rows:
+        size += 64 + 8 * len(row)
+        for value in row:
+            if isinstance(value, (str, bytes)):
+                size += len(value)
+            else:
+                size += 8
+    return size
+
+
+def cache_key_params(params):
+    "Query parameters as something that can be used in a cache key"
+    if isinstance(params, dict):
+        return tuple(sorted(params.items()))
+    elif params is not None:
+        return tuple(params)
+    return None
+
+
 def urlsafe_components(token):
     "Splits token on commas and URL decodes each component"
     return [urllib.parse.unquote_plus(b) for b in token.split(",")]
@@ -258,6 +356,28 @@ def escape_css_string(s):
     return _css_re.sub(lambda m: "\\{:X}".format(ord(m.group())), s)
 
 
+_sql_token_re = re.compile(
+    r"""'(?:[^']|'')*'|"((?:[^"]|"")*)"|\[([^\]]*)\]|`((?:[^`]|``)*)`|([a-zA-Z_][a-zA-Z0-9_$]*)"""
+)
+
+
+def sql_identifiers(sql):
+    "Returns the lower case names of every identifier used in sql"
+    identifiers = set()
+    # String literals match the first alternative, so are skipped
+    for match in _sql_token_re.finditer(sql):
+        double, square, backtick, bare = match.groups()
+        if double is not None:
+            identifiers.add(double.replace('""', '"').lower())
+        elif square is not None:
+            identifiers.add(square.lower())
+        elif backtick is not None:
+            identifiers.add(backtick.replace("``", "`").lower())
+        elif bare is not None:
+            identifiers.add(bare.lower())
+    return identifiers
+
+
 def escape_sqlite(s):
     if _boring_keyword_re.match(s) and (s.lower() not in reserved_words):
         return s
@@ -498,6 +618,27 @@ def detect_json1(conn=None):
         return False
 
 
+@functools.lru_cache(maxsize=None)
+def _sqlite_has_window_functions():
+    conn = sqlite3.connect(":memory:")
+    try:
+        return detect_window_functions(conn)
+    finally:
+        conn.close()
+
+
+def detect_window_functions(conn=None):
+    # Window functions were added in SQLite 3.25.0
+    if conn is None:
+        # That depends only on the SQLite library, so it is only checked once
+        return _sqlite_has_window_functions()
+    try:
+        conn.execute("select row_number() over ()")
+        return True
+    except Exception:
+        return False
+
+
 def table_columns(conn, table):
     return [
         r[1]
@@ -668,6 +809,36 @@ class CustomRow(OrderedDict):
             yield self[column]
 
 
+class ResultRow(tuple):
+    # Imitation of sqlite3.Row for rows built from plain tuples, for example
+    # results returned from a worker process. Use result_row_class()
+    __slots__ = ()
+    _keys = ()
+    _index = {}
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            try:
+                key = self._index[key.lower()]
+            except KeyError:
+                raise IndexError("No item with that key")
+        return super().__getitem__(key)
+
+    def keys(self):
+        return list(self._keys)
+
+
+def result_row_class(description):
+    "Returns a ResultRow subclass for rows with the columns in description"
+    keys = tuple(d[0] for d in description)
+    index = {}
+    for i, key in enumerate(keys):
+        index.setdefault(key.lower(), i)
+    return type(
+        "ResultRow", (ResultRow,), {"__slots__": (), "_keys": keys, "_index": index}
+    )
+
+
 def value_as_boolean(value):
     if value.lower() not in ("on", "off", "true", "false", "1", "0"):
         raise ValueAsBooleanError
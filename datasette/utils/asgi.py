@@ -1,12 +1,20 @@
+import asyncio
 import json
-from datasette.utils import RequestParameters
+from contextlib import contextmanager
+from datasette.utils import QueryInterrupted, RequestParameters, sqlite3
 from mimetypes import guess_type
-from urllib.parse import parse_qs, urlunparse, parse_qsl
+from urllib.parse import parse_qs, quote, urlunparse, parse_qsl
 from pathlib import Path
 from html import escape
 import re
+import threading
 import aiofiles
 
+try:
+    import contextvars
+except ImportError:  # Python 3.6
+    contextvars = None
+
 
 class NotFound(Exception):
     pass
@@ -174,6 +182,141 @@ class AsgiLifespan:
             await self.app(scope, receive, send)
 
 
+class RequestCancellation:
+    """
+    Tracks the SQLite connections running queries for a request, so they
+    can be interrupted if the client disconnects before it is finished.
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self._connections = set()
+        self._children = []
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            for conn in self._connections:
+                conn.interrupt()
+            children = list(self._children)
+        for child in children:
+            child.cancel()
+
+    def add_child(self, child):
+        "Cancel child too when this is cancelled"
+        with self._lock:
+            if not self.cancelled:
+                self._children.append(child)
+                return
+        child.cancel()
+
+    @contextmanager
+    def interrupts(self, conn):
+        "Interrupt conn if the request is cancelled while this block runs"
+        with self._lock:
+            if self.cancelled:
+                raise QueryInterrupted(
+                    sqlite3.OperationalError("interrupted"), None, None
+                )
+            self._connections.add(conn)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._connections.discard(conn)
+
+
+if contextvars is not None:
+    _current_cancellation = contextvars.ContextVar(
+        "datasette_cancellation", default=None
+    )
+
+
+def current_cancellation():
+    "The RequestCancellation for the request being handled, if any"
+    if contextvars is None:
+        return None
+    return _current_cancellation.get()
+
+
+@contextmanager
+def child_cancellation():
+    """
+    Yields a RequestCancellation for the queries started inside this block,
+    including those run by tasks created in it, so that they can be
+    interrupted without cancelling the rest of the request. They are still
+    interrupted if the whole request is cancelled.
+    """
+    cancellation = RequestCancellation()
+    parent = current_cancellation()
+    if parent is not None:
+        parent.add_child(cancellation)
+    if contextvars is None:
+        yield cancellation
+        return
+    token = _current_cancellation.set(cancellation)
+    try:
+        yield cancellation
+    finally:
+        _current_cancellation.reset(token)
+
+
+@contextmanager
+def detached_cancellation():
+    """
+    Queries started inside this block, including those run by tasks created
+    in it, are not interrupted if the current request is cancelled - for
+    work that other requests share.
+    """
+    if contextvars is None:
+        yield
+        return
+    token = _current_cancellation.set(None)
+    try:
+        yield
+    finally:
+        _current_cancellation.reset(token)
+
+
+class AsgiCancelOnDisconnect:
+    """
+    Watches for http.disconnect while a request is being handled and
+    interrupts any SQL queries still running for it. Requires Python 3.7+
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or contextvars is None:
+            await self.app(scope, receive, send)
+            return
+        cancellation = RequestCancellation()
+        messages = asyncio.Queue()
+
+        async def watch():
+            while True:
+                message = await receive()
+                messages.put_nowait(message)
+                if message["type"] == "http.disconnect":
+                    cancellation.cancel()
+                    return
+
+        async def wrapped_receive():
+            if cancellation.cancelled and messages.empty():
+                return {"type": "http.disconnect"}
+            return await messages.get()
+
+        token = _current_cancellation.set(cancellation)
+        watcher = asyncio.ensure_future(watch())
+        try:
+            await self.app(scope, wrapped_receive, send)
+        finally:
+            watcher.cancel()
+            _current_cancellation.reset(token)
+
+
 class AsgiView:
     def dispatch_request(self, request, *args, **kwargs):
         handler = getattr(self, request.method.lower(), None)
@@ -293,6 +436,40 @@ async def asgi_start(send, status, headers=None, content_type="text/plain"):
     )
 
 
+async def asgi_internal_get(app, path):
+    """
+    Makes a GET request to an ASGI app from within the same process, discarding
+    the response body. Returns the response status code.
+    """
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": "GET",
+        "path": path,
+        "raw_path": quote(path, safe="/:,").encode("latin-1"),
+        "query_string": b"",
+        "headers": [[b"host", b"localhost"]],
+    }
+    started = {}
+    requested = False
+    # The client never disconnects
+    never = asyncio.get_event_loop().create_future()
+
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {"type": "http.request"}
+        return await never
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            started.update(message)
+
+    await app(scope, receive, send)
+    return started.get("status")
+
+
 async def asgi_send_file(
     send, filepath, filename=None, content_type=None, chunk_size=4096
 ):
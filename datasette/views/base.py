@@ -13,6 +13,7 @@ from datasette import __version__
 from datasette.plugins import pm
 from datasette.utils import (
     QueryInterrupted,
+    QueryRejected,
     InvalidSql,
     LimitedWriter,
     is_url,
@@ -30,6 +31,7 @@ from datasette.utils.asgi import (
     AsgiView,
     NotFound,
     Response,
+    current_cancellation,
 )
 
 ureg = pint.UnitRegistry()
@@ -181,8 +183,9 @@ class DataView(BaseView):
             if (
                 (self.ds.config("hash_urls") or "_hash" in request.args)
                 and
-                # Redirect only if database is immutable
+                # Redirect only if database is immutable and its hash is ready
                 not self.ds.databases[name].is_mutable
+                and not self.ds.databases[name].hash_pending
             ):
                 return name, expected, correct_hash_provided, should_redirect
 
@@ -248,7 +251,11 @@ class DataView(BaseView):
             writer = csv.writer(LimitedWriter(r, self.ds.config("max_csv_mb")))
             first = True
             next = None
+            cancellation = current_cancellation()
             while first or (next and stream):
+                if cancellation is not None and cancellation.cancelled:
+                    # Client has disconnected, stop fetching pages
+                    return
                 try:
                     if next:
                         kwargs["_next"] = next
@@ -347,6 +354,9 @@ class DataView(BaseView):
 
             else:
                 data, extra_template_data, templates = response_or_template_contexts
+        except QueryRejected:
+            # Turned into a 503 by the router
+            raise
         except QueryInterrupted:
             raise DatasetteError(
                 """
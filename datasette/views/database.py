@@ -38,6 +38,7 @@ class DatabaseView(DataView):
                     "columns": table_columns,
                     "primary_keys": await db.primary_keys(table),
                     "count": table_counts[table],
+                    "count_exact": table not in db.estimated_table_counts,
                     "hidden": table in hidden_table_names,
                     "fts_table": await db.fts_table(table),
                     "foreign_keys": all_foreign_keys[table],
@@ -23,13 +23,16 @@ class IndexView(BaseView):
 
     async def get(self, request, as_format):
         databases = []
-        for name, db in self.ds.databases.items():
+        for name, db in list(self.ds.databases.items()):
             table_names = await db.table_names()
             hidden_table_names = set(await db.hidden_table_names())
             views = await db.view_names()
             # Perform counts only for immutable or DBS with <= COUNT_TABLE_LIMIT tables
             table_counts = {}
-            if not db.is_mutable or db.size < COUNT_DB_SIZE_LIMIT:
+            # Skip counts still being calculated by a lazy startup
+            if not db.counts_pending and (
+                not db.is_mutable or db.size < COUNT_DB_SIZE_LIMIT
+            ):
                 table_counts = await db.table_counts(10)
                 # If any of these are None it means at least one timed out - ignore them all
                 if any(v is None for v in table_counts.values()):
@@ -89,6 +92,7 @@ class IndexView(BaseView):
                     "tables_count": len(visible_tables),
                     "table_rows_sum": sum((t["count"] or 0) for t in visible_tables),
                     "show_table_row_counts": bool(table_counts),
+                    "counts_pending": db.counts_pending,
                     "hidden_table_rows_sum": sum(
                         t["count"] for t in hidden_tables if t["count"] is not None
                     ),
@@ -1,3 +1,4 @@
+import asyncio
 import json
 from datasette.utils.asgi import Response
 from .base import BaseView
@@ -13,12 +14,18 @@ class JsonDataView(BaseView):
 
     async def get(self, request, as_format):
         data = self.data_callback()
+        if asyncio.iscoroutine(data):
+            data = await data
+        return await self.render_data(request, as_format, data)
+
+    async def render_data(self, request, as_format, data, status=200):
         if as_format:
             headers = {}
             if self.ds.cors:
                 headers["Access-Control-Allow-Origin"] = "*"
             return Response(
                 json.dumps(data),
+                status=status,
                 content_type="application/json; charset=utf-8",
                 headers=headers,
             )
@@ -32,3 +39,13 @@ class JsonDataView(BaseView):
                     "data_json": json.dumps(data, indent=4),
                 },
             )
+
+
+class StatusView(JsonDataView):
+    "Like JsonDataView, but the JSON has a 503 status until startup is complete"
+
+    async def get(self, request, as_format):
+        data = self.data_callback()
+        return await self.render_data(
+            request, as_format, data, status=200 if data["ready"] else 503
+        )
@@ -1,3 +1,4 @@
+import asyncio
 import urllib
 import itertools
 import json
@@ -8,6 +9,7 @@ from datasette.plugins import pm
 from datasette.utils import (
     CustomRow,
     QueryInterrupted,
+    QueryRejected,
     RequestParameters,
     append_querystring,
     compound_keys_after_sql,
@@ -23,7 +25,7 @@ from datasette.utils import (
     urlsafe_components,
     value_as_boolean,
 )
-from datasette.utils.asgi import NotFound
+from datasette.utils.asgi import NotFound, child_cancellation
 from datasette.filters import Filters
 from .base import DataView, DatasetteError, ureg
 
@@ -427,6 +429,7 @@ class TableView(RowTableShared):
 
             order_by = "{} desc".format(escape_sqlite(sort_desc))
 
+        filtered = bool(where_clauses)
         from_sql = "from {table_name} {where}".format(
             table_name=escape_sqlite(table),
             where=("where {} ".format(" and ".join(where_clauses)))
@@ -549,8 +552,6 @@ class TableView(RowTableShared):
         if request.raw_args.get("_timelimit"):
             extra_args["custom_time_limit"] = int(request.raw_args["_timelimit"])
 
-        results = await db.execute(sql, params, truncate=True, **extra_args)
-
         # Number of filtered rows in whole set:
         filtered_table_rows_count = None
         if (
@@ -565,13 +566,6 @@ class TableView(RowTableShared):
             except KeyError:
                 pass
 
-        if count_sql and filtered_table_rows_count is None:
-            try:
-                count_rows = list(await db.execute(count_sql, from_sql_params))
-                filtered_table_rows_count = count_rows[0][0]
-            except QueryInterrupted:
-                pass
-
         # facets support
         if not self.ds.config("allow_facet") and any(
             arg.startswith("_facet") for arg in request.args
@@ -582,8 +576,12 @@ class TableView(RowTableShared):
         facet_classes = list(
             itertools.chain.from_iterable(pm.hook.register_facet_classes())
         )
-        facet_results = {}
-        facets_timed_out = []
+        # Facets count the whole filtered set of rows, so they leave out the
+        # sort order and the _next= position - that way every page and sort
+        # order of a filtered table shares the same facet cache entries
+        facet_sql = "select {select} {from_sql}".format(
+            select=select, from_sql=from_sql
+        ).rstrip()
         facet_instances = []
         for klass in facet_classes:
             facet_instances.append(
@@ -591,21 +589,82 @@ class TableView(RowTableShared):
                     self.ds,
                     request,
                     database,
-                    sql=sql_no_limit,
-                    params=params,
+                    sql=facet_sql,
+                    params=from_sql_params,
                     table=table,
                     metadata=table_metadata,
                     row_count=filtered_table_rows_count,
+                    unfiltered=not filtered,
                 )
             )
 
-        for facet in facet_instances:
-            (
-                instance_facet_results,
-                instance_facets_timed_out,
-            ) = await facet.facet_results()
+        # The count, facet and suggested facet queries do not depend on the
+        # main query, so they all run at the same time as it does
+        async def count_rows():
+            if not count_sql or filtered_table_rows_count is not None:
+                return filtered_table_rows_count
+            try:
+                count_results = await db.execute(
+                    count_sql, from_sql_params, priority="count"
+                )
+                return count_results.rows[0][0]
+            except (QueryInterrupted, QueryRejected):
+                return None
+
+        async def facet_results():
+            return await asyncio.gather(
+                *[facet.facet_results() for facet in facet_instances]
+            )
+
+        async def suggested_facets():
+            # Detect suggested facets
+            if (
+                not self.ds.config("suggest_facets")
+                or not self.ds.config("allow_facet")
+                or _next
+            ):
+                return []
+            # Suggestions compare distinct values against the row count
+            row_count = await count_task
+            for facet in facet_instances:
+                if facet.row_count is None:
+                    facet.row_count = row_count
+            return await asyncio.gather(*[facet.suggest() for facet in facet_instances])
+
+        # Their queries can be interrupted if the main query fails, as
+        # cancelling the tasks would leave them running in their threads
+        with child_cancellation() as optional_cancellation:
+            count_task = asyncio.ensure_future(count_rows())
+            optional_tasks = [
+                count_task,
+                asyncio.ensure_future(facet_results()),
+                asyncio.ensure_future(suggested_facets()),
+            ]
+
+        try:
+            results = await db.execute(sql, params, truncate=True, **extra_args)
+        except BaseException:
+            optional_cancellation.cancel()
+            for task in optional_tasks:
+                task.cancel()
+            await asyncio.gather(*optional_tasks, return_exceptions=True)
+            raise
+
+        (
+            filtered_table_rows_count,
+            all_facet_results,
+            all_suggested_facets,
+        ) = await asyncio.gather(*optional_tasks)
+
+        # Merged in the order of the facet classes
+        facet_results = {}
+        facets_timed_out = []
+        for instance_facet_results, instance_facets_timed_out in all_facet_results:
             facet_results.update(instance_facet_results)
             facets_timed_out.extend(instance_facets_timed_out)
+        suggested_facets = []
+        for instance_suggested_facets in all_suggested_facets:
+            suggested_facets.extend(instance_suggested_facets)
 
         # Figure out columns and rows for the query
         columns = [r[0] for r in results.description]
@@ -687,17 +746,6 @@ class TableView(RowTableShared):
             )
             rows = rows[:page_size]
 
-        # Detect suggested facets
-        suggested_facets = []
-
-        if (
-            self.ds.config("suggest_facets")
-            and self.ds.config("allow_facet")
-            and not _next
-        ):
-            for facet in facet_instances:
-                suggested_facets.extend(await facet.suggest())
-
         # human_description_en combines filters AND search, if provided
         human_description_en = filters.human_description_en(
             extra=extra_human_descriptions
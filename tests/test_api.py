@@ -17,9 +17,14 @@ from .fixtures import (  # noqa
     make_app_client,
     METADATA,
 )
+from datasette.cli import inspect_
+from datasette.database import Database
+from datasette.utils import sqlite3
+import asyncio
 import json
 import pytest
 import sys
+import threading
 import urllib
 
 
@@ -65,6 +70,7 @@ def test_database_page(app_client):
             "columns": ["content"],
             "primary_keys": [],
             "count": 0,
+            "count_exact": True,
             "hidden": False,
             "fts_table": None,
             "foreign_keys": {"incoming": [], "outgoing": []},
@@ -74,6 +80,7 @@ def test_database_page(app_client):
             "columns": ["pk", "content"],
             "primary_keys": ["pk"],
             "count": 0,
+            "count_exact": True,
             "hidden": False,
             "fts_table": None,
             "foreign_keys": {"incoming": [], "outgoing": []},
@@ -83,6 +90,7 @@ def test_database_page(app_client):
             "columns": ["pk", "name"],
             "primary_keys": ["pk"],
             "count": 2,
+            "count_exact": True,
             "hidden": False,
             "fts_table": None,
             "foreign_keys": {
@@ -101,6 +109,7 @@ def test_database_page(app_client):
             "columns": ["data"],
             "primary_keys": [],
             "count": 1,
+            "count_exact": True,
             "hidden": False,
             "fts_table": None,
             "foreign_keys": {"incoming": [], "outgoing": []},
@@ -110,6 +119,7 @@ def test_database_page(app_client):
             "columns": ["pk", "f1", "f2", "f3"],
             "primary_keys": ["pk"],
             "count": 1,
+            "count_exact": True,
             "hidden": False,
             "fts_table": None,
             "foreign_keys": {
@@ -138,6 +148,7 @@ def test_database_page(app_client):
             "columns": ["pk1", "pk2", "content"],
             "primary_keys": ["pk1", "pk2"],
             "count": 1,
+            "count_exact": True,
             "hidden": False,
             "fts_table": None,
             "foreign_keys": {"incoming": [], "outgoing": []},
@@ -147,6 +158,7 @@ def test_database_page(app_client):
             "columns": ["pk1", "pk2", "pk3", "content"],
             "primary_keys": ["pk1", "pk2", "pk3"],
             "count": 1001,
+            "count_exact": True,
             "hidden": False,
             "fts_table": None,
             "foreign_keys": {"incoming": [], "outgoing": []},
@@ -156,6 +168,7 @@ def test_database_page(app_client):
             "columns": ["pk", "foreign_key_with_custom_label"],
             "primary_keys": ["pk"],
             "count": 1,
+            "count_exact": True,
             "hidden": False,
             "fts_table": None,
             "foreign_keys": {
@@ -174,6 +187,7 @@ def test_database_page(app_client):
             "columns": ["id", "name"],
             "primary_keys": ["id"],
             "count": 4,
+            "count_exact": True,
             "hidden": False,
             "fts_table": None,
             "foreign_keys": {
@@ -203,6 +217,7 @@ def test_database_page(app_client):
             ],
             "primary_keys": ["pk"],
             "count": 15,
+            "count_exact": True,
             "hidden": False,
             "fts_table": None,
             "foreign_keys": {
@@ -221,6 +236,7 @@ def test_database_page(app_client):
             "columns": ["pk", "foreign_key_with_label", "foreign_key_with_no_label"],
             "primary_keys": ["pk"],
             "count": 2,
+            "count_exact": True,
             "hidden": False,
             "fts_table": None,
             "foreign_keys": {
@@ -244,6 +260,7 @@ def test_database_page(app_client):
             "columns": ["value"],
             "primary_keys": [],
             "count": 3,
+            "count_exact": True,
             "hidden": False,
             "fts_table": None,
             "foreign_keys": {"incoming": [], "outgoing": []},
@@ -253,6 +270,7 @@ def test_database_page(app_client):
             "columns": ["id", "content", "content2"],
             "primary_keys": ["id"],
             "count": 1,
+            "count_exact": True,
             "hidden": False,
             "fts_table": None,
             "foreign_keys": {
@@ -271,6 +289,7 @@ def test_database_page(app_client):
             "columns": ["id", "content", "content2"],
             "primary_keys": ["id"],
             "count": 1,
+            "count_exact": True,
             "hidden": False,
             "fts_table": None,
             "foreign_keys": {
@@ -289,6 +308,7 @@ def test_database_page(app_client):
             "columns": ["attraction_id", "characteristic_id"],
             "primary_keys": [],
             "count": 5,
+            "count_exact": True,
             "hidden": False,
             "fts_table": None,
             "foreign_keys": {
@@ -312,6 +332,7 @@ def test_database_page(app_client):
             "columns": ["pk", "name", "address", "latitude", "longitude"],
             "primary_keys": ["pk"],
             "count": 4,
+            "count_exact": True,
             "hidden": False,
             "fts_table": None,
             "foreign_keys": {
@@ -330,6 +351,7 @@ def test_database_page(app_client):
             "columns": ["pk", "text1", "text2", "name with . and spaces"],
             "primary_keys": ["pk"],
             "count": 2,
+            "count_exact": True,
             "hidden": False,
             "fts_table": "searchable_fts",
             "foreign_keys": {
@@ -348,6 +370,7 @@ def test_database_page(app_client):
             "columns": ["searchable_id", "tag"],
             "primary_keys": ["searchable_id", "tag"],
             "count": 2,
+            "count_exact": True,
             "hidden": False,
             "fts_table": None,
             "foreign_keys": {
@@ -367,6 +390,7 @@ def test_database_page(app_client):
             "columns": ["group", "having", "and", "json"],
             "primary_keys": [],
             "count": 1,
+            "count_exact": True,
             "hidden": False,
             "fts_table": None,
             "foreign_keys": {"incoming": [], "outgoing": []},
@@ -376,6 +400,7 @@ def test_database_page(app_client):
             "columns": ["id", "content"],
             "primary_keys": ["id"],
             "count": 4,
+            "count_exact": True,
             "hidden": False,
             "fts_table": None,
             "foreign_keys": {
@@ -417,6 +442,7 @@ def test_database_page(app_client):
             ],
             "primary_keys": ["pk1", "pk2"],
             "count": 201,
+            "count_exact": True,
             "hidden": False,
             "fts_table": None,
             "foreign_keys": {"incoming": [], "outgoing": []},
@@ -426,6 +452,7 @@ def test_database_page(app_client):
             "columns": ["pk", "content"],
             "primary_keys": ["pk"],
             "count": 1,
+            "count_exact": True,
             "hidden": False,
             "fts_table": None,
             "foreign_keys": {"incoming": [], "outgoing": []},
@@ -435,6 +462,7 @@ def test_database_page(app_client):
             "columns": ["tag"],
             "primary_keys": ["tag"],
             "count": 2,
+            "count_exact": True,
             "hidden": False,
             "fts_table": None,
             "foreign_keys": {
@@ -453,6 +481,7 @@ def test_database_page(app_client):
             "columns": ["pk", "distance", "frequency"],
             "primary_keys": ["pk"],
             "count": 3,
+            "count_exact": True,
             "hidden": False,
             "fts_table": None,
             "foreign_keys": {"incoming": [], "outgoing": []},
@@ -462,6 +491,7 @@ def test_database_page(app_client):
             "columns": ["content", "a", "b", "c"],
             "primary_keys": [],
             "count": 201,
+            "count_exact": True,
             "hidden": True,
             "fts_table": None,
             "foreign_keys": {"incoming": [], "outgoing": []},
@@ -471,6 +501,7 @@ def test_database_page(app_client):
             "columns": ["text1", "text2", "name with . and spaces", "content"],
             "primary_keys": [],
             "count": 2,
+            "count_exact": True,
             "hidden": True,
             "fts_table": "searchable_fts",
             "foreign_keys": {"incoming": [], "outgoing": []},
@@ -486,6 +517,7 @@ def test_database_page(app_client):
             ],
             "primary_keys": ["docid"],
             "count": 2,
+            "count_exact": True,
             "hidden": True,
             "fts_table": None,
             "foreign_keys": {"incoming": [], "outgoing": []},
@@ -502,6 +534,7 @@ def test_database_page(app_client):
             ],
             "primary_keys": ["level", "idx"],
             "count": 1,
+            "count_exact": True,
             "hidden": True,
             "fts_table": None,
             "foreign_keys": {"incoming": [], "outgoing": []},
@@ -511,6 +544,7 @@ def test_database_page(app_client):
             "columns": ["blockid", "block"],
             "primary_keys": ["blockid"],
             "count": 0,
+            "count_exact": True,
             "hidden": True,
             "fts_table": None,
             "foreign_keys": {"incoming": [], "outgoing": []},
@@ -529,6 +563,7 @@ def test_no_files_uses_memory_database(app_client_no_files):
             "hidden_tables_count": 0,
             "name": ":memory:",
             "show_table_row_counts": False,
+            "counts_pending": False,
             "path": "/:memory:",
             "table_rows_sum": 0,
             "tables_count": 0,
@@ -1235,11 +1270,14 @@ def test_databases_json(app_client_two_attached_databases_one_immutable):
     extra_database, fixtures_database = databases
     assert "extra database" == extra_database["name"]
     assert None == extra_database["hash"]
+    assert isinstance(extra_database["generation"], int)
+    assert extra_database["wal"] is None
     assert True == extra_database["is_mutable"]
     assert False == extra_database["is_memory"]
 
     assert "fixtures" == fixtures_database["name"]
     assert fixtures_database["hash"] is not None
+    assert 0 == fixtures_database["generation"]
     assert False == fixtures_database["is_mutable"]
     assert False == fixtures_database["is_memory"]
 
@@ -1251,10 +1289,54 @@ def test_metadata_json(app_client):
 
 def test_threads_json(app_client):
     response = app_client.get("/-/threads.json")
-    expected_keys = {"threads", "num_threads"}
+    expected_keys = {"threads", "num_threads", "databases"}
     if sys.version_info >= (3, 7, 0):
         expected_keys.update({"tasks", "num_tasks"})
     assert expected_keys == set(response.json.keys())
+    fixtures = response.json["databases"]["fixtures"]
+    assert "shared" == fixtures["executor"]
+    assert {"queued", "running", "wait_ms_total", "wait_ms_max"}.issubset(fixtures)
+
+
+def test_overloaded_database_returns_503():
+    for client in make_app_client(config={"max_sql_in_flight": 1}):
+        db = client.ds.databases["fixtures"]
+        release = threading.Event()
+        db.executor.submit(lambda: release.wait(5))
+        try:
+            response = client.get("/fixtures/facetable.json")
+        finally:
+            release.set()
+        assert 503 == response.status
+        assert "1" == response.headers["Retry-After"]
+        assert not response.json["ok"]
+        assert 1 == db.executor.stats()["rejected_in_flight"]
+
+
+def test_caches_json(app_client):
+    response = app_client.get("/-/caches.json")
+    assert {
+        "max_bytes": 0,
+        "bytes": 0,
+        "entries": 0,
+        "hits": 0,
+        "misses": 0,
+        "evictions": 0,
+    } == response.json["query"]
+    assert 0 == response.json["facet"]["max_bytes"]
+
+
+def test_status_json(app_client):
+    response = app_client.get("/-/status.json")
+    assert 200 == response.status
+    assert {
+        "ready": True,
+        "lazy_startup": False,
+        "databases_ready": 1,
+        "databases_total": 1,
+        "databases": {"fixtures": {"hash_ready": True, "counts_ready": True}},
+        "warmup": {"steps": [], "complete": True, "timings_ms": {}},
+    } == response.json
 
 
 def test_plugins_json(app_client):
@@ -1290,7 +1372,9 @@ def test_config_json(app_client):
         "default_page_size": 50,
         "default_facet_size": 30,
         "facet_suggest_time_limit_ms": 50,
+        "facet_suggest_sample_size": 1000,
         "facet_time_limit_ms": 200,
+        "facet_sample_size": 10000,
         "max_returned_rows": 100,
         "sql_time_limit_ms": 200,
         "allow_download": True,
@@ -1300,7 +1384,32 @@ def test_config_json(app_client):
         "default_cache_ttl": 5,
         "default_cache_ttl_hashed": 365 * 24 * 60 * 60,
         "num_sql_threads": 3,
+        "max_shared_sql_threads": 0,
+        "num_sql_connections": 0,
+        "sql_connection_idle_timeout": 0,
+        "num_sql_processes": 0,
+        "write_batch_size": 100,
+        "write_batch_window_ms": 0,
+        "wal_mode": False,
+        "wal_checkpoint_pages": 1000,
+        "wal_checkpoint_interval_ms": 1000,
+        "change_check_interval_ms": 500,
+        "max_sql_in_flight": 0,
+        "max_sql_queued": 0,
+        "sql_queue_timeout_ms": 0,
+        "sql_shed_queue_depth": 0,
+        "query_cache_kb": 0,
+        "facet_cache_kb": 0,
+        "hash_cache": False,
+        "dir_scan_interval_ms": 1000,
+        "warmup": "",
+        "fast_count_threshold": 0,
+        "lazy_startup": False,
         "cache_size_kb": 0,
+        "mmap_size_mb": 0,
+        "temp_store": "default",
+        "cached_statements": 0,
+        "sqlite_threads": 0,
         "allow_csv_stream": True,
         "max_csv_mb": 100,
         "truncate_cells_html": 2048,
@@ -1541,6 +1650,167 @@ def test_suggest_facets_off():
         assert [] == client.get("/fixtures/facetable.json").json["suggested_facets"]
 
 
+def test_facet_cache():
+    for client in make_app_client(config={"facet_cache_kb": 100}):
+        path = "/fixtures/facetable.json?_facet=state&_facet_date=created&state=CA"
+
+        def cached(path):
+            facet_results = client.get(path).json["facet_results"]
+            return {name: r.get("cached", False) for name, r in facet_results.items()}
+
+        assert {"state": False, "created": False} == cached(path)
+        first = client.get(path).json["facet_results"]
+        assert {"state": True, "created": True} == cached(path)
+        # Other sort orders and pages of the same filtered rows share the cache
+        assert {"state": True, "created": True} == cached(path + "&_sort=pk&_size=1")
+        next_path = (
+            client.get(path + "&_size=1")
+            .json["next_url"]
+            .replace("http://localhost", "")
+        )
+        assert {"state": True, "created": True} == cached(next_path)
+        next_results = client.get(next_path).json["facet_results"]
+        assert [(r["value"], r["count"]) for r in first["state"]["results"]] == [
+            (r["value"], r["count"]) for r in next_results["state"]["results"]
+        ]
+        # Different filters do not
+        assert {"state": False} == cached("/fixtures/facetable.json?_facet=state")
+        # ?_nocache=1 ignores the cache
+        assert {"state": False, "created": False} == cached(path + "&_nocache=1")
+        stats = client.get("/-/caches.json").json["facet"]
+        # Three facets plus suggested facets for two different filters
+        assert 5 == stats["entries"]
+        assert 24 == stats["hits"]
+
+
+def test_approximate_facets():
+    for client in make_app_client(config={"facet_sample_size": 5}):
+        path = "/fixtures/facetable.json?_facet=state&_facet_array=tags"
+        facet_results = client.get(path).json["facet_results"]
+        assert not any(r.get("approximate") for r in facet_results.values())
+        facet_results = client.get(path + "&_facet_approx=1").json["facet_results"]
+        for name in ("state", "tags"):
+            assert facet_results[name]["approximate"]
+            assert 0.333333 == facet_results[name]["sample_fraction"]
+        assert [("CA", 9, [3, 20]), ("MC", 3, [1, 9]), ("MI", 3, [1, 9])] == [
+            (r["value"], r["count"], r["count_range"])
+            for r in facet_results["state"]["results"]
+        ]
+        # Tables smaller than the sample are counted exactly
+        facet_results = client.get(
+            "/fixtures/facet_cities.json?_facet=name&_facet_approx=1"
+        ).json["facet_results"]
+        assert "approximate" not in facet_results["name"]
+
+
+def test_facets_from_inspect_column_stats(app_client, monkeypatch):
+    path = "/fixtures/facetable.json?_facet=state&_facet=city_id&_facet_date=created"
+    if detect_json1():
+        path += "&_facet_array=tags"
+    expected = app_client.get(path).json
+    # A fresh event loop, as earlier async tests may have closed the default one
+    loop = asyncio.new_event_loop()
+    try:
+        inspect_data = loop.run_until_complete(
+            inspect_([app_client.ds.databases["fixtures"].path], None, top_values=31)
+        )
+    finally:
+        loop.close()
+    # Inspect data is read back from JSON
+    inspect_data = json.loads(json.dumps(inspect_data))
+    state = inspect_data["fixtures"]["tables"]["facetable"]["column_stats"]["columns"][
+        "state"
+    ]
+    assert {
+        "distinct": 3,
+        "nulls": 0,
+        "values": [["CA", 10], ["MI", 4], ["MC", 1]],
+        "dates": False,
+        "arrays": False,
+    } == state
+    for client in make_app_client(inspect_data=inspect_data, is_immutable=True):
+        sqls = []
+        original_execute = Database.execute
+
+        async def execute(self, sql, *args, **kwargs):
+            sqls.append(sql)
+            return await original_execute(self, sql, *args, **kwargs)
+
+        monkeypatch.setattr(Database, "execute", execute)
+        data = client.get(path).json
+        assert expected["facet_results"] == data["facet_results"]
+        assert expected["suggested_facets"] == data["suggested_facets"]
+        assert not [sql for sql in sqls if "count(*)" in sql or "limit 1000" in sql]
+        # Filtered facets still need to query the table
+        client.get(path + "&state=CA")
+        assert [sql for sql in sqls if "count(*)" in sql]
+
+
+def _patch_table_queries(monkeypatch, main_query):
+    original_execute = Database.execute
+
+    async def execute(self, sql, *args, **kwargs):
+        priority = kwargs.get("priority") or "interactive"
+        if kwargs.get("truncate") and priority == "interactive":
+            return await main_query(original_execute(self, sql, *args, **kwargs))
+        return await original_execute(self, sql, *args, **kwargs)
+
+    monkeypatch.setattr(Database, "execute", execute)
+
+
+def test_table_queries_run_concurrently(app_client, monkeypatch):
+    events = []
+    original_execute = Database.execute
+
+    async def main_query(coro):
+        events.append("main started")
+        # Long enough for the other queries to start
+        await asyncio.sleep(0.2)
+        results = await coro
+        events.append("main finished")
+        return results
+
+    async def execute(self, sql, *args, **kwargs):
+        if kwargs.get("priority") == "count":
+            events.append("count started")
+        return await original_execute(self, sql, *args, **kwargs)
+
+    monkeypatch.setattr(Database, "execute", execute)
+    _patch_table_queries(monkeypatch, main_query)
+    response = app_client.get("/fixtures/facetable.json?_facet=state")
+    assert 200 == response.status
+    assert 15 == response.json["filtered_table_rows_count"]
+    assert ["state"] == list(response.json["facet_results"].keys())
+    assert "main started" == events[0]
+    assert events.index("count started") < events.index("main finished")
+
+
+def test_table_optional_queries_cancelled_if_main_query_fails(app_client, monkeypatch):
+    cancelled = []
+    original_execute = Database.execute
+
+    async def main_query(coro):
+        coro.close()
+        # Let the other queries start before failing
+        await asyncio.sleep(0.1)
+        raise sqlite3.OperationalError("main query failed")
+
+    async def execute(self, sql, *args, **kwargs):
+        if kwargs.get("priority") in ("count", "facet"):
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                cancelled.append(kwargs["priority"])
+                raise
+        return await original_execute(self, sql, *args, **kwargs)
+
+    monkeypatch.setattr(Database, "execute", execute)
+    _patch_table_queries(monkeypatch, main_query)
+    response = app_client.get("/fixtures/facetable.json?_facet=state")
+    assert 400 == response.status
+    assert ["count", "facet"] == sorted(cancelled)
+
+
 def test_expand_labels(app_client):
     response = app_client.get(
         "/fixtures/facetable.json?_shape=object&_labels=1&_size=2"
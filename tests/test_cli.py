@@ -19,6 +19,20 @@ def test_inspect_cli(app_client):
         "facetable": 15,
     }.items():
         assert expected_count == database["tables"][table_name]["count"]
+    searchable = database["tables"]["searchable"]
+    assert ["pk"] == searchable["primary_keys"]
+    assert "searchable_fts" == searchable["fts_table"]
+    assert not searchable["hidden"]
+    assert database["tables"]["searchable_fts"]["hidden"]
+    assert [
+        {"name": "sqlite_autoindex_compound_three_primary_keys_1", "sql": None},
+        {
+            "name": "idx_compound_three_primary_keys_content",
+            "sql": "CREATE INDEX idx_compound_three_primary_keys_content ON compound_three_primary_keys(content)",
+        },
+    ] == database["tables"]["compound_three_primary_keys"]["indexes"]
+    assert database["views"]["simple_view"]["sql"].startswith("CREATE VIEW")
+    assert 1 == database["schema"]["version"]
 
 
 def test_inspect_cli_writes_to_file(app_client):
@@ -1,5 +1,30 @@
-from .fixtures import app_client
+from .fixtures import app_client, TestClient
+from asgiref.testing import ApplicationCommunicator
+from datasette.app import Datasette
+from datasette.cli import inspect_
+from datasette.database import (
+    CheckpointScheduler,
+    ConnectionPool,
+    Database,
+    wal_frames,
+)
+from datasette.executor import QueryExecutor
+from datasette.inspect import inspect_hash
+from datasette.utils.asgi import (
+    AsgiCancelOnDisconnect,
+    RequestCancellation,
+    asgi_internal_get,
+    child_cancellation,
+)
+from datasette.utils import LRUCache, QueryInterrupted, QueryRejected, sqlite3
+import asyncio
+import hashlib
+import os
+from pathlib import Path
+from concurrent import futures
 import pytest
+import sys
+import threading
 import time
 import uuid
 
@@ -148,3 +173,1029 @@ async def test_execute_write_fn_exception(app_client):
 
     with pytest.raises(AssertionError):
         await db.execute_write_fn(write_fn, block=True)
+
+
+@pytest.mark.asyncio
+async def test_schema_catalog_is_reused(app_client):
+    db = app_client.ds.databases["fixtures"]
+    schema = await db.schema()
+    assert schema is await db.schema()
+    assert ["id", "content"] == await db.table_columns("simple_primary_key")
+    assert ["pk1", "pk2"] == await db.primary_keys("compound_primary_key")
+    assert "searchable_fts" == await db.fts_table("searchable")
+
+
+@pytest.mark.asyncio
+async def test_schema_catalog_reloads_on_schema_change(app_client):
+    db = app_client.ds.databases["fixtures"]
+    schema = await db.schema()
+    assert not await db.table_exists("schema_change")
+    await db.execute_write(
+        "create table schema_change (id integer primary key)", block=True
+    )
+    try:
+        assert await db.table_exists("schema_change")
+        assert schema is not await db.schema()
+        assert ["id"] == await db.primary_keys("schema_change")
+    finally:
+        await db.execute_write("drop table schema_change", block=True)
+    assert not await db.table_exists("schema_change")
+
+
+@pytest.mark.asyncio
+async def test_connection_pool_is_bounded(app_client):
+    db = app_client.ds.databases["fixtures"]
+    await db.prewarm()
+    for i in range(10):
+        await db.execute("select {}".format(i))
+    stats = db.pool.stats()
+    assert 3 == stats["size"]
+    assert 3 == stats["open"]
+    assert 0 == stats["in_use"]
+    assert stats["checkouts"] >= 10
+
+
+def test_connection_pool_evicts_idle_connections(app_client):
+    db = app_client.ds.databases["fixtures"]
+    pool = ConnectionPool(db, size=2, idle_timeout=0.01)
+    with pool.connection() as conn:
+        assert 1 == conn.execute("select 1").fetchone()[0]
+    assert 1 == pool.stats()["idle"]
+    time.sleep(0.02)
+    with pool.connection():
+        pass
+    stats = pool.stats()
+    assert 1 == stats["evicted"]
+    assert 2 == stats["created"]
+    assert 1 == stats["open"]
+
+
+def test_connection_pool_evicts_idle_connections_without_checkouts(app_client):
+    db = app_client.ds.databases["fixtures"]
+    pool = ConnectionPool(db, size=2, idle_timeout=0.01)
+    pool.prewarm()
+    assert 2 == pool.stats()["idle"]
+    deadline = time.monotonic() + 2
+    while pool.stats()["open"] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert {"open": 0, "idle": 0, "evicted": 2} == {
+        key: pool.stats()[key] for key in ("open", "idle", "evicted")
+    }
+    pool.close()
+
+
+def test_connection_pool_close(app_client):
+    db = app_client.ds.databases["fixtures"]
+    pool = ConnectionPool(db, size=2)
+    pool.prewarm()
+    assert 2 == pool.stats()["idle"]
+    with pool.connection() as conn:
+        pool.close()
+        assert {"open": 1, "in_use": 1, "idle": 0} == {
+            key: pool.stats()[key] for key in ("open", "in_use", "idle")
+        }
+    assert 0 == pool.stats()["open"]
+
+
+def test_remove_database_closes_pool(app_client):
+    ds = app_client.ds
+    db = Database(ds, is_memory=True, is_mutable=True)
+    ds.add_database("removable", db)
+    db.pool.prewarm()
+    assert 3 == db.pool.stats()["open"]
+    ds.remove_database("removable")
+    assert 0 == db.pool.stats()["open"]
+
+
+def _make_database_file(path):
+    conn = sqlite3.connect(str(path))
+    conn.execute("create table t (id integer primary key)")
+    conn.commit()
+    conn.close()
+    return str(path)
+
+
+def test_process_worker_reopens_replaced_file(tmp_path):
+    from datasette import executor
+
+    executor.init_process_worker({}, {}, None, None)
+    path = _make_database_file(tmp_path / "replaced.db")
+    _, rows, _ = executor.execute_in_process(
+        path, "replaced", "select count(*) from sqlite_master", None, 1000, None
+    )
+    assert [(1,)] == rows
+    replacement = _make_database_file(tmp_path / "replacement.db")
+    conn = sqlite3.connect(replacement)
+    conn.execute("create table t2 (id integer primary key)")
+    conn.commit()
+    conn.close()
+    os.replace(replacement, path)
+    _, rows, _ = executor.execute_in_process(
+        path, "replaced", "select count(*) from sqlite_master", None, 1000, None
+    )
+    assert [(2,)] == rows
+    executor._worker_connections.pop(path)[1].close()
+
+
+@pytest.mark.asyncio
+async def test_database_config_dedicated_executor(tmp_path):
+    archive = _make_database_file(tmp_path / "archive.db")
+    hot = _make_database_file(tmp_path / "hot.db")
+    ds = Datasette(
+        [archive, hot],
+        metadata={"databases": {"archive": {"config": {"num_sql_threads": 2}}}},
+    )
+    archive_db = ds.databases["archive"]
+    hot_db = ds.databases["hot"]
+    assert archive_db.executor.dedicated
+    assert 2 == archive_db.pool.size
+    assert not hot_db.executor.dedicated
+    assert 3 == hot_db.pool.size
+    assert [(0,)] == [tuple(r) for r in await archive_db.execute("select 0")]
+    assert "dedicated" == ds.threads()["databases"]["archive"]["executor"]
+    assert 1 == ds.threads()["databases"]["archive"]["completed"]
+
+
+@pytest.mark.asyncio
+async def test_max_shared_sql_threads(tmp_path):
+    ds = Datasette(
+        [_make_database_file(tmp_path / "limited.db")],
+        config={"max_shared_sql_threads": 1},
+    )
+    db = ds.databases["limited"]
+    running = []
+    max_running = 0
+    lock = threading.Lock()
+
+    def fn(conn):
+        nonlocal max_running
+        with lock:
+            running.append(1)
+            max_running = max(max_running, len(running))
+        time.sleep(0.02)
+        with lock:
+            running.pop()
+
+    await asyncio.gather(
+        *[db.execute_against_connection_in_thread(fn) for _ in range(4)]
+    )
+    assert 1 == max_running
+    assert 4 == db.executor.stats()["completed"]
+    assert 0 == db.executor.stats()["queued"]
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason="Requires Python 3.7+")
+@pytest.mark.asyncio
+async def test_num_sql_processes(tmp_path):
+    immutable = _make_database_file(tmp_path / "immutable.db")
+    mutable = _make_database_file(tmp_path / "mutable.db")
+    ds = Datasette(
+        [mutable],
+        immutables=[immutable],
+        config={"num_sql_processes": 1, "max_returned_rows": 2},
+    )
+    try:
+        assert ds.databases["immutable"].uses_processes
+        assert not ds.databases["mutable"].uses_processes
+        results = await ds.execute(
+            "immutable", "select 1 as One, 'two' as two union all select 2, 'three'",
+        )
+        assert ["One", "two"] == results.columns
+        assert [(1, "two"), (2, "three")] == [tuple(row) for row in results.rows]
+        first = results.rows[0]
+        assert 1 == first["one"] == first["One"] == first[0]
+        assert ["One", "two"] == first.keys()
+        # Positional and named parameters are both passed through
+        results = await ds.execute("immutable", "select ?, ?", [1, "two"])
+        assert [(1, "two")] == [tuple(row) for row in results.rows]
+        results = await ds.execute("immutable", "select :one", {"one": 1})
+        assert [(1,)] == [tuple(row) for row in results.rows]
+        # Truncation still applies
+        results = await ds.execute(
+            "immutable",
+            "select 1 union all select 2 union all select 3",
+            truncate=True,
+        )
+        assert results.truncated
+        assert 2 == len(results.rows)
+        with pytest.raises(QueryInterrupted):
+            await ds.execute(
+                "immutable",
+                "with recursive c(x) as (select 1 union all select x + 1 from c) "
+                "select count(*) from c",
+                custom_time_limit=10,
+            )
+    finally:
+        ds.process_executor.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_execute_write_batches_queued_writes(tmp_path):
+    ds = Datasette([_make_database_file(tmp_path / "batched.db")])
+    db = ds.databases["batched"]
+    await db.execute_write(
+        "create table batched (id integer primary key, value text)", block=True
+    )
+    started = threading.Event()
+
+    def slow(conn):
+        started.set()
+        time.sleep(0.1)
+
+    def insert(value):
+        def fn(conn):
+            with conn:
+                conn.execute("insert into batched (value) values (?)", [value])
+            return value
+
+        return fn
+
+    def insert_then_fail(conn):
+        conn.execute("insert into batched (value) values ('bad')")
+        raise ValueError("bad write")
+
+    await db.execute_write_fn(slow)
+    # The rest queue up behind slow() and get committed as one batch
+    await asyncio.get_event_loop().run_in_executor(None, started.wait)
+    await db.execute_write_fn(insert("one"))
+    await db.execute_write_fn(insert_then_fail)
+    assert "two" == await db.execute_write_fn(insert("two"), block=True)
+    rows = await db.execute("select value from batched order by id")
+    assert ["one", "two"] == [row[0] for row in rows]
+
+
+@pytest.mark.asyncio
+async def test_execute_write_fn_can_end_its_transaction(tmp_path):
+    ds = Datasette([_make_database_file(tmp_path / "ended.db")])
+    db = ds.databases["ended"]
+    await db.execute_write(
+        "create table t2 (id integer primary key, value text)", block=True
+    )
+
+    def leaves_transaction_open(conn):
+        conn.execute("insert into t2 (value) values ('open')")
+        return "open"
+
+    def ends_transaction(conn):
+        conn.execute("insert into t2 (value) values ('ended')")
+        conn.execute("commit")
+        return "ended"
+
+    def runs_script(conn):
+        conn.executescript("insert into t2 (value) values ('script');")
+        return "script"
+
+    assert "open" == await db.execute_write_fn(leaves_transaction_open, block=True)
+    assert "ended" == await db.execute_write_fn(ends_transaction, block=True)
+    assert "script" == await db.execute_write_fn(runs_script, block=True)
+    # And the same again as part of a batch
+    started = threading.Event()
+
+    def slow(conn):
+        started.set()
+        time.sleep(0.1)
+
+    await db.execute_write_fn(slow)
+    await asyncio.get_event_loop().run_in_executor(None, started.wait)
+    await db.execute_write_fn(ends_transaction)
+    await db.execute_write_fn(runs_script)
+    assert "open" == await db.execute_write_fn(leaves_transaction_open, block=True)
+    rows = await db.execute("select value from t2 order by id")
+    assert ["open", "ended", "script", "ended", "script", "open"] == [
+        row[0] for row in rows
+    ]
+
+
+@pytest.mark.asyncio
+async def test_execute_stream(app_client):
+    db = app_client.ds.databases["fixtures"]
+    batches = []
+    async for rows in db.execute_stream(
+        "select pk, state from facetable order by pk", batch_size=4
+    ):
+        batches.append(rows)
+    assert [4, 4, 4, 3] == [len(rows) for rows in batches]
+    assert list(range(1, 16)) == [row["pk"] for rows in batches for row in rows]
+    assert 0 == db.pool.stats()["in_use"]
+
+
+@pytest.mark.asyncio
+async def test_execute_stream_does_not_hold_pooled_connections(tmp_path):
+    ds = Datasette(
+        [_make_database_file(tmp_path / "streamed.db")],
+        config={"num_sql_threads": 1, "num_sql_connections": 1},
+    )
+    db = ds.databases["streamed"]
+    streams = [
+        db.execute_stream(
+            "with recursive c(x) as (select 1 union all select x + 1 from c "
+            "limit 10) select x from c",
+            batch_size=1,
+        )
+        for _ in range(3)
+    ]
+    for stream in streams:
+        await stream.__anext__()
+    assert 0 == db.pool.stats()["in_use"]
+    # Paused streams cannot block other queries
+    results = await asyncio.wait_for(db.execute("select 1"), timeout=5)
+    assert [(1,)] == [tuple(row) for row in results.rows]
+    for stream in streams:
+        await stream.aclose()
+
+
+@pytest.mark.asyncio
+async def test_execute_stream_time_limit(app_client):
+    db = app_client.ds.databases["fixtures"]
+    with pytest.raises(QueryInterrupted):
+        async for rows in db.execute_stream(
+            "with recursive c(x) as (select 1 union all select x + 1 from c) "
+            "select count(*) from c",
+            custom_time_limit=10,
+        ):
+            pass
+
+
+@pytest.mark.asyncio
+async def test_query_cache(tmp_path):
+    path = _make_database_file(tmp_path / "cached.db")
+    conn = sqlite3.connect(path)
+    conn.execute("create table private (id integer primary key)")
+    conn.execute("create view private_view as select * from [private]")
+    conn.execute("create view nested_view as select * from private_view")
+    conn.execute("create table private_notes (id integer primary key)")
+    conn.close()
+    ds = Datasette(
+        [],
+        immutables=[path],
+        config={"query_cache_kb": 100},
+        metadata={
+            "databases": {"cached": {"tables": {"private": {"query_cache": False}}}}
+        },
+    )
+    cache = ds.query_cache
+    await ds.execute("cached", "select :v as v", {"v": 1})
+    results = await ds.execute("cached", "select :v as v", {"v": 1})
+    assert [1] == [row["v"] for row in results]
+    assert 1 == cache.hits
+    assert 1 == cache.misses
+    # Different parameters are cached separately
+    results = await ds.execute("cached", "select :v as v", {"v": 2})
+    assert [2] == [row["v"] for row in results]
+    assert 2 == cache.misses
+    # Tables opted out in metadata are never cached
+    await ds.execute("cached", "select * from private")
+    await ds.execute("cached", "select * from private")
+    assert 2 == len(cache)
+    assert 1 == cache.hits
+    # ... including through views that read from them
+    await ds.execute("cached", 'select * from "Nested_View"')
+    assert 2 == len(cache)
+    # Only whole names count - not other names or strings containing them
+    await ds.execute("cached", "select * from private_notes")
+    await ds.execute("cached", "select 'private' as v")
+    assert 4 == len(cache)
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(max_bytes=100)
+    cache.set("a", 1, 40)
+    cache.set("b", 2, 40)
+    assert 1 == cache.get("a")
+    cache.set("c", 3, 40)
+    assert cache.get("b") is None
+    assert 1 == cache.get("a")
+    assert 3 == cache.get("c")
+    assert 80 == cache.num_bytes
+    assert 1 == cache.evictions
+    # Values larger than the whole budget are not stored
+    cache.set("d", 4, 101)
+    assert cache.get("d") is None
+
+
+@pytest.mark.asyncio
+async def test_change_monitor_detects_external_writes(tmp_path):
+    path = _make_database_file(tmp_path / "monitored.db")
+    ds = Datasette([path], config={"change_check_interval_ms": 0})
+    db = ds.databases["monitored"]
+    generation = await db.current_generation()
+    assert generation == await db.current_generation()
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute("insert into t default values")
+    assert await db.current_generation() > generation
+    generation = await db.current_generation()
+    # Writes made through Datasette count too
+    await db.execute_write("insert into t default values", block=True)
+    assert await db.current_generation() > generation
+
+
+@pytest.mark.asyncio
+async def test_change_monitor_interval(tmp_path):
+    path = _make_database_file(tmp_path / "monitored.db")
+    ds = Datasette([path], config={"change_check_interval_ms": 60 * 1000})
+    db = ds.databases["monitored"]
+    generation = await db.current_generation()
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute("insert into t default values")
+    # Not checked again until the interval has passed
+    assert generation == await db.current_generation()
+    assert generation < db.changes.check(force=True)
+
+
+@pytest.mark.asyncio
+async def test_table_counts_retries_timed_out_counts_with_longer_limit(tmp_path):
+    ds = Datasette([_make_database_file(tmp_path / "counted.db")])
+    db = ds.databases["counted"]
+    limits = []
+
+    async def count_table(table, limit, threshold, has_stat1):
+        limits.append(limit)
+        return (None if limit < 100 else 0), True
+
+    db._count_table = count_table
+    assert {"t": None} == await db.table_counts(10)
+    assert {"t": None} == await db.table_counts(10)
+    assert [10] == limits
+    # A longer time limit tries again, and its complete counts are reused
+    assert {"t": 0} == await db.table_counts(1000)
+    assert {"t": 0} == await db.table_counts(10)
+    assert [10, 1000] == limits
+
+
+@pytest.mark.asyncio
+async def test_table_counts_respect_admission_limits(tmp_path):
+    path = _make_database_file(tmp_path / "many.db")
+    conn = sqlite3.connect(path)
+    for i in range(20):
+        conn.execute("create table t{} (id integer primary key)".format(i))
+    conn.close()
+    ds = Datasette(
+        [path],
+        config={"num_sql_threads": 2, "max_sql_in_flight": 2, "max_sql_queued": 1},
+    )
+    db = ds.databases["many"]
+    counts = await db.table_counts(1000)
+    assert 21 == len(counts)
+    assert all(count == 0 for count in counts.values())
+    stats = db.executor.stats()
+    assert 0 == stats["rejected_in_flight"] == stats["rejected_queued"]
+
+
+@pytest.mark.asyncio
+async def test_table_counts_rejected_are_not_cached(tmp_path):
+    ds = Datasette([_make_database_file(tmp_path / "counted.db")])
+    db = ds.databases["counted"]
+    calls = []
+
+    async def count_table(table, limit, threshold, has_stat1):
+        calls.append(table)
+        if len(calls) == 1:
+            raise QueryRejected("busy")
+        return 0, True
+
+    db._count_table = count_table
+    assert {"t": None} == await db.table_counts(10)
+    assert {"t": 0} == await db.table_counts(10)
+    assert {"t": 0} == await db.table_counts(10)
+    assert 2 == len(calls)
+
+
+@pytest.mark.asyncio
+async def test_query_cache_mutable_database(tmp_path):
+    path = _make_database_file(tmp_path / "mutable.db")
+    ds = Datasette([path], config={"query_cache_kb": 100})
+    db = ds.databases["mutable"]
+    assert 0 == (await db.execute("select count(*) from t")).rows[0][0]
+    assert 0 == (await db.execute("select count(*) from t")).rows[0][0]
+    assert 1 == ds.query_cache.hits
+    await db.execute_write("insert into t default values", block=True)
+    assert 1 == (await db.execute("select count(*) from t")).rows[0][0]
+    assert 2 == ds.query_cache.misses
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason="Requires Python 3.7+")
+@pytest.mark.asyncio
+async def test_client_disconnect_interrupts_query(tmp_path):
+    ds = Datasette(
+        [_make_database_file(tmp_path / "slow.db")],
+        config={"sql_time_limit_ms": 20 * 1000},
+    )
+    db = ds.databases["slow"]
+    errors = []
+
+    async def app(scope, receive, send):
+        try:
+            await db.execute(
+                "with recursive c(x) as (select 1 union all select x + 1 from c) "
+                "select count(*) from c"
+            )
+        except QueryInterrupted as e:
+            errors.append(e)
+
+    sent_request = False
+
+    async def receive():
+        nonlocal sent_request
+        if not sent_request:
+            sent_request = True
+            return {"type": "http.request"}
+        await asyncio.sleep(0.1)
+        return {"type": "http.disconnect"}
+
+    start = time.monotonic()
+    await AsgiCancelOnDisconnect(app)({"type": "http"}, receive, None)
+    assert 1 == len(errors)
+    assert time.monotonic() - start < 5
+    # The interrupted connection is back in the pool and still works
+    assert [(1,)] == [tuple(row) for row in await db.execute("select 1")]
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason="Requires Python 3.7+")
+@pytest.mark.asyncio
+async def test_child_cancellation_interrupts_queries_from_its_tasks(tmp_path):
+    ds = Datasette(
+        [_make_database_file(tmp_path / "slow.db")],
+        config={"sql_time_limit_ms": 20 * 1000},
+    )
+    db = ds.databases["slow"]
+    slow_sql = (
+        "with recursive c(x) as (select 1 union all select x + 1 from c) "
+        "select count(*) from c"
+    )
+    with child_cancellation() as cancellation:
+        task = asyncio.ensure_future(db.execute(slow_sql))
+    await asyncio.sleep(0.1)
+    start = time.monotonic()
+    cancellation.cancel()
+    with pytest.raises(QueryInterrupted):
+        await task
+    assert time.monotonic() - start < 5
+    # Queries started outside the block are unaffected
+    assert [(1,)] == [tuple(row) for row in await db.execute("select 1")]
+    # Cancelling the parent cancels its children
+    parent = RequestCancellation()
+    child = RequestCancellation()
+    parent.add_child(child)
+    parent.cancel()
+    assert child.cancelled
+
+
+def test_query_executor_admission_control():
+    executor = QueryExecutor(
+        futures.ThreadPoolExecutor(max_workers=1),
+        num_threads=1,
+        dedicated=True,
+        name="busy",
+        max_queued=1,
+        queue_timeout_ms=50,
+    )
+    release = threading.Event()
+    running = executor.submit(lambda: release.wait(5))
+    waiting = executor.submit(lambda: "ran")
+    # Only one query is allowed to wait for a thread
+    with pytest.raises(QueryRejected):
+        executor.submit(lambda: "rejected")
+    time.sleep(0.1)
+    release.set()
+    assert running.result()
+    # The waiting query waited longer than queue_timeout_ms
+    with pytest.raises(QueryRejected) as e:
+        waiting.result()
+    assert "busy" in str(e.value)
+    # Rejected queries never ran, so they are not mistaken for slow ones
+    assert not isinstance(e.value, QueryInterrupted)
+    stats = executor.stats()
+    assert 1 == stats["rejected_queued"]
+    assert 1 == stats["rejected_wait"]
+    assert 0 == stats["rejected_in_flight"]
+    assert "ran" == executor.submit(lambda: "ran").result()
+    executor.shutdown()
+
+
+def test_query_executor_priorities():
+    executor = QueryExecutor(
+        futures.ThreadPoolExecutor(max_workers=1),
+        num_threads=1,
+        dedicated=True,
+        shed_queue_depth=3,
+    )
+    release = threading.Event()
+    order = []
+    blocker = executor.submit(lambda: release.wait(5))
+    submitted = [
+        executor.submit(lambda: order.append("suggest"), priority="suggest"),
+        executor.submit(lambda: order.append("facet"), priority="facet"),
+        executor.submit(lambda: order.append("count"), priority="count"),
+        executor.submit(lambda: order.append("interactive")),
+    ]
+    # Three queries are now waiting, so suggestions are dropped
+    with pytest.raises(QueryRejected):
+        executor.submit(lambda: None, priority="suggest")
+    release.set()
+    blocker.result()
+    for future in submitted:
+        future.result()
+    assert ["interactive", "count", "facet", "suggest"] == order
+    assert 1 == executor.stats()["rejected_low_priority"]
+    executor.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_wal_mode(tmp_path):
+    path = _make_database_file(tmp_path / "wal.db")
+    ds = Datasette(
+        [path],
+        config={
+            "wal_mode": True,
+            "wal_checkpoint_pages": 1,
+            "wal_checkpoint_interval_ms": 10,
+        },
+    )
+    db = ds.databases["wal"]
+    assert db.wal_stats() is None
+    await db.execute_write("insert into t default values", block=True)
+    conn = sqlite3.connect(path)
+    assert "wal" == conn.execute("PRAGMA journal_mode").fetchone()[0]
+    conn.close()
+    for _ in range(100):
+        stats = db.wal_stats()
+        if stats["checkpoints"]:
+            break
+        await asyncio.sleep(0.02)
+    assert stats["size"] > 0
+    assert stats["checkpoints"] >= 1
+    assert stats["pages_checkpointed"] >= 1
+    assert 1 == (await db.execute("select count(*) from t")).rows[0][0]
+    ds.remove_database("wal")
+
+
+def test_wal_frames_counts_frames_since_restart(tmp_path):
+    path = str(tmp_path / "frames.db")
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=wal")
+    conn.execute("PRAGMA wal_autocheckpoint=0")
+    conn.execute("create table t (value text)")
+    for _ in range(20):
+        conn.execute("insert into t values (randomblob(5000))")
+    salts, frames = wal_frames(path + "-wal")
+    scheduler = CheckpointScheduler(None, pages=5)
+    _, log, checkpointed = scheduler.checkpoint(conn)
+    assert frames == log == checkpointed
+    scheduler._checkpointed = (salts, checkpointed)
+    assert 0 == scheduler.pending_frames(salts, frames)
+    size = os.stat(path + "-wal").st_size
+    # The next write restarts the WAL, which keeps its size
+    conn.execute("insert into t values ('small')")
+    new_salts, new_frames = wal_frames(path + "-wal")
+    assert size == os.stat(path + "-wal").st_size
+    assert new_salts != salts
+    assert new_frames < 5 == scheduler.pages
+    assert new_frames == scheduler.pending_frames(new_salts, new_frames)
+    conn.close()
+
+
+@pytest.mark.asyncio
+async def test_sqlite_tuning(tmp_path):
+    ds = Datasette(
+        [
+            _make_database_file(tmp_path / "tuned.db"),
+            _make_database_file(tmp_path / "untuned.db"),
+        ],
+        metadata={
+            "databases": {
+                "tuned": {
+                    "config": {
+                        "mmap_size_mb": 1,
+                        "cache_size_kb": 4000,
+                        "temp_store": "memory",
+                        "cached_statements": 500,
+                        "sqlite_threads": 2,
+                    }
+                }
+            }
+        },
+    )
+    tuned = ds.databases["tuned"]
+    assert [(-4000,)] == [tuple(r) for r in await tuned.execute("PRAGMA cache_size")]
+    assert {
+        "mmap_size": 1024 * 1024,
+        "cache_size": -4000,
+        "temp_store": "memory",
+        "threads": 2,
+        "cached_statements": 500,
+    } == tuned.tuning
+    untuned = ds.databases["untuned"]
+    await untuned.execute("select 1")
+    assert "default" == untuned.tuning["temp_store"]
+    assert None == untuned.tuning["cached_statements"]
+    databases = {d["name"]: d for d in await ds.connected_databases()}
+    assert tuned.tuning == databases["tuned"]["tuning"]
+
+
+def test_inspect_hash(tmp_path):
+    empty = tmp_path / "empty.db"
+    empty.write_bytes(b"")
+    assert hashlib.sha256(b"").hexdigest() == inspect_hash(empty)
+    path = Path(_make_database_file(tmp_path / "data.db"))
+    assert hashlib.sha256(path.read_bytes()).hexdigest() == inspect_hash(path)
+
+
+def test_hash_cache_sidecar(tmp_path, monkeypatch):
+    path = _make_database_file(tmp_path / "hashed.db")
+    # Nothing is written next to the database unless asked for
+    expected = Datasette([], immutables=[path]).databases["hashed"].hash
+    assert not (tmp_path / "hashed.db.datasette-hash").exists()
+    config = {"hash_cache": True}
+    assert (
+        expected
+        == Datasette([], immutables=[path], config=config).databases["hashed"].hash
+    )
+    assert (tmp_path / "hashed.db.datasette-hash").exists()
+
+    def fail(path):
+        assert False, "Should have used the cached hash"
+
+    monkeypatch.setattr("datasette.database.inspect_hash", fail)
+    assert (
+        expected
+        == Datasette([], immutables=[path], config=config).databases["hashed"].hash
+    )
+    # Changing the file invalidates the cached hash
+    conn = sqlite3.connect(path)
+    conn.execute("create table another (id integer primary key)")
+    conn.close()
+    with pytest.raises(AssertionError):
+        Datasette([], immutables=[path], config=config)
+
+
+def test_hash_from_inspect_data(tmp_path, monkeypatch):
+    path = _make_database_file(tmp_path / "inspected.db")
+    monkeypatch.setattr("datasette.database.inspect_hash", lambda path: "computed")
+    size = Path(path).stat().st_size
+    ds = Datasette(
+        [],
+        immutables=[path],
+        inspect_data={"inspected": {"hash": "fromfile", "size": size, "tables": {}}},
+        config={"hash_cache": False},
+    )
+    assert "fromfile" == ds.databases["inspected"].hash
+    # Ignored if the size no longer matches
+    ds = Datasette(
+        [],
+        immutables=[path],
+        inspect_data={"inspected": {"hash": "fromfile", "size": 1, "tables": {}}},
+        config={"hash_cache": False},
+    )
+    assert "computed" == ds.databases["inspected"].hash
+    assert not (tmp_path / "inspected.db.datasette-hash").exists()
+
+
+@pytest.mark.asyncio
+async def test_schema_from_inspect_data(app_client, monkeypatch):
+    path = app_client.ds.databases["fixtures"].path
+    inspect_data = await inspect_([path], [])
+    db = app_client.ds.databases["fixtures"]
+
+    def fail(*args):
+        assert False, "Should not introspect the database"
+
+    monkeypatch.setattr("datasette.database.SchemaCatalog.load", fail)
+    ds = Datasette(
+        [],
+        immutables=[path],
+        inspect_data=inspect_data,
+        metadata=app_client.ds._metadata,
+    )
+    inspected = ds.databases["fixtures"]
+    assert await db.table_names() == await inspected.table_names()
+    assert await db.view_names() == await inspected.view_names()
+    assert await db.get_all_foreign_keys() == await inspected.get_all_foreign_keys()
+    assert await db.hidden_table_names() == await inspected.hidden_table_names()
+    assert await db.primary_keys("compound_three_primary_keys") == (
+        await inspected.primary_keys("compound_three_primary_keys")
+    )
+    assert await db.get_table_definition("searchable") == (
+        await inspected.get_table_definition("searchable")
+    )
+    # Snapshots from another version of the format are ignored
+    inspect_data["fixtures"]["schema"]["version"] = 0
+    ds = Datasette([], immutables=[path], inspect_data=inspect_data)
+    with pytest.raises(AssertionError):
+        await ds.databases["fixtures"].table_names()
+
+
+@pytest.mark.asyncio
+async def test_lazy_startup(tmp_path, monkeypatch):
+    path = _make_database_file(tmp_path / "lazy.db")
+    hashing = threading.Event()
+    monkeypatch.setattr(
+        "datasette.database.inspect_hash", lambda path: hashing.wait(5) and "abc123"
+    )
+    ds = Datasette(
+        [],
+        immutables=[path],
+        config={"lazy_startup": True, "hash_urls": True, "hash_cache": False},
+    )
+    db = ds.databases["lazy"]
+    assert db.hash is None
+    app = ds.app()
+    lifespan = ApplicationCommunicator(app, {"type": "lifespan"})
+    await lifespan.send_input({"type": "lifespan.startup"})
+    assert {"type": "lifespan.startup.complete"} == await lifespan.receive_output(2)
+    client = TestClient(app)
+    response = await client._get("/-/status.json")
+    assert 503 == response.status
+    assert not response.json["ready"]
+    assert {"hash_ready": False, "counts_ready": False} == response.json["databases"][
+        "lazy"
+    ]
+    # No redirect to a hashed URL until the hash is ready
+    assert 200 == (await client._get("/lazy/t.json")).status
+    index = await client._get("/.json")
+    assert index.json["lazy"]["counts_pending"]
+    hashing.set()
+    await asyncio.gather(*ds._startup_tasks)
+    response = await client._get("/-/status.json")
+    assert 200 == response.status
+    assert response.json["ready"]
+    assert {"t": 0} == db.cached_table_counts
+    response = await client._get("/lazy/t.json", allow_redirects=False)
+    assert 302 == response.status
+    assert "/lazy-abc123/t.json" == response.headers["Location"]
+    await lifespan.send_input({"type": "lifespan.shutdown"})
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("lazy_startup", (False, True))
+async def test_warmup(tmp_path, monkeypatch, lazy_startup):
+    path = _make_database_file(tmp_path / "warm.db")
+    ds = Datasette(
+        [],
+        immutables=[path],
+        metadata={
+            "databases": {
+                "warm": {"queries": {"one": "select * from t where id = :id"}}
+            }
+        },
+        config={
+            "warmup": "read, madvise,queries,pages,unknown",
+            "lazy_startup": lazy_startup,
+            "query_cache_kb": 100,
+            "hash_cache": False,
+        },
+    )
+    rendered = []
+
+    async def internal_get(app, path):
+        status = await asgi_internal_get(app, path)
+        rendered.append((path, status))
+        return status
+
+    monkeypatch.setattr("datasette.app.asgi_internal_get", internal_get)
+    app = ds.app()
+    lifespan = ApplicationCommunicator(app, {"type": "lifespan"})
+    client = TestClient(app)
+    assert 503 == (await client._get("/-/status.json")).status
+    await lifespan.send_input({"type": "lifespan.startup"})
+    assert {"type": "lifespan.startup.complete"} == await lifespan.receive_output(2)
+    await asyncio.gather(*ds._startup_tasks)
+    response = await client._get("/-/status.json")
+    assert 200 == response.status
+    warmup = response.json["warmup"]
+    assert ["read", "madvise", "queries", "pages"] == warmup["steps"]
+    assert warmup["complete"]
+    assert set(warmup["steps"]) == set(warmup["timings_ms"])
+    assert [("/", 200), ("/warm", 200)] == rendered
+    # The canned query result is now in the query cache
+    await ds.execute(
+        "warm", "select * from t where id = :id", {"id": ""}, truncate=True
+    )
+    assert 1 == ds.query_cache.stats()["hits"]
+    await lifespan.send_input({"type": "lifespan.shutdown"})
+
+
+@pytest.mark.asyncio
+async def test_directory_watcher(tmp_path):
+    _make_database_file(tmp_path / "a.db")
+    ds = Datasette([], watch_dirs=[str(tmp_path)])
+    watcher = ds.directory_watcher
+    assert ["a"] == list(ds.databases.keys())
+    old_a = ds.databases["a"]
+    # A new file is attached once it has stopped changing
+    _make_database_file(tmp_path / "b.db")
+    await watcher.check()
+    assert "b" not in ds.databases
+    await watcher.check()
+    assert {"t": 0} == ds.databases["b"].cached_table_counts
+    # A replaced file is swapped for a new Database - the old one drains
+    in_flight = old_a.pool.checkout()
+    replacement = tmp_path / "a.db.new"
+    conn = sqlite3.connect(str(replacement))
+    conn.execute("create table replaced (id integer primary key)")
+    conn.commit()
+    conn.close()
+    os.replace(str(replacement), str(tmp_path / "a.db"))
+    await watcher.check()
+    await watcher.check()
+    new_a = ds.databases["a"]
+    assert new_a is not old_a
+    assert ["replaced"] == await new_a.table_names()
+    assert new_a.hash != old_a.hash
+    assert [(0,)] == [tuple(r) for r in in_flight.execute("select count(*) from t")]
+    old_a.pool.checkin(in_flight)
+    assert 0 == old_a.pool.stats()["open"]
+    # Files that are not SQLite databases are skipped
+    (tmp_path / "broken.db").write_text("not a database")
+    await watcher.check()
+    await watcher.check()
+    assert "broken" not in ds.databases
+    # Deleted files are detached
+    os.remove(str(tmp_path / "b.db"))
+    await watcher.check()
+    assert ["a"] == list(ds.databases.keys())
+    assert {
+        "directories": [str(tmp_path)],
+        "databases": ["a"],
+        "attached": 1,
+        "replaced": 1,
+        "detached": 1,
+    } == watcher.stats()
+
+
+@pytest.mark.asyncio
+async def test_directory_watcher_survives_errors(tmp_path, monkeypatch):
+    ds = Datasette([], watch_dirs=[str(tmp_path)])
+    watcher = ds.directory_watcher
+    watcher.interval_ms = 1
+    original_open = watcher._open
+    opened = []
+
+    async def _open(path):
+        opened.append(Path(path).name)
+        if path.endswith("bad.db"):
+            raise RuntimeError("plugin failed")
+        return await original_open(path)
+
+    monkeypatch.setattr(watcher, "_open", _open)
+    _make_database_file(tmp_path / "bad.db")
+    _make_database_file(tmp_path / "good.db")
+    await watcher.check()
+    await watcher.check()
+    # One file failing does not stop the others being attached
+    assert ["good"] == list(ds.databases.keys())
+    assert ["bad.db", "good.db"] == opened
+
+    # Nor does an error in check() stop run() from watching
+    checks = []
+
+    async def check():
+        checks.append(1)
+        if len(checks) == 1:
+            raise RuntimeError("check failed")
+
+    monkeypatch.setattr(watcher, "check", check)
+    task = asyncio.ensure_future(watcher.run())
+    for _ in range(100):
+        if len(checks) > 1:
+            break
+        await asyncio.sleep(0.01)
+    task.cancel()
+    assert len(checks) > 1
+
+
+@pytest.mark.asyncio
+async def test_fast_count_threshold(tmp_path):
+    path = str(tmp_path / "counted.db")
+    conn = sqlite3.connect(path)
+    conn.execute("create table big (id integer primary key)")
+    conn.executemany("insert into big (id) values (?)", [(i,) for i in range(1, 11)])
+    conn.execute("delete from big where id = 3")
+    conn.execute("create table small (id integer primary key)")
+    conn.execute("insert into small (id) values (1)")
+    conn.execute("create table keyed (id text primary key) without rowid")
+    conn.executemany("insert into keyed (id) values (?)", [(str(i),) for i in range(8)])
+    conn.commit()
+    conn.close()
+    ds = Datasette([], immutables=[path], config={"fast_count_threshold": 5})
+    db = ds.databases["counted"]
+    # max(rowid) overestimates after a delete, so it is flagged as an estimate
+    assert {"big": 10, "small": 1, "keyed": 8} == await db.table_counts(1000)
+    assert {"big"} == db.estimated_table_counts
+    # sqlite_stat1 is preferred where it exists
+    conn = sqlite3.connect(path)
+    conn.execute("create index big_id on big (id)")
+    conn.execute("analyze")
+    conn.close()
+    ds = Datasette([], immutables=[path], config={"fast_count_threshold": 5})
+    db = ds.databases["counted"]
+    counts = await db.table_counts(1000)
+    assert {"big": 9, "small": 1, "keyed": 8} == {
+        table: count for table, count in counts.items() if table != "sqlite_stat1"
+    }
+    assert {"big", "keyed"} == db.estimated_table_counts
+    # Exact by default
+    db = Datasette([], immutables=[path]).databases["counted"]
+    assert 9 == (await db.table_counts(1000))["big"]
+    assert set() == db.estimated_table_counts
@@ -1,6 +1,15 @@
-from datasette.facets import ColumnFacet, ArrayFacet, DateFacet
-from datasette.utils import detect_json1
-from .fixtures import app_client  # noqa
+from datasette.facets import (
+    ColumnFacet,
+    ArrayFacet,
+    DateFacet,
+    ColumnProfile,
+    profile_column,
+)
+from datasette.utils import detect_json1, QueryInterrupted
+from datasette.utils.asgi import child_cancellation, current_cancellation
+import asyncio
+import sys
+from .fixtures import app_client, make_app_client  # noqa
 from .utils import MockRequest
 import pytest
 
@@ -90,6 +99,95 @@ async def test_column_facet_suggest_skip_if_enabled_by_metadata(app_client):
     ] == suggestions
 
 
+@pytest.mark.asyncio
+async def test_suggestions_share_one_sample(app_client, monkeypatch):
+    sqls = []
+    original_execute = app_client.ds.execute
+
+    async def execute(db_name, sql, *args, **kwargs):
+        sqls.append(sql)
+        return await original_execute(db_name, sql, *args, **kwargs)
+
+    monkeypatch.setattr(app_client.ds, "execute", execute)
+    facet_classes = [ColumnFacet, DateFacet]
+    if detect_json1():
+        facet_classes.append(ArrayFacet)
+    facets = [
+        facet_class(
+            app_client.ds,
+            MockRequest("http://localhost/"),
+            database="fixtures",
+            sql="select * from facetable",
+            table="facetable",
+            row_count=15,
+        )
+        for facet_class in facet_classes
+    ]
+    suggestions = await asyncio.gather(*[facet.suggest() for facet in facets])
+    assert [
+        [
+            "created",
+            "planet_int",
+            "on_earth",
+            "state",
+            "city_id",
+            "neighborhood",
+            "tags",
+            "complex_array",
+        ],
+        ["created"],
+        ["tags"],
+    ][: len(facets)] == [[s["name"] for s in suggested] for suggested in suggestions]
+    assert ["select * from (select * from facetable) limit 1000"] == sqls
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason="Requires Python 3.7+")
+@pytest.mark.asyncio
+async def test_shared_sample_not_cancelled_with_request(app_client, monkeypatch):
+    cancellations = []
+    original_execute = app_client.ds.execute
+
+    async def execute(db_name, sql, *args, **kwargs):
+        cancellations.append(current_cancellation())
+        return await original_execute(db_name, sql, *args, **kwargs)
+
+    monkeypatch.setattr(app_client.ds, "execute", execute)
+    facet = ColumnFacet(
+        app_client.ds,
+        MockRequest("http://localhost/"),
+        database="fixtures",
+        sql="select * from facetable where pk > 0",
+        table="facetable",
+        row_count=14,
+    )
+    with child_cancellation():
+        assert await facet.column_profiles()
+    assert [None] == cancellations
+
+
+@pytest.mark.parametrize(
+    "values,expected",
+    [
+        ([None, None], ColumnProfile(0, False, False, False)),
+        ([1, 2, 2, None], ColumnProfile(2, True, False, False)),
+        (
+            ['["a", "b"]', "[]", None, '["a", "b"]'],
+            ColumnProfile(2, True, True, False),
+        ),
+        (["[]", "[]"], ColumnProfile(1, True, False, False)),
+        (['["a"]', "[1]"], ColumnProfile(2, False, False, False)),
+        (['["a"]', "not json"], ColumnProfile(2, False, False, False)),
+        (
+            ["2019-01-14 08:00:00", "2019-01-15T12:44", "x"],
+            ColumnProfile(3, False, False, True),
+        ),
+        (["2019-13-01", "2019-01-14abc"], ColumnProfile(2, False, False, False)),
+    ],
+)
+def test_profile_column(values, expected):
+    assert expected == profile_column(values)
+
+
 @pytest.mark.asyncio
 async def test_column_facet_results(app_client):
     facet = ColumnFacet(
@@ -142,6 +240,79 @@ async def test_column_facet_results(app_client):
     } == buckets
 
 
+@pytest.mark.asyncio
+async def test_column_facet_results_single_pass(app_client, monkeypatch):
+    def facet(path, metadata=None):
+        return ColumnFacet(
+            app_client.ds,
+            MockRequest(path),
+            database="fixtures",
+            sql="select * from facetable where planet_int = :p",
+            params={"p": 1},
+            table="facetable",
+            metadata=metadata,
+        )
+
+    def without_urls(results):
+        return {
+            column: dict(
+                result,
+                toggle_url=None,
+                results=[dict(r, toggle_url=None) for r in result["results"]],
+            )
+            for column, result in results.items()
+        }
+
+    # Gives the same results as one query for each column
+    expected = {}
+    for column in ("neighborhood", "state", "city_id"):
+        results, timed_out = await facet(
+            "http://localhost/?_facet={}".format(column)
+        ).facet_results()
+        assert [] == timed_out
+        expected.update(without_urls(results))
+    expected["neighborhood"]["hideable"] = False
+    sqls = []
+    original_execute = app_client.ds.execute
+
+    async def execute(db_name, sql, *args, **kwargs):
+        sqls.append(sql)
+        return await original_execute(db_name, sql, *args, **kwargs)
+
+    monkeypatch.setattr(app_client.ds, "execute", execute)
+    results, timed_out = await facet(
+        "http://localhost/?_facet=state&_facet=city_id", {"facets": ["neighborhood"]}
+    ).facet_results()
+    assert [] == timed_out
+    assert ["neighborhood", "state", "city_id"] == list(results.keys())
+    assert expected == without_urls(results)
+    assert 1 == len([sql for sql in sqls if "group by" in sql])
+
+    # A timeout applies to every column in the query
+    async def timeout(db_name, sql, *args, **kwargs):
+        raise QueryInterrupted(None, sql, None)
+
+    monkeypatch.setattr(app_client.ds, "execute", timeout)
+    assert ({}, ["state", "city_id"]) == await facet(
+        "http://localhost/?_facet=state&_facet=city_id"
+    ).facet_results()
+
+    # If only the single pass times out each column is counted on its own
+    async def single_pass_timeout(db_name, sql, *args, **kwargs):
+        if "facet_column" in sql:
+            raise QueryInterrupted(None, sql, None)
+        return await original_execute(db_name, sql, *args, **kwargs)
+
+    monkeypatch.setattr(app_client.ds, "execute", single_pass_timeout)
+    results, timed_out = await facet(
+        "http://localhost/?_facet=state&_facet=city_id"
+    ).facet_results()
+    assert [] == timed_out
+    assert {
+        column: expected[column] for column in ("state", "city_id")
+    } == without_urls(results)
+
+
 @pytest.mark.asyncio
 async def test_column_facet_from_metadata_cannot_be_hidden(app_client):
     facet = ColumnFacet(
@@ -325,3 +496,50 @@ async def test_date_facet_results(app_client):
             "truncated": False,
         }
     } == buckets
+
+
+@pytest.mark.asyncio
+async def test_facets_fall_back_to_sample_on_timeout(monkeypatch):
+    for client in make_app_client(config={"facet_sample_size": 5}):
+        ds = client.ds
+        original_execute = ds.execute
+        sqls = []
+
+        async def execute(db_name, sql, *args, **kwargs):
+            # Exact facet queries time out, queries against the sample do not
+            sqls.append(sql)
+            if "count(*)" in sql and not sql.startswith("with"):
+                raise QueryInterrupted(None, sql, None)
+            return await original_execute(db_name, sql, *args, **kwargs)
+
+        monkeypatch.setattr(ds, "execute", execute)
+        facet = ColumnFacet(
+            ds,
+            MockRequest("http://localhost/?_facet=state&_facet=city_id"),
+            database="fixtures",
+            sql="select * from facetable",
+            table="facetable",
+        )
+        results, timed_out = await facet.facet_results()
+        assert [] == timed_out
+        state = results["state"]
+        assert state["approximate"]
+        assert 0.333333 == state["sample_fraction"]
+        # Rows 1, 4, 8, 11 and 15 were sampled, three of them in CA
+        assert {"value": "CA", "label": "CA", "count": 9, "count_range": [3, 20],} == {
+            key: value
+            for key, value in state["results"][0].items()
+            if key not in ("toggle_url", "selected")
+        }
+        # One sample query for each column
+        assert 2 == len([sql for sql in sqls if sql.startswith("with")])
+
+        # Views cannot be sampled, so their facets still time out
+        facet = ColumnFacet(
+            ds,
+            MockRequest("http://localhost/?_facet=state"),
+            database="fixtures",
+            sql="select * from simple_view",
+            table="simple_view",
+        )
+        assert ({}, ["state"]) == await facet.facet_results()
@@ -168,6 +168,22 @@ def test_validate_sql_select_good(good_sql):
     utils.validate_sql_select(good_sql)
 
 
+def test_sql_identifiers():
+    assert {"select", "a", "from", "my table", "join", "b", "c", "where", "d"} == (
+        utils.sql_identifiers(
+            "select a from [My Table] join \"b\" join `c` where d = 'e f'"
+        )
+    )
+
+
+def test_detect_window_functions_only_checks_once():
+    expected = utils.detect_window_functions(utils.sqlite3.connect(":memory:"))
+    assert expected == utils.detect_window_functions()
+    with patch.object(utils.sqlite3, "connect") as connect:
+        assert expected == utils.detect_window_functions()
+        assert not connect.called
+
+
 @pytest.mark.parametrize("open_quote,close_quote", [('"', '"'), ("[", "]")])
 def test_detect_fts(open_quote, close_quote):
     sql = """